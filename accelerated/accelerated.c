@@ -6,6 +6,7 @@
 // author: Michael Cohen <scudette@gmail.com>
 
 
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 
 // Number of bits used to hold type info in a proto tag.
@@ -58,12 +59,92 @@ int varint_encode(unsigned PY_LONG_LONG value,
 }
 
 
+// Encodes a long that does not fit into 64 bits, 7 bits at a time using
+// Python arithmetic. Returns a new string or NULL with an exception set.
+static PyObject *varint_encode_long(PyObject *number) {
+  size_t bits = _PyLong_NumBits(number);
+  Py_ssize_t length;
+  Py_ssize_t index;
+  PyObject *result = NULL;
+  PyObject *shift = NULL;
+  PyObject *value = NULL;
+  PyObject *next = NULL;
+  unsigned char *buffer;
+
+  if (bits == (size_t)-1 && PyErr_Occurred())
+    return NULL;
+
+  length = bits ? (bits + 6) / 7 : 1;
+  result = PyString_FromStringAndSize(NULL, length);
+  shift = PyInt_FromLong(7);
+  if (!result || !shift)
+    goto error;
+
+  buffer = (unsigned char *)PyString_AS_STRING(result);
+  value = number;
+  Py_INCREF(value);
+  for (index = 0; index < length; index++) {
+    buffer[index] = PyLong_AsUnsignedLongLongMask(value) & 0x7f;
+    if (PyErr_Occurred())
+      goto error;
+
+    if (index < length - 1)
+      buffer[index] |= 0x80;
+
+    next = PyNumber_Rshift(value, shift);
+    if (!next)
+      goto error;
+
+    Py_DECREF(value);
+    value = next;
+  }
+
+  Py_DECREF(value);
+  Py_DECREF(shift);
+  return result;
+
+error:
+  Py_XDECREF(value);
+  Py_XDECREF(shift);
+  Py_XDECREF(result);
+  return NULL;
+}
+
+
 PyObject *py_varint_encode(PyObject *self, PyObject *args) {
   unsigned char buffer[100];
   Py_ssize_t index = sizeof(buffer);
   unsigned PY_LONG_LONG value;
+  PyObject *number = NULL;
+  PyObject *zero = NULL;
+  int negative = 0;
+
+  if (!PyArg_ParseTuple(args, "O", &number))
+    return NULL;
 
-  if (!PyArg_ParseTuple(args, "K", &value))
+  zero = PyInt_FromLong(0);
+  negative = PyObject_RichCompareBool(number, zero, Py_LT);
+  Py_DECREF(zero);
+  if (negative < 0)
+    return NULL;
+
+  if (negative) {
+    PyErr_SetString(
+        PyExc_ValueError, "Varint can not encode a negative number.");
+    return NULL;
+  }
+
+  if (PyInt_Check(number)) {
+    value = PyInt_AsUnsignedLongLongMask(number);
+  } else {
+    value = PyLong_AsUnsignedLongLong(number);
+    // Like the Python encoder, encode longs of any width.
+    if (PyErr_Occurred() && PyErr_ExceptionMatches(PyExc_OverflowError)) {
+      PyErr_Clear();
+      return varint_encode_long(number);
+    }
+  }
+  if (PyErr_Occurred())
     return NULL;
 
   // Can't really happen but just in case.
@@ -98,7 +179,7 @@ int varint_decode(unsigned PY_LONG_LONG *result,
     }
 
     shift += 7;
-  } while (shift < 64);
+  }
 
   // Error decoding varint - buffer too short.
   return 0;
@@ -111,10 +192,40 @@ PyObject *py_varint_decode(PyObject *self, PyObject *args) {
   Py_ssize_t length = 0;
   unsigned PY_LONG_LONG result = 0;
 
-  if (!PyArg_ParseTuple(args, "s#n", &buffer, &length, &pos))
+  if (!PyArg_ParseTuple(args, "s#|n", &buffer, &length, &pos))
+    return NULL;
+
+  if (pos < 0 || pos > length) {
+    PyErr_SetString(PyExc_ValueError, "Invalid position.");
     return NULL;
+  }
+
+  if (varint_decode(&result, buffer + pos, length - pos, &length)) {
+    // The last byte of a 10 byte varint may carry bits beyond 64 bits, which
+    // the Python decoder keeps.
+    unsigned char high_bits = (unsigned char)buffer[pos + length - 1] >> 1;
+    if (length == 10 && high_bits) {
+      PyObject *value = NULL;
+      PyObject *low = PyLong_FromUnsignedLongLong(result);
+      PyObject *high = PyLong_FromLong(high_bits);
+      PyObject *shift = PyInt_FromLong(64);
+      PyObject *shifted = NULL;
+
+      if (low && high && shift)
+        shifted = PyNumber_Lshift(high, shift);
+      if (shifted)
+        value = PyNumber_Or(low, shifted);
+
+      Py_XDECREF(low);
+      Py_XDECREF(high);
+      Py_XDECREF(shift);
+      Py_XDECREF(shifted);
+      if (!value)
+        return NULL;
+
+      return Py_BuildValue("Nn", value, pos + length);
+    }
 
-  if (varint_decode(&result, buffer+pos, length, &length)) {
     return Py_BuildValue("Kn", result, pos + length);
   }
 
@@ -123,198 +234,643 @@ PyObject *py_varint_decode(PyObject *self, PyObject *args) {
 }
 
 
+// Measures the field at the start of the buffer: the length of its encoded
+// tag, of its encoded length (only length delimited fields have one) and of its
+// data. Returns 0 with an exception set if the buffer does not hold a complete
+// field.
+static int parse_entry(const char *buffer, Py_ssize_t length,
+                       Py_ssize_t *tag_length, Py_ssize_t *prefix_length,
+                       Py_ssize_t *data_length) {
+  const char *data = NULL;
+  Py_ssize_t remaining = 0;
+  unsigned PY_LONG_LONG tag;
+  unsigned PY_LONG_LONG value;
+
+  *prefix_length = 0;
+  *data_length = 0;
+
+  if (!varint_decode(&tag, buffer, length, tag_length)) {
+    PyErr_SetString(PyExc_ValueError, "Invalid tag");
+    return 0;
+  }
+
+  data = buffer + *tag_length;
+  remaining = length - *tag_length;
+
+  switch (tag & TAG_TYPE_MASK) {
+    case WIRETYPE_VARINT:
+      if (!varint_decode(&value, data, remaining, data_length)) {
+        PyErr_SetString(PyExc_ValueError, "Invalid varint.");
+        return 0;
+      }
+      break;
+
+    case WIRETYPE_FIXED64:
+      *data_length = 8;
+      break;
+
+    case WIRETYPE_FIXED32:
+      *data_length = 4;
+      break;
+
+    case WIRETYPE_LENGTH_DELIMITED:
+      // The data is preceded by its length.
+      if (!varint_decode(&value, data, remaining, prefix_length)) {
+        PyErr_SetString(PyExc_ValueError, "Invalid length tag.");
+        return 0;
+      }
+
+      if (value > (unsigned PY_LONG_LONG)(remaining - *prefix_length)) {
+        PyErr_SetString(
+            PyExc_ValueError, "Length tag exceeds available buffer.");
+        return 0;
+      }
+      *data_length = (Py_ssize_t)value;
+      break;
+
+    default:
+      PyErr_SetString(PyExc_ValueError, "Unexpected Tag");
+      return 0;
+  }
+
+  if (*prefix_length + *data_length > remaining) {
+    PyErr_SetString(PyExc_ValueError, "Field exceeds available buffer.");
+    return 0;
+  }
+
+  return 1;
+}
+
+
+// Reads the field at the start of the buffer into an (encoded_tag,
+// encoded_length, wire_format) tuple of strings and advances the buffer and
+// length past it.
+static PyObject *read_entry(const char **buffer, Py_ssize_t *length) {
+  Py_ssize_t tag_length = 0;
+  Py_ssize_t prefix_length = 0;
+  Py_ssize_t data_length = 0;
+  Py_ssize_t entry_length = 0;
+  PyObject *entry = NULL;
+
+  if (!parse_entry(*buffer, *length, &tag_length, &prefix_length,
+                   &data_length))
+    return NULL;
+
+  entry = Py_BuildValue("(s#s#s#)",
+                        *buffer, tag_length,
+                        *buffer + tag_length, prefix_length,
+                        *buffer + tag_length + prefix_length, data_length);
+  if (!entry)
+    return NULL;
+
+  entry_length = tag_length + prefix_length + data_length;
+  *buffer += entry_length;
+  *length -= entry_length;
+
+  return entry;
+}
+
+
+// Checks the buffer arguments and positions buffer and length on the part of
+// the buffer to parse.
+static int check_buffer_range(const char **buffer, Py_ssize_t buffer_len,
+                              Py_ssize_t index, Py_ssize_t *length) {
+  if (index < 0 || *length < 0 || index > buffer_len) {
+    PyErr_SetString(
+        PyExc_ValueError, "Invalid parameters.");
+    return 0;
+  }
+
+  // Advance the buffer to the required start index.
+  *buffer += index;
+
+  // Determine the length we will be parsing.
+  if (*length == 0 || *length > buffer_len - index) {
+    *length = buffer_len - index;
+  }
+
+  return 1;
+}
+
+
 PyObject *py_split_buffer(PyObject *self, PyObject *args, PyObject *kwargs) {
-  char *buffer;
+  const char *buffer;
   Py_ssize_t buffer_len = 0;
   Py_ssize_t length = 0;
   Py_ssize_t index = 0;
   static const char *kwlist[] = {"buffer", "index", "length", NULL};
-  PyObject *encoded_tag = NULL;
-
-  PyObject *result = PyList_New(0);
-  if (!result)
-    return NULL;
+  PyObject *result = NULL;
 
   if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#|nn", (char **)kwlist,
                                    &buffer, &buffer_len, &index, &length))
     return NULL;
 
-  if (index < 0 || length < 0 || index > buffer_len) {
-    PyErr_SetString(
-        PyExc_ValueError, "Invalid parameters.");
+  if (!check_buffer_range(&buffer, buffer_len, index, &length))
+    return NULL;
+
+  result = PyList_New(0);
+  if (!result)
     return NULL;
+
+  // We advance the buffer and decrement the length until there is no more
+  // buffer space left.
+  while (length > 0) {
+    PyObject *entry = read_entry(&buffer, &length);
+    int error = 0;
+
+    if (!entry)
+      goto error;
+
+    error = PyList_Append(result, entry);
+    Py_DECREF(entry);
+    if (error < 0)
+      goto error;
   }
 
-  // Advance the buffer to the required start index.
-  buffer += index;
+  return result;
+
+error:
+  Py_DECREF(result);
+  return NULL;
+}
+
+
+// Stores a field of a known, non repeated type in the raw data dict.
+static int store_field(PyObject *raw_data, PyObject *type_info,
+                       PyObject *entry) {
+  PyObject *name = NULL;
+  PyObject *value = NULL;
+  int error = -1;
 
-  // Determine the length we will be splitting.
-  if (length == 0 || length > buffer_len - index) {
-    length = buffer_len - index;
+  name = PyObject_GetAttrString(type_info, "name");
+  if (!name)
+    goto out;
+
+  // Set the python_format as None so it gets converted lazily on access.
+  value = PyTuple_Pack(3, Py_None, entry, type_info);
+  if (!value)
+    goto out;
+
+  error = PyObject_SetItem(raw_data, name, value);
+
+out:
+  Py_XDECREF(name);
+  Py_XDECREF(value);
+  return error;
+}
+
+
+// Collects the location of a repeated field element under the field name.
+static int store_repeated_field(PyObject *repeated, PyObject *type_info,
+                                PyObject *entry) {
+  PyObject *name = NULL;
+  PyObject *items = NULL;
+  PyObject *value = NULL;
+  int error = -1;
+
+  name = PyObject_GetAttrString(type_info, "name");
+  if (!name)
+    goto out;
+
+  // Borrowed reference.
+  items = PyDict_GetItem(repeated, name);
+  if (!items) {
+    items = PyList_New(0);
+    if (!items)
+      goto out;
+
+    error = PyDict_SetItem(repeated, name, items);
+    Py_DECREF(items);
+    if (error < 0)
+      goto out;
   }
 
-  // We advance the buffer and decrement the length until there is no more
-  // buffer space left.
+  value = PyTuple_Pack(2, Py_None, entry);
+  if (!value)
+    goto out;
+
+  error = PyList_Append(items, value);
+
+out:
+  Py_XDECREF(name);
+  Py_XDECREF(value);
+  return error;
+}
+
+
+// Creates a slice_type((buffer, start, tag_end, data_start, end)) instance.
+// slice_type is a tuple subclass, so we fill it in directly instead of calling
+// it which would be much slower.
+static PyObject *new_slice(PyObject *slice_type, PyObject *buffer,
+                           Py_ssize_t start, Py_ssize_t tag_end,
+                           Py_ssize_t data_start, Py_ssize_t end) {
+  PyTypeObject *type = (PyTypeObject *)slice_type;
+  Py_ssize_t offsets[4];
+  PyObject *result = NULL;
+  int i;
+
+  offsets[0] = start;
+  offsets[1] = tag_end;
+  offsets[2] = data_start;
+  offsets[3] = end;
+
+  result = type->tp_alloc(type, 5);
+  if (!result)
+    return NULL;
+
+  Py_INCREF(buffer);
+  PyTuple_SET_ITEM(result, 0, buffer);
+
+  for (i = 0; i < 4; i++) {
+    PyObject *offset = PyInt_FromSsize_t(offsets[i]);
+    if (!offset) {
+      Py_DECREF(result);
+      return NULL;
+    }
+    PyTuple_SET_ITEM(result, i + 1, offset);
+  }
+
+  return result;
+}
+
+
+// Parses the fields in buffer_obj[index:index + length] into the raw_data
+// dict. Returns a new dict of the repeated field elements or NULL on error.
+static PyObject *read_fields(PyObject *buffer_obj, Py_ssize_t index,
+                             Py_ssize_t length, PyObject *type_infos,
+                             PyObject *raw_data, PyObject *repeated_type,
+                             PyObject *slice_type) {
+  const char *buffer = PyString_AS_STRING(buffer_obj);
+  Py_ssize_t buffer_len = PyString_GET_SIZE(buffer_obj);
+  Py_ssize_t count = 0;
+  PyObject *repeated = NULL;
+
+  if (!check_buffer_range(&buffer, buffer_len, index, &length))
+    return NULL;
+
+  // Repeated fields are returned to the caller as a dict of field name to a
+  // list of (None, slice_type((buffer, start, tag_end, data_start, end)))
+  // tuples, so their elements are not copied out of the buffer.
+  repeated = PyDict_New();
+  if (!repeated)
+    return NULL;
+
   while (length > 0) {
-    Py_ssize_t decoded_length = 0;
-    unsigned PY_LONG_LONG tag;
-    int tag_type;
-
-    // Read the tag off the buffer.
-    varint_decode(&tag, buffer, length, &decoded_length);
-
-    // Prepare to pass the encoded tag into the result tuple.
-    encoded_tag = PyString_FromStringAndSize(buffer, decoded_length);
-    buffer += decoded_length;
-    length -= decoded_length;
-
-    // Handle the tag depending on its type.
-    tag_type = tag & TAG_TYPE_MASK;
-    switch (tag_type) {
-      case WIRETYPE_VARINT: {
-        // Decode the varint and position ourselves at the next tag.
-        Py_ssize_t tag_length = 0;
-        PyObject *entry = NULL;
-
-        varint_decode(&tag, buffer, length, &tag_length);
-
-        // Create an entry to add to the result set. Note: We use
-        // PyTuple_SetItem which steals the references here instead of
-        // PyTuple_Pack which does not (meaning its more involved to use).
-        entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
-
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, 0));
-
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer, tag_length));
-
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
-
-        buffer += tag_length;
-        length -= tag_length;
-
-        break;
+    Py_ssize_t tag_length = 0;
+    Py_ssize_t prefix_length = 0;
+    Py_ssize_t data_length = 0;
+    Py_ssize_t entry_length = 0;
+    PyObject *encoded_tag = NULL;
+    PyObject *type_info = NULL;
+    PyObject *entry = NULL;
+    int error = -1;
+
+    if (!parse_entry(buffer, length, &tag_length, &prefix_length,
+                     &data_length))
+      goto error;
+
+    entry_length = tag_length + prefix_length + data_length;
+
+    encoded_tag = PyString_FromStringAndSize(buffer, tag_length);
+    if (!encoded_tag)
+      goto error;
+
+    // Borrowed reference.
+    type_info = PyDict_GetItem(type_infos, encoded_tag);
+
+    if (type_info && (PyObject *)Py_TYPE(type_info) == repeated_type) {
+      Py_ssize_t start = buffer - PyString_AS_STRING(buffer_obj);
+
+      entry = new_slice(slice_type, buffer_obj, start, start + tag_length,
+                        start + tag_length + prefix_length,
+                        start + entry_length);
+      if (entry)
+        error = store_repeated_field(repeated, type_info, entry);
+
+    } else {
+      entry = Py_BuildValue("(Os#s#)", encoded_tag,
+                            buffer + tag_length, prefix_length,
+                            buffer + tag_length + prefix_length, data_length);
+      if (!entry) {
+        error = -1;
+
+      } else if (!type_info) {
+        // Unknown fields are kept under a unique integer key so they are
+        // written back unchanged.
+        PyObject *key = PyInt_FromSsize_t(count);
+        PyObject *value = PyTuple_Pack(3, Py_None, entry, Py_None);
+
+        count++;
+        if (key && value)
+          error = PyObject_SetItem(raw_data, key, value);
+
+        Py_XDECREF(key);
+        Py_XDECREF(value);
+
+      } else {
+        error = store_field(raw_data, type_info, entry);
       }
+    }
 
-      case WIRETYPE_FIXED64: {
-        // Fixed size data.
-        Py_ssize_t tag_length = 8;
+    Py_DECREF(encoded_tag);
+    Py_XDECREF(entry);
+    if (error < 0)
+      goto error;
 
-        PyObject *entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
+    buffer += entry_length;
+    length -= entry_length;
+  }
 
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, 0));
+  return repeated;
 
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer, tag_length));
+error:
+  Py_DECREF(repeated);
+  return NULL;
+}
 
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
 
-        buffer += tag_length;
-        length -= tag_length;
+static int check_slice_type(PyObject *slice_type) {
+  if (!PyType_Check(slice_type) ||
+      !PyType_IsSubtype((PyTypeObject *)slice_type, &PyTuple_Type)) {
+    PyErr_SetString(PyExc_TypeError, "slice_type must be a tuple subclass.");
+    return 0;
+  }
 
-        break;
-      }
+  return 1;
+}
 
-      case WIRETYPE_FIXED32: {
-        // Fixed size data.
-        Py_ssize_t tag_length = 4;
 
-        PyObject *entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
+PyObject *py_read_into_object(PyObject *self, PyObject *args,
+                              PyObject *kwargs) {
+  PyObject *buffer_obj = NULL;
+  Py_ssize_t length = 0;
+  Py_ssize_t index = 0;
+  static const char *kwlist[] = {
+    "buffer", "index", "length", "type_infos_by_encoded_tag", "raw_data",
+    "repeated_type", "slice_type", NULL};
+  PyObject *type_infos = NULL;
+  PyObject *raw_data = NULL;
+  PyObject *repeated_type = NULL;
+  PyObject *slice_type = NULL;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "SnnO!OOO", (char **)kwlist,
+                                   &buffer_obj, &index, &length,
+                                   &PyDict_Type, &type_infos, &raw_data,
+                                   &repeated_type, &slice_type))
+    return NULL;
 
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, 0));
+  if (!check_slice_type(slice_type))
+    return NULL;
 
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer, tag_length));
+  return read_fields(buffer_obj, index, length, type_infos, raw_data,
+                     repeated_type, slice_type);
+}
 
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
 
-        buffer += tag_length;
-        length -= tag_length;
+// Parses a list of buffers into the matching list of raw data dicts of objects
+// of the same type. Returns a list with the repeated fields of each object.
+PyObject *py_read_into_objects(PyObject *self, PyObject *args) {
+  PyObject *buffers = NULL;
+  PyObject *type_infos = NULL;
+  PyObject *raw_datas = NULL;
+  PyObject *repeated_type = NULL;
+  PyObject *slice_type = NULL;
+  PyObject *result = NULL;
+  Py_ssize_t i;
 
-        break;
-      }
+  if (!PyArg_ParseTuple(args, "OO!OOO", &buffers, &PyDict_Type, &type_infos,
+                        &raw_datas, &repeated_type, &slice_type))
+    return NULL;
 
-      case WIRETYPE_LENGTH_DELIMITED: {
-        // Decode the length varint and position ourselves at the start of the
-        // data.
-        Py_ssize_t decoded_length = 0;
-        unsigned PY_LONG_LONG data_size;
-        PyObject *entry = NULL;
+  if (!check_slice_type(slice_type))
+    return NULL;
 
-        varint_decode(&data_size, buffer, length, &decoded_length);
+  buffers = PySequence_Fast(buffers, "buffers must be a sequence.");
+  if (!buffers)
+    return NULL;
 
-        // Check that we do not exceed the available buffer here.
-        if (data_size + decoded_length > (unsigned int)length) {
-          PyErr_SetString(
-              PyExc_ValueError, "Length tag exceeds available buffer.");
+  raw_datas = PySequence_Fast(raw_datas, "raw_datas must be a sequence.");
+  if (!raw_datas)
+    goto out;
 
-          goto error;
-        }
+  if (PySequence_Fast_GET_SIZE(buffers) !=
+      PySequence_Fast_GET_SIZE(raw_datas)) {
+    PyErr_SetString(PyExc_ValueError,
+                    "buffers and raw_datas must have the same length.");
+    goto out;
+  }
 
-        entry = PyTuple_New(3);
-        PyTuple_SET_ITEM(
-            entry, 0, encoded_tag);
+  result = PyList_New(PySequence_Fast_GET_SIZE(buffers));
+  if (!result)
+    goto out;
 
-        // Empty string "".
-        PyTuple_SET_ITEM(
-            entry, 1,
-            PyString_FromStringAndSize(buffer, decoded_length));
+  for (i = 0; i < PySequence_Fast_GET_SIZE(buffers); i++) {
+    PyObject *buffer_obj = PySequence_Fast_GET_ITEM(buffers, i);
+    PyObject *repeated = NULL;
 
-        PyTuple_SET_ITEM(
-            entry, 2,
-            PyString_FromStringAndSize(buffer + decoded_length, data_size));
+    if (!PyString_Check(buffer_obj)) {
+      PyErr_SetString(PyExc_TypeError, "buffers must be strings.");
+      Py_CLEAR(result);
+      goto out;
+    }
 
-        PyList_Append(result, entry);
-        Py_DECREF(entry);
+    repeated = read_fields(buffer_obj, 0, 0, type_infos,
+                           PySequence_Fast_GET_ITEM(raw_datas, i),
+                           repeated_type, slice_type);
+    if (!repeated) {
+      Py_CLEAR(result);
+      goto out;
+    }
 
-        buffer += decoded_length + data_size;
-        length -= decoded_length + data_size;
+    PyList_SET_ITEM(result, i, repeated);
+  }
 
-        break;
-      }
+out:
+  Py_DECREF(buffers);
+  Py_XDECREF(raw_datas);
+  return result;
+}
 
-      default:
-        PyErr_SetString(
-            PyExc_ValueError, "Unexpected Tag");
 
-        goto error;
+// Appends the wire format of a single (python_format, wire_format,
+// type_descriptor) entry to the pieces list. The wire format is only
+// recalculated if it is missing or the python object was modified.
+static int serialize_entry(PyObject *entry, PyObject *pieces) {
+  PyObject *fields = NULL;
+  PyObject *python_format = NULL;
+  PyObject *wire_format = NULL;
+  PyObject *type_descriptor = NULL;
+  PyObject *converted = NULL;
+  PyObject *wire_fields = NULL;
+  Py_ssize_t i;
+  int error = -1;
+
+  fields = PySequence_Fast(entry, "Entries must be sequences.");
+  if (!fields)
+    return -1;
+
+  if (PySequence_Fast_GET_SIZE(fields) != 3) {
+    PyErr_SetString(PyExc_ValueError, "Entries must have three fields.");
+    goto out;
+  }
+
+  python_format = PySequence_Fast_GET_ITEM(fields, 0);
+  wire_format = PySequence_Fast_GET_ITEM(fields, 1);
+  type_descriptor = PySequence_Fast_GET_ITEM(fields, 2);
+
+  if (wire_format != Py_None) {
+    int dirty = PyObject_IsTrue(python_format);
+
+    if (dirty > 0) {
+      PyObject *result = PyObject_CallMethod(
+          type_descriptor, "IsDirty", "(O)", python_format);
+      if (!result)
+        goto out;
+
+      dirty = PyObject_IsTrue(result);
+      Py_DECREF(result);
     }
+
+    if (dirty < 0)
+      goto out;
+
+    if (dirty)
+      wire_format = Py_None;
+  }
+
+  if (wire_format == Py_None) {
+    converted = PyObject_CallMethod(
+        type_descriptor, "ConvertToWireFormat", "(O)", python_format);
+    if (!converted)
+      goto out;
+
+    wire_format = converted;
+  }
+
+  wire_fields = PySequence_Fast(wire_format, "Wire format must be a sequence.");
+  if (!wire_fields)
+    goto out;
+
+  for (i = 0; i < PySequence_Fast_GET_SIZE(wire_fields); i++) {
+    if (PyList_Append(pieces, PySequence_Fast_GET_ITEM(wire_fields, i)) < 0)
+      goto out;
   }
 
+  error = 0;
+
+out:
+  Py_DECREF(fields);
+  Py_XDECREF(converted);
+  Py_XDECREF(wire_fields);
+  return error;
+}
+
+
+// Serializes an iterable of entries. Returns a new string or NULL on error.
+static PyObject *serialize_entries(PyObject *entries) {
+  PyObject *iterator = NULL;
+  PyObject *entry = NULL;
+  PyObject *pieces = NULL;
+  PyObject *separator = NULL;
+  PyObject *result = NULL;
+
+  iterator = PyObject_GetIter(entries);
+  if (!iterator)
+    return NULL;
+
+  pieces = PyList_New(0);
+  if (!pieces)
+    goto out;
+
+  while ((entry = PyIter_Next(iterator))) {
+    int error = serialize_entry(entry, pieces);
+
+    Py_DECREF(entry);
+    if (error < 0)
+      goto out;
+  }
+
+  if (PyErr_Occurred())
+    goto out;
+
+  separator = PyString_FromStringAndSize(NULL, 0);
+  if (!separator)
+    goto out;
+
+  result = _PyString_Join(separator, pieces);
+
+out:
+  Py_DECREF(iterator);
+  Py_XDECREF(pieces);
+  Py_XDECREF(separator);
   return result;
+}
 
-error:
-  Py_DECREF(encoded_tag);
-  return NULL;
+
+PyObject *py_serialize_entries(PyObject *self, PyObject *args) {
+  PyObject *entries = NULL;
+
+  if (!PyArg_ParseTuple(args, "O", &entries))
+    return NULL;
+
+  return serialize_entries(entries);
+}
+
+
+// Serializes the entries of each raw data dict in a list.
+PyObject *py_serialize_many(PyObject *self, PyObject *args) {
+  PyObject *raw_datas = NULL;
+  PyObject *result = NULL;
+  Py_ssize_t i;
+
+  if (!PyArg_ParseTuple(args, "O", &raw_datas))
+    return NULL;
+
+  raw_datas = PySequence_Fast(raw_datas, "raw_datas must be a sequence.");
+  if (!raw_datas)
+    return NULL;
+
+  result = PyList_New(PySequence_Fast_GET_SIZE(raw_datas));
+  if (!result)
+    goto out;
+
+  for (i = 0; i < PySequence_Fast_GET_SIZE(raw_datas); i++) {
+    PyObject *raw_data = PySequence_Fast_GET_ITEM(raw_datas, i);
+    PyObject *entries = NULL;
+    PyObject *serialized = NULL;
+
+    if (!PyDict_Check(raw_data)) {
+      PyErr_SetString(PyExc_TypeError, "raw_datas must be dicts.");
+      Py_CLEAR(result);
+      goto out;
+    }
+
+    entries = PyDict_Values(raw_data);
+    if (entries) {
+      serialized = serialize_entries(entries);
+      Py_DECREF(entries);
+    }
+
+    if (!serialized) {
+      Py_CLEAR(result);
+      goto out;
+    }
+
+    PyList_SET_ITEM(result, i, serialized);
+  }
+
+out:
+  Py_DECREF(raw_datas);
+  return result;
 }
 
+
 /* Retrieves the semantic protobuf version
  * Returns a Python object if successful or NULL on error
  */
 PyObject *py_semantic_get_version(PyObject *self, PyObject *arguments) {
     const char *errors = NULL;
-    return(PyUnicode_DecodeUTF8("20150518", (Py_ssize_t) 8, errors));
+    return(PyUnicode_DecodeUTF8("20161018", (Py_ssize_t) 8, errors));
 }
 
 static PyMethodDef _semantic_methods[] = {
@@ -340,6 +896,26 @@ static PyMethodDef _semantic_methods[] = {
      METH_VARARGS | METH_KEYWORDS,
      "Split a buffer into tags and wire format data."},
 
+    {"read_into_object",
+     (PyCFunction)py_read_into_object,
+     METH_VARARGS | METH_KEYWORDS,
+     "Parse a buffer into the raw data dict of a protobuf struct."},
+
+    {"serialize_entries",
+     (PyCFunction)py_serialize_entries,
+     METH_VARARGS,
+     "Serialize (python_format, wire_format, type_descriptor) entries."},
+
+    {"read_into_objects",
+     (PyCFunction)py_read_into_objects,
+     METH_VARARGS,
+     "Parse a list of buffers into a list of raw data dicts."},
+
+    {"serialize_many",
+     (PyCFunction)py_serialize_many,
+     METH_VARARGS,
+     "Serialize the entries of each raw data dict in a list."},
+
     {NULL}  /* Sentinel */
 };
 
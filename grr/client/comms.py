@@ -20,6 +20,9 @@ The client connections are controlled via a number of config parameters:
 - Client.poll_max, Client.poll_min: Parameters for timing of SLOW POLL and FAST
   POLL modes.
 
+- Client.http_keep_alive, Client.http_keep_alive_idle: Whether connections to
+  the server are kept open between polls and for how long they may sit idle.
+
 The client goes through a state machine:
 
 1) In the INITIAL state, the client has no active server URL or active proxy and
@@ -59,7 +62,12 @@ The client goes through a state machine:
    start searching for a new URL/Proxy combination). If a retry is successful,
    the client will return to its designated polling frequency.
 
-7) If there are Client.connection_error_limit failures, the client will
+7) If the server returns a 503 error it is overloaded and turned the request
+   away. The client keeps its messages and waits for the number of seconds the
+   Retry-After header asks for (at most Client.poll_max) before polling again.
+   A 503 is considered a valid connection, like a 406.
+
+8) If there are Client.connection_error_limit failures, the client will
    exit. Hopefully the nanny will restart the client.
 
 Examples:
@@ -84,6 +92,7 @@ import sys
 import threading
 import time
 import traceback
+import urlparse
 
 
 import psutil
@@ -112,11 +121,19 @@ from grr.lib.rdfvalues import protodict as rdf_protodict
 class HTTPObject(object):
   """Data returned from a HTTP connection."""
 
-  def __init__(self, url="", data="", proxy="", code=500, duration=0):
+  def __init__(self,
+               url="",
+               data="",
+               proxy="",
+               code=500,
+               duration=0,
+               retry_after=None):
     self.url = url
     self.data = data
     self.proxy = proxy
     self.code = code
+    # The number of seconds the server asked us to wait with a 503.
+    self.retry_after = retry_after
     # Contains the decoded data from the 'control' endpoint.
     self.messages = self.source = self.nonce = None
     self.duration = duration
@@ -151,6 +168,12 @@ class HTTPManager(object):
     self.active_base_url = None
     self.error_poll_min = config_lib.CONFIG["Client.error_poll_min"]
 
+    # Open requests sessions keyed by (server, proxy), each with the time it
+    # was last used. A session keeps its connection alive between polls.
+    self.sessions = {}
+    self.keep_alive = config_lib.CONFIG["Client.http_keep_alive"]
+    self.keep_alive_idle = config_lib.CONFIG["Client.http_keep_alive_idle"]
+
   def _GetBaseURLs(self):
     """Gathers a list of base URLs we will try."""
     result = config_lib.CONFIG["Client.server_urls"]
@@ -198,8 +221,8 @@ class HTTPManager(object):
                          timeout=None):
     """Search through all the base URLs to connect to one that works.
 
-    This is a thin wrapper around requests.request() so most parameters are
-    documented there.
+    This is a thin wrapper around requests.Session.request() so most parameters
+    are documented there.
 
     Args:
       path: The URL path to access in this endpoint.
@@ -333,6 +356,14 @@ class HTTPManager(object):
             self.consecutive_connection_errors = 0
             return HTTPObject(code=406)
 
+          if last_error == 503:
+            # The frontend is overloaded and asks us to come back later. It is
+            # reachable, so trying other proxies would not help.
+            self.consecutive_connection_errors = 0
+            return HTTPObject(
+                code=503,
+                retry_after=self._GetRetryAfter(e.response))
+
         # Try the next proxy
         self.last_proxy_index = proxy_index + 1
         tries += 1
@@ -357,7 +388,7 @@ class HTTPManager(object):
 
     Args:
       timeout: Timeout for retry.
-      **request_args: Args to the requests.request call.
+      **request_args: Args to the requests.Session.request call.
 
     Returns:
       a tuple of duration, urllib2.urlopen response.
@@ -369,7 +400,7 @@ class HTTPManager(object):
         if not timeout:
           timeout = config_lib.CONFIG["Client.http_timeout"]
 
-        result = requests.request(**request_args)
+        result = self._SendRequest(timeout=timeout, **request_args)
         # By default requests doesn't raise on HTTP error codes.
         result.raise_for_status()
 
@@ -384,9 +415,10 @@ class HTTPManager(object):
         # messages.
         if self.active_base_url is not None:
           # Propagate 406 immediately without retrying, as 406 is a valid
-          # response that indicates a need for enrollment.
+          # response that indicates a need for enrollment. A 503 tells us how
+          # long to back off, so it is not retried either.
           response = getattr(e, "response", None)
-          if getattr(response, "status_code", None) == 406:
+          if getattr(response, "status_code", None) in (406, 503):
             raise
 
           if self.consecutive_connection_errors >= self.retry_error_limit:
@@ -408,6 +440,82 @@ class HTTPManager(object):
         else:
           raise e
 
+  def _GetSession(self, key):
+    """Returns the session for key and whether it was used before."""
+    now = time.time()
+    session, last_used = self.sessions.get(key, (None, 0))
+    if session is not None and now - last_used > self.keep_alive_idle:
+      # Idle connections may have been dropped by the server or a NAT box on
+      # the way, so we do not trust them any more.
+      self._CloseSession(key)
+      session = None
+
+    reused = session is not None
+    if session is None:
+      session = requests.Session()
+      stats.STATS.IncrementCounter("grr_client_http_sessions")
+
+    self.sessions[key] = (session, now)
+    return session, reused
+
+  def _CloseSession(self, key):
+    session, _ = self.sessions.pop(key, (None, 0))
+    if session is not None:
+      session.close()
+
+  def Close(self):
+    """Closes all open connections."""
+    for key in self.sessions.keys():
+      self._CloseSession(key)
+
+  def _SendRequest(self, **request_args):
+    """Sends a request, reusing an open connection to the server if possible.
+
+    A server or proxy may close a kept alive connection just as we reuse it. In
+    that case we reconnect right away instead of treating it as a connection
+    error, which would back off and eventually search for another URL.
+
+    Args:
+      **request_args: Args to the requests.Session.request call.
+
+    Returns:
+      The requests.Response object.
+    """
+    if not self.keep_alive:
+      session = requests.Session()
+      try:
+        return session.request(**request_args)
+      finally:
+        session.close()
+
+    parsed_url = urlparse.urlparse(request_args["url"])
+    key = (parsed_url.scheme, parsed_url.netloc,
+           request_args.get("proxies", {}).get("http", ""))
+
+    session, reused = self._GetSession(key)
+    try:
+      result = session.request(**request_args)
+    except requests.ConnectionError as e:
+      self._CloseSession(key)
+      if not reused or e.response is not None:
+        raise
+
+      stats.STATS.IncrementCounter("grr_client_http_stale_connections")
+      session, reused = self._GetSession(key)
+      result = session.request(**request_args)
+
+    if reused:
+      stats.STATS.IncrementCounter("grr_client_http_reused_sessions")
+
+    return result
+
+  def _GetRetryAfter(self, response):
+    """Returns the backoff in seconds a 503 response asks for."""
+    try:
+      return int(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+      return self.error_poll_min
+
   def Wait(self, timeout):
     """Wait for the specified timeout."""
     time.sleep(timeout - int(timeout))
@@ -441,6 +549,10 @@ class Timer(object):
     """Switch to slow poll mode."""
     self.sleep_time = self.poll_max
 
+  def Backoff(self, timeout):
+    """Wait at least timeout seconds, but no longer than poll_max, next time."""
+    self.sleep_time = max(self.sleep_time, min(timeout, self.poll_max))
+
   def Wait(self):
     """Wait until the next action is needed."""
     time.sleep(self.sleep_time - int(self.sleep_time))
@@ -457,6 +569,64 @@ class Timer(object):
                           max(self.poll_min, self.sleep_time) * self.poll_slew)
 
 
+class PostSizer(object):
+  """Sizes the posts to the server.
+
+  Every post pays a round trip on top of the time it takes to upload its data,
+  so over slow links small posts waste most of their time waiting. Posts are
+  therefore sized so that uploading them takes Client.post_rtt_multiple round
+  trips, but no more than half of Client.http_timeout. The round trip time is
+  measured on posts smaller than Client.min_post_size and the throughput on the
+  larger ones.
+
+  The whole post is held in memory several times while it is serialized and
+  encrypted, so while the client is over its memory limit posts are limited to
+  Client.min_post_size.
+  """
+
+  # The weight of the latest post in the moving averages.
+  DECAY = 0.3
+
+  def __init__(self):
+    self.adaptive = config_lib.CONFIG["Client.adaptive_post_size"]
+    self.min_size = config_lib.CONFIG["Client.min_post_size"]
+    self.max_size = config_lib.CONFIG["Client.max_post_size"]
+    self.rtt_multiple = config_lib.CONFIG["Client.post_rtt_multiple"]
+    self.http_timeout = config_lib.CONFIG["Client.http_timeout"]
+
+    # The round trip time in seconds and the throughput in bytes per second.
+    self.rtt = None
+    self.throughput = None
+    self.size = self.min_size
+
+  def _Average(self, average, value):
+    if average is None:
+      return value
+    return average + self.DECAY * (value - average)
+
+  def Update(self, num_bytes, duration):
+    """Records a successful post of num_bytes that took duration seconds."""
+    if num_bytes < self.min_size or self.rtt is None:
+      self.rtt = self._Average(self.rtt, duration)
+      return
+
+    upload_time = max(duration - self.rtt, 0.001)
+    self.throughput = self._Average(self.throughput, num_bytes / upload_time)
+
+    upload_time = min(self.rtt * self.rtt_multiple, self.http_timeout / 2.0)
+    self.size = int(
+        min(self.max_size, max(self.min_size, self.throughput * upload_time)))
+    stats.STATS.SetGaugeValue("grr_client_post_size", self.size)
+
+  def MaxSize(self, memory_exceeded=False):
+    """Returns the number of bytes of messages the next post should carry."""
+    if memory_exceeded:
+      return self.min_size
+    if not self.adaptive:
+      return self.max_size
+    return self.size
+
+
 class CommsInit(registry.InitHook):
 
   def RunOnce(self):
@@ -467,6 +637,10 @@ class CommsInit(registry.InitHook):
     stats.STATS.RegisterCounterMetric("grr_client_slave_restarts")
     stats.STATS.RegisterCounterMetric("grr_client_sent_bytes")
     stats.STATS.RegisterCounterMetric("grr_client_sent_messages")
+    stats.STATS.RegisterGaugeMetric("grr_client_post_size", int)
+    stats.STATS.RegisterCounterMetric("grr_client_http_reused_sessions")
+    stats.STATS.RegisterCounterMetric("grr_client_http_sessions")
+    stats.STATS.RegisterCounterMetric("grr_client_http_stale_connections")
 
 
 class Status(object):
@@ -1137,6 +1311,14 @@ class GRRHTTPClient(object):
 
     - A status code of 500 is an error, the messages are re-queued and the
       client waits and retried to send them later.
+
+    - A status code of 503 means that the server is overloaded. The messages
+      are re-queued and the client backs off for as long as the server asks.
+
+  The amount of data sent per POST is chosen by a PostSizer(). When a POST was
+  full and more messages are waiting, the next POST is made right away instead
+  of at the next poll, so large uploads are streamed as a series of bounded
+  POSTs.
   """
 
   http_manager_class = HTTPManager
@@ -1172,6 +1354,12 @@ class GRRHTTPClient(object):
     # This controls our polling frequency.
     self.timer = Timer()
 
+    # This controls how much data we send per post.
+    self.post_sizer = PostSizer()
+
+    # Set when the last post was full and there are more messages to send.
+    self.upload_pending = False
+
     # The time we last sent an enrollment request. Enrollment requests are
     # throttled especially to a maximum of one every 10 minutes.
     self.last_enrollment_time = 0
@@ -1277,18 +1465,22 @@ class GRRHTTPClient(object):
     Returns:
       A Status() object indicating how the last POST went.
     """
+    self.upload_pending = False
+
     # Attempt to fetch and load server certificate.
     if not self._FetchServerCertificate():
       self.timer.Wait()
       return HTTPObject(code=500)
 
+    memory_exceeded = self.client_worker.MemoryExceeded()
+    max_size = self.post_sizer.MaxSize(memory_exceeded=memory_exceeded)
+
     # Here we only drain messages if we were able to connect to the server in
     # the last poll request. Otherwise we just wait until the connection comes
     # back so we don't expire our messages too fast.
     if self.http_manager.consecutive_connection_errors == 0:
       # Grab some messages to send
-      message_list = self.client_worker.Drain(
-          max_size=config_lib.CONFIG["Client.max_post_size"])
+      message_list = self.client_worker.Drain(max_size=max_size)
     else:
       message_list = rdf_flows.MessageList()
 
@@ -1305,7 +1497,7 @@ class GRRHTTPClient(object):
     # is full. This will prevent the server from sending us any messages, and
     # hopefully allow us to work down our memory usage, by processing any
     # outstanding messages.
-    if self.client_worker.MemoryExceeded():
+    if memory_exceeded:
       logging.info("Memory exceeded, will not retrieve jobs.")
       payload.queue_size = 1000000
     else:
@@ -1325,15 +1517,21 @@ class GRRHTTPClient(object):
                    self.communicator.common_name,
                    self.http_manager.active_base_url, response.code)
 
-      # Force the server pem to be reparsed on the next connection.
-      self.server_certificate = None
+      if response.code == 503:
+        # The server is fine but too busy to take our messages right now.
+        self.timer.Backoff(response.retry_after)
+      else:
+        # Force the server pem to be reparsed on the next connection.
+        self.server_certificate = None
 
       # Reschedule the tasks back on the queue so they get retried next time.
       messages = list(message_list.job)
       for message in messages:
         message.priority = rdf_flows.GrrMessage.Priority.HIGH_PRIORITY
         message.require_fastpoll = False
-        message.ttl -= 1
+        # Messages the server turned away were not lost in transmission.
+        if response.code != 503:
+          message.ttl -= 1
         if message.ttl > 0:
           # Schedule with high priority to make it jump the queue.
           self.client_worker.QueueResponse(
@@ -1364,6 +1562,14 @@ class GRRHTTPClient(object):
         self.timer.FastPoll()
         break
 
+    self.post_sizer.Update(len(payload_data), response.duration)
+
+    # If the message list was cut off at max_size there are more messages
+    # waiting, we send them right away instead of at the next poll.
+    sent_size = sum(len(message.Get("args") or "")
+                    for message in message_list.job)
+    self.upload_pending = sent_size >= max_size
+
     # Process all messages. Messages can be processed by clients in
     # any order since clients do not have state.
     self.client_worker.QueueMessages(response.messages)
@@ -1465,7 +1671,9 @@ class GRRHTTPClient(object):
         # And done for now.
         sys.exit(-1)
 
-      self.timer.Wait()
+      # Large uploads go out as a series of back to back posts.
+      if not self.upload_pending:
+        self.timer.Wait()
 
   def InitiateEnrolment(self):
     """Initiate the enrollment process.
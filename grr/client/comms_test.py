@@ -61,7 +61,7 @@ class RequestsInstrumentor(object):
        A context manager that when exits restores the mocks.
     """
     self.actions = []
-    return utils.MultiStubber((requests, "request", self.request),
+    return utils.MultiStubber((requests.Session, "request", self.request),
                               (time, "sleep", self.sleep))
 
 
@@ -91,7 +91,7 @@ class HTTPManagerTest(test_lib.GRRBaseTest):
   """Tests the HTTP Manager."""
 
   def MakeRequest(self, instrumentor, manager, path, verify_cb=lambda x: True):
-    with utils.MultiStubber((requests, "request", instrumentor.request),
+    with utils.MultiStubber((requests.Session, "request", instrumentor.request),
                             (time, "sleep", instrumentor.sleep)):
       return manager.OpenServerEndpoint(path, verify_cb=verify_cb)
 
@@ -233,6 +233,119 @@ class HTTPManagerTest(test_lib.GRRBaseTest):
 
     self.assertEqual(result.data, "Good")
 
+  def testKeepAlive(self):
+    """Connections to the same server through the same proxy are reused."""
+    instrumentor = RequestsInstrumentor()
+    instrumentor.responses = [_make_200("Good") for _ in range(3)]
+    with instrumentor.instrument():
+      manager = MockHTTPManager()
+      manager.OpenServerEndpoint("control")
+      session = manager.sessions.values()[0][0]
+      manager.OpenServerEndpoint("control")
+      manager.OpenURL("http://server1/server.pem")
+
+    self.assertEqual(len(manager.sessions), 1)
+    self.assertIs(manager.sessions.values()[0][0], session)
+
+  def testIdleSessionsAreClosed(self):
+    instrumentor = RequestsInstrumentor()
+    instrumentor.responses = [_make_200("Good"), _make_200("Good")]
+    with instrumentor.instrument():
+      manager = MockHTTPManager()
+      with test_lib.FakeTime(1000):
+        manager.OpenServerEndpoint("control")
+      session = manager.sessions.values()[0][0]
+
+      with test_lib.FakeTime(1000 + manager.keep_alive_idle + 1):
+        manager.OpenServerEndpoint("control")
+
+    self.assertEqual(len(manager.sessions), 1)
+    self.assertIsNot(manager.sessions.values()[0][0], session)
+
+  def testStaleConnectionIsReopenedRightAway(self):
+    """A reused connection the server already closed is not an error."""
+    instrumentor = RequestsInstrumentor()
+    instrumentor.responses = [
+        _make_200("Good"), requests.ConnectionError("Error", response=None),
+        _make_200("Also Good")
+    ]
+    with instrumentor.instrument():
+      manager = MockHTTPManager()
+      manager.OpenServerEndpoint("control")
+      result = manager.OpenServerEndpoint("control")
+
+    self.assertEqual(result.data, "Also Good")
+    self.assertEqual(manager.consecutive_connection_errors, 0)
+
+    # The retry went to the same server through the same proxy without waiting.
+    self.assertEqual([x[0] for x in instrumentor.actions], [0, 0, 0])
+    self.assertEqual(
+        len(set((x[1]["url"], x[1]["proxies"]["http"])
+                for x in instrumentor.actions)), 1)
+
+  def testNoKeepAlive(self):
+    instrumentor = RequestsInstrumentor()
+    instrumentor.responses = [_make_200("Good")]
+    with test_lib.ConfigOverrider({"Client.http_keep_alive": False}):
+      with instrumentor.instrument():
+        manager = MockHTTPManager()
+        result = manager.OpenServerEndpoint("control")
+
+    self.assertEqual(result.data, "Good")
+    self.assertEqual(manager.sessions, {})
+
+
+class PostSizerTest(test_lib.GRRBaseTest):
+  """Tests the PostSizer."""
+
+  def setUp(self):
+    super(PostSizerTest, self).setUp()
+    self.config_overrider = test_lib.ConfigOverrider({
+        "Client.min_post_size": 1000,
+        "Client.max_post_size": 1000000,
+        "Client.post_rtt_multiple": 4,
+        "Client.http_timeout": 100
+    })
+    self.config_overrider.Start()
+
+  def tearDown(self):
+    super(PostSizerTest, self).tearDown()
+    self.config_overrider.Stop()
+
+  def testPostsStartSmall(self):
+    sizer = comms.PostSizer()
+    self.assertEqual(sizer.MaxSize(), 1000)
+
+  def testPostsGrowWithRoundTripTime(self):
+    sizers = []
+    for rtt in [0.25, 0.5]:
+      sizer = comms.PostSizer()
+      # Idle polls measure the round trip time.
+      sizer.Update(100, rtt)
+      # Uploads at 40kB/s.
+      sizer.Update(10000, rtt + 0.25)
+      sizers.append(sizer)
+
+    self.assertEqual(sizers[0].MaxSize(), 40000)
+    self.assertEqual(sizers[1].MaxSize(), 80000)
+
+  def testPostSizeIsBounded(self):
+    sizer = comms.PostSizer()
+    sizer.Update(100, 0.5)
+    # A fast link could upload more than max_post_size within 4 round trips.
+    sizer.Update(500000, 0.75)
+    self.assertEqual(sizer.MaxSize(), 1000000)
+
+    # Posts are small while the client is over its memory limit.
+    self.assertEqual(sizer.MaxSize(memory_exceeded=True), 1000)
+
+  def testNonAdaptivePostSize(self):
+    with test_lib.ConfigOverrider({"Client.adaptive_post_size": False}):
+      sizer = comms.PostSizer()
+
+    self.assertEqual(sizer.MaxSize(), 1000000)
+    self.assertEqual(sizer.MaxSize(memory_exceeded=True), 1000)
+
 
 def main(argv):
   test_lib.main(argv)
@@ -1,8 +1,17 @@
 #!/usr/bin/env python
-"""This is the GRR client for thread pools."""
+"""This is the GRR client for thread pools.
 
+The pool client doubles as a load generator for the frontend. Run it against a
+test frontend (e.g. one backed by the fake or sqlite data store) with
+--duration, optionally with --poll_interval, --payload_count and --ramp_up, and
+it logs a report of poll latencies, error rates and message throughput.
+"""
 
+
+import bisect
+import collections
 import pickle
+import Queue
 import threading
 import time
 
@@ -18,8 +27,11 @@ from grr.client import comms
 from grr.client import vfs
 from grr.lib import config_lib
 from grr.lib import flags
+from grr.lib import rdfvalue
 from grr.lib import startup
+from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import crypto as rdf_crypto
+from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import paths as rdf_paths
 
 flags.DEFINE_integer("nrclients", 1, "Number of clients to start")
@@ -31,27 +43,194 @@ flags.DEFINE_string("cert_file", "",
 flags.DEFINE_bool("enroll_only", False,
                   "If specified, the script will enroll all clients and exit.")
 
+flags.DEFINE_float("duration", 0,
+                   "Stop the pool after this many seconds and log a load "
+                   "report. If 0, the pool runs until interrupted.")
+
+flags.DEFINE_float("ramp_up", 0,
+                   "Start the clients evenly spread over this many seconds.")
+
+flags.DEFINE_float("poll_interval", 0,
+                   "If set, every client polls this many seconds apart instead "
+                   "of following the client poll timer.")
+
+flags.DEFINE_integer("payload_count", 0,
+                     "The number of StatEntry responses every client sends "
+                     "with each poll.")
+
+flags.DEFINE_integer("payload_size", 100,
+                     "The approximate size in bytes of each StatEntry "
+                     "response.")
+
+
+class LoadReport(object):
+  """Collects the poll results of the pool clients and summarizes them."""
+
+  # Upper bounds of the latency histogram bins, in seconds.
+  LATENCY_BINS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.start_time = time.time()
+    # Latencies of the successful polls.
+    self.latencies = []
+    self.status_codes = collections.Counter()
+    self.messages_sent = 0
+    self.messages_received = 0
+
+  def AddPoll(self, latency, code, messages_sent=0, messages_received=0):
+    """Records a poll.
+
+    Args:
+      latency: The number of seconds the poll took.
+      code: The HTTP status of the poll.
+      messages_sent: The number of messages the client sent with the poll.
+      messages_received: The number of messages the server sent back.
+    """
+    with self.lock:
+      self.status_codes[code] += 1
+      if code == 200:
+        self.latencies.append(latency)
+        self.messages_sent += messages_sent
+        self.messages_received += messages_received
+
+  def Percentile(self, percentile):
+    """Returns the latency percentile of the successful polls."""
+    with self.lock:
+      latencies = sorted(self.latencies)
+    if not latencies:
+      return 0
+    index = int(round(percentile / 100.0 * (len(latencies) - 1)))
+    return latencies[index]
+
+  def Histogram(self):
+    """Returns (upper bound, count) pairs of the poll latencies."""
+    counts = [0] * (len(self.LATENCY_BINS) + 1)
+    with self.lock:
+      for latency in self.latencies:
+        counts[bisect.bisect_left(self.LATENCY_BINS, latency)] += 1
+    return zip(self.LATENCY_BINS + [float("inf")], counts)
+
+  def Format(self):
+    """Returns the report as a string."""
+    elapsed = max(time.time() - self.start_time, 1e-6)
+    polls = sum(self.status_codes.values())
+    lines = [
+        "Polls: %d in %.1f seconds (%.1f/s)" % (polls, elapsed,
+                                                polls / elapsed),
+        "Messages sent: %d (%.1f/s), received: %d (%.1f/s)" %
+        (self.messages_sent, self.messages_sent / elapsed,
+         self.messages_received, self.messages_received / elapsed)
+    ]
+
+    for code, count in sorted(self.status_codes.items()):
+      lines.append("  Status %s: %d (%.1f%%)" % (code, count,
+                                                  100.0 * count / polls))
+
+    lines.append("Latency of successful polls (seconds): p50 %.3f, p90 %.3f, "
+                 "p99 %.3f, max %.3f" %
+                 (self.Percentile(50), self.Percentile(90),
+                  self.Percentile(99), self.Percentile(100)))
+    for upper_bound, count in self.Histogram():
+      lines.append("  <= %-6s %d" % (upper_bound, count))
+
+    return "\n".join(lines)
+
+
+class PoolClientWorker(comms.GRRThreadedWorker):
+  """A client worker that counts the messages drained for each poll."""
+
+  last_drain_count = 0
+
+  def Drain(self, max_size=1024):
+    message_list = super(PoolClientWorker, self).Drain(max_size=max_size)
+    self.last_drain_count = len(message_list)
+    return message_list
+
 
 class PoolGRRClient(threading.Thread):
   """A GRR client for running in pool mode."""
 
-  def __init__(self, ca_cert=None, private_key=None):
-    """Constructor."""
+  def __init__(self,
+               ca_cert=None,
+               private_key=None,
+               report=None,
+               start_delay=0,
+               poll_interval=0,
+               payload_count=0,
+               payload_size=0):
+    """Constructor.
+
+    Args:
+      ca_cert: String representation of a CA certificate to use for checking
+          server certificate.
+      private_key: The private key for this client.
+      report: An optional LoadReport to record the polls in.
+      start_delay: The number of seconds to wait before the first poll.
+      poll_interval: If set, poll this many seconds apart instead of following
+          the client poll timer.
+      payload_count: The number of StatEntry responses to send with each poll.
+      payload_size: The approximate size in bytes of each StatEntry.
+    """
     super(PoolGRRClient, self).__init__()
     self.private_key = private_key
     self.daemon = True
 
-    self.client = comms.GRRHTTPClient(ca_cert=ca_cert, private_key=private_key)
+    self.client = comms.GRRHTTPClient(
+        ca_cert=ca_cert, private_key=private_key, worker=PoolClientWorker())
     self.stop = False
     # Is this client already enrolled?
     self.enrolled = False
 
+    self.report = report
+    self.start_delay = start_delay
+    self.poll_interval = poll_interval
+    self.payload_count = payload_count
+    self.payload = rdf_client.StatEntry(
+        st_mode=0100644,
+        st_size=payload_size,
+        st_mtime=int(time.time()),
+        symlink="x" * payload_size)
+
+  def SendPayload(self):
+    """Queues the synthetic responses for the next poll."""
+    for _ in xrange(self.payload_count):
+      try:
+        self.client.client_worker.SendReply(
+            self.payload,
+            session_id=rdfvalue.FlowSessionID(flow_name="IgnoreResponses"),
+            priority=rdf_flows.GrrMessage.Priority.LOW_PRIORITY,
+            require_fastpoll=False,
+            blocking=False)
+      except Queue.Full:
+        # The server does not keep up, there is no point in queueing more.
+        return
+
   def Run(self):
+    time.sleep(self.start_delay)
     while not self.stop:
+      self.SendPayload()
+
+      self.client.client_worker.last_drain_count = 0
+      start = time.time()
       status = self.client.RunOnce()
+      latency = time.time() - start
+
       if status.code == 200:
         self.enrolled = True
-      self.client.timer.Wait()
+      if self.report:
+        self.report.AddPoll(
+            latency,
+            status.code,
+            messages_sent=self.client.client_worker.last_drain_count,
+            messages_received=len(status.messages or []))
+
+      if self.client.upload_pending:
+        continue
+      if self.poll_interval:
+        time.sleep(max(0, self.poll_interval - latency))
+      else:
+        self.client.timer.Wait()
 
   def Stop(self):
     self.stop = True
@@ -63,6 +242,12 @@ class PoolGRRClient(threading.Thread):
 def CreateClientPool(n):
   """Create n clients to run in a pool."""
   clients = []
+  report = LoadReport()
+  client_args = dict(
+      report=report,
+      poll_interval=flags.FLAGS.poll_interval,
+      payload_count=flags.FLAGS.payload_count,
+      payload_size=flags.FLAGS.payload_size)
 
   # Load previously stored clients.
   try:
@@ -74,7 +259,8 @@ def CreateClientPool(n):
       clients.append(
           PoolGRRClient(
               private_key=certificate,
-              ca_cert=config_lib.CONFIG["CA.certificate"]))
+              ca_cert=config_lib.CONFIG["CA.certificate"],
+              **client_args))
 
     clients_loaded = True
   except (IOError, EOFError):
@@ -90,10 +276,13 @@ def CreateClientPool(n):
     key = rdf_crypto.RSAPrivateKey.GenerateKey(bits=bits)
     clients.append(
         PoolGRRClient(
-            private_key=key, ca_cert=config_lib.CONFIG["CA.certificate"]))
+            private_key=key,
+            ca_cert=config_lib.CONFIG["CA.certificate"],
+            **client_args))
 
-  # Start all the clients now.
-  for c in clients:
+  # Start all the clients now, their first polls spread over the ramp up time.
+  for i, c in enumerate(clients):
+    c.start_delay = flags.FLAGS.ramp_up * i / len(clients)
     c.start()
 
   start_time = time.time()
@@ -113,7 +302,15 @@ def CreateClientPool(n):
     else:
       try:
         while True:
-          time.sleep(100)
+          wait = 10
+          if flags.FLAGS.duration:
+            wait = min(wait, start_time + flags.FLAGS.duration - time.time())
+            if wait <= 0:
+              break
+
+          time.sleep(wait)
+          logging.info("%s: %s", int(time.time()),
+                       report.Format().splitlines()[0])
       except KeyboardInterrupt:
         pass
 
@@ -125,6 +322,7 @@ def CreateClientPool(n):
   # Note: code below is going to be executed after SIGTERM is sent to this
   # process.
   logging.info("Pool done in %s seconds.", time.time() - start_time)
+  logging.info("Load report:\n%s", report.Format())
 
   # The way benchmarking is supposed to work is that we execute poolclient with
   # --enroll_only flag, it dumps the certificates to the flags.FLAGS.cert_file.
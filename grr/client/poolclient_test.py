@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Tests for the pool client load report."""
+
+
+from grr.client import poolclient
+from grr.lib import flags
+from grr.lib import test_lib
+
+
+class LoadReportTest(test_lib.GRRBaseTest):
+  """Tests the LoadReport."""
+
+  def setUp(self):
+    super(LoadReportTest, self).setUp()
+    self.report = poolclient.LoadReport()
+    for i in range(101):
+      self.report.AddPoll(
+          i / 100.0, 200, messages_sent=2, messages_received=1)
+    self.report.AddPoll(30, 500, messages_sent=2)
+    self.report.AddPoll(0.1, 503)
+
+  def testOnlySuccessfulPollsAreCounted(self):
+    self.assertEqual(len(self.report.latencies), 101)
+    self.assertEqual(self.report.messages_sent, 202)
+    self.assertEqual(self.report.messages_received, 101)
+    self.assertEqual(dict(self.report.status_codes), {200: 101, 500: 1, 503: 1})
+
+  def testPercentiles(self):
+    self.assertEqual(self.report.Percentile(50), 0.5)
+    self.assertEqual(self.report.Percentile(90), 0.9)
+    self.assertEqual(self.report.Percentile(100), 1.0)
+    self.assertEqual(poolclient.LoadReport().Percentile(50), 0)
+
+  def testHistogram(self):
+    histogram = dict(self.report.Histogram())
+    self.assertEqual(histogram[0.01], 2)
+    self.assertEqual(histogram[0.025], 1)
+    self.assertEqual(histogram[1], 50)
+    self.assertEqual(histogram[float("inf")], 0)
+    self.assertEqual(sum(histogram.values()), 101)
+
+  def testFormat(self):
+    report = self.report.Format()
+    self.assertIn("Polls: 103 in", report)
+    self.assertIn("Status 503: 1", report)
+    self.assertIn("p50 0.500", report)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -11,5 +11,6 @@ from grr.client import client_test
 from grr.client import client_utils_test
 from grr.client import client_vfs_test
 from grr.client import comms_test
+from grr.client import poolclient_test
 from grr.client.client_actions import tests
 from grr.client.osx import objc_test
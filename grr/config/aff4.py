@@ -10,6 +10,32 @@ config_lib.DEFINE_integer(
 config_lib.DEFINE_integer("AFF4.cache_max_size", 10000,
                           "Maximum size of the AFF4 objects cache.")
 
+config_lib.DEFINE_choice(
+    "AFF4.cache_type", "AgeBasedCache",
+    ["AgeBasedCache", "ShardedAgeBasedCache"],
+    "The cache implementation used for the AFF4 objects cache. The "
+    "ShardedAgeBasedCache is limited by AFF4.cache_max_bytes instead of "
+    "AFF4.cache_max_size.")
+
+config_lib.DEFINE_integer(
+    "AFF4.cache_max_bytes", 100 * 1024 * 1024,
+    "Maximum total size of the attributes held in the sharded AFF4 objects "
+    "cache.")
+
+config_lib.DEFINE_integer(
+    "AFF4.cache_shards", 16,
+    "Number of independently locked shards of the sharded AFF4 objects cache.")
+
+config_lib.DEFINE_integer(
+    "AFF4.multi_stream_prefetch_workers", 4,
+    "Number of chunk groups that AFF4 image MultiStream fetches from the data "
+    "store in parallel, ahead of the consumer. 0 disables prefetching.")
+
+config_lib.DEFINE_integer(
+    "AFF4.multi_stream_max_chunks_in_flight", 4000,
+    "Maximum number of chunks that AFF4 image MultiStream holds in memory "
+    "while prefetching, including the chunks being processed.")
+
 config_lib.DEFINE_integer(
     "AFF4.intermediate_cache_age", 600,
     "The number of seconds AFF4 urns live in index cache.")
@@ -79,6 +79,16 @@ config_lib.DEFINE_list("Client.control_urls", [],
 config_lib.DEFINE_integer("Client.http_timeout", 100,
                           "Timeout for HTTP requests.")
 
+config_lib.DEFINE_bool("Client.http_keep_alive", True,
+                       "Keep connections to the server open between polls "
+                       "instead of reconnecting for every request.")
+
+config_lib.DEFINE_integer("Client.http_keep_alive_idle", 50,
+                          "Connections idle for longer than this many seconds "
+                          "are closed and reopened. This should be below "
+                          "Frontend.keepalive_timeout so we never reuse a "
+                          "connection the server is about to close.")
+
 config_lib.DEFINE_string("Client.plist_path",
                          "/Library/LaunchDaemons/com.google.code.grrd.plist",
                          "Location of our launchctl plist.")
@@ -122,6 +132,22 @@ config_lib.DEFINE_list(
 config_lib.DEFINE_integer("Client.max_post_size", 40000000,
                           "Maximum size of the post.")
 
+config_lib.DEFINE_bool("Client.adaptive_post_size", True,
+                       "If set, the size of each post is chosen from the "
+                       "measured round trip time and upload throughput, "
+                       "between Client.min_post_size and "
+                       "Client.max_post_size. Otherwise every post may be up "
+                       "to Client.max_post_size.")
+
+config_lib.DEFINE_integer("Client.min_post_size", 1000000,
+                          "Posts are allowed to be at least this large. Posts "
+                          "are limited to this size while the client is over "
+                          "its memory limit.")
+
+config_lib.DEFINE_float("Client.post_rtt_multiple", 8,
+                        "Adaptive posts are sized so that uploading them takes "
+                        "this many times the round trip time to the server.")
+
 config_lib.DEFINE_integer("Client.max_out_queue", 51200000,
                           "Maximum size of the output queue.")
 
@@ -272,7 +298,9 @@ config_lib.DEFINE_integer("Network.api", 3,
 config_lib.DEFINE_string(
     "Network.compression",
     default="ZCOMPRESS",
-    help="Type of compression (ZCOMPRESS, UNCOMPRESSED)")
+    help="Type of compression (ZCOMPRESS, ZCOMPRESS_FAST, ZCOMPRESS_DICT, "
+    "LZ4, UNCOMPRESSED). Codecs other than ZCOMPRESS and UNCOMPRESSED are only "
+    "used once the other end has announced that it supports them.")
 
 # Installer options.
 config_lib.DEFINE_string(
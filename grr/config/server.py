@@ -55,6 +55,17 @@ config_lib.DEFINE_integer("Worker.queue_shards", 5,
                           "Queue notifications will be sharded across "
                           "this number of datastore subjects.")
 
+config_lib.DEFINE_string(
+    "Worker.notification_bus", "LocalNotificationBus",
+    "The notification bus idle workers wait on for new notifications. "
+    "LocalNotificationBus wakes up workers in the process that queued the "
+    "notifications, PollingNotificationBus only polls.")
+
+config_lib.DEFINE_float(
+    "Worker.notification_shard_max_backoff", 2,
+    "Queue notification shards that were found empty are polled less often, "
+    "at most this many seconds apart. 0 disables the backoff.")
+
 config_lib.DEFINE_integer("Worker.notification_expiry_time", 600,
                           "The queue manager expires stale notifications "
                           "after this many seconds.")
@@ -158,6 +169,84 @@ config_lib.DEFINE_integer("Frontend.message_expiry_time", 600,
                           "Maximum time messages remain valid within the "
                           "system.")
 
+config_lib.DEFINE_float("Frontend.ingestion_batch_window", 0.005,
+                        "Messages received from clients within this many "
+                        "seconds are written to the data store together. Set "
+                        "to 0 to write the messages of each poll separately.")
+
+config_lib.DEFINE_integer("Frontend.ingestion_max_batch_size", 100,
+                          "The maximum number of client polls whose messages "
+                          "are written together.")
+
+config_lib.DEFINE_integer("Frontend.liveness_flush_interval", 10,
+                          "Client ip, clock and ping times are written to the "
+                          "data store in bulk every this many seconds. Set to "
+                          "0 to write them on every poll.")
+
+config_lib.DEFINE_integer("Frontend.admission_max_inflight_messages", 20000,
+                          "Client polls are turned away while the frontend is "
+                          "receiving this many messages.")
+
+config_lib.DEFINE_float("Frontend.admission_target_latency", 10.0,
+                        "Client polls are turned away while the data store "
+                        "work of a poll takes this many seconds on average.")
+
+config_lib.DEFINE_float("Frontend.admission_ping_load_limit", 0.8,
+                        "Polls without responses to flow requests are turned "
+                        "away at this fraction of the load other polls are "
+                        "turned away at.")
+
+config_lib.DEFINE_integer("Frontend.admission_min_backoff", 30,
+                          "The least number of seconds clients turned away by "
+                          "admission control are asked to wait.")
+
+config_lib.DEFINE_integer("Frontend.admission_max_backoff", 600,
+                          "The most number of seconds clients turned away by "
+                          "admission control are asked to wait.")
+
+config_lib.DEFINE_integer("Frontend.cipher_cache_size", 50000,
+                          "The number of verified client session ciphers the "
+                          "frontend keeps so that repeat packets of a session "
+                          "only need an HMAC check instead of RSA operations.")
+
+config_lib.DEFINE_integer("Frontend.cipher_cache_ttl", 3600,
+                          "Cached client session ciphers are dropped after "
+                          "being unused for this many seconds.")
+
+config_lib.DEFINE_choice("Frontend.client_queue_mode", "lease",
+                         ["lease", "log"],
+                         "How the frontend takes tasks off client queues. "
+                         "'lease' leases them in a data store transaction, "
+                         "'log' reads them without a transaction and appends "
+                         "a delivery record to the queue instead.")
+
+config_lib.DEFINE_choice("Frontend.server_type", "threaded",
+                         ["async", "threaded"],
+                         "The frontend http server implementation. The "
+                         "threaded server uses a thread per connection, the "
+                         "async server handles all connections in one event "
+                         "loop and hands data store work to a bounded thread "
+                         "pool. Set this to 'async' to opt in to the async "
+                         "server.")
+
+config_lib.DEFINE_integer("Frontend.max_connections", 10000,
+                          "The async server stops accepting new connections "
+                          "while this many are open.")
+
+config_lib.DEFINE_integer("Frontend.keepalive_timeout", 60,
+                          "Idle client connections are closed by the async "
+                          "server after this many seconds.")
+
+config_lib.DEFINE_integer("Frontend.executor_min_threads", 10,
+                          "The number of threads the async server starts "
+                          "with for processing client requests.")
+
+config_lib.DEFINE_integer("Frontend.executor_max_threads", 50,
+                          "The maximum number of threads processing client "
+                          "requests in the async server. Requests arriving "
+                          "while they are all busy are rejected with a 500 so "
+                          "that the clients back off.")
+
 config_lib.DEFINE_string("Server.initialized", False,
                          "True once config_updater initialize has been "
                          "run at least once.")
@@ -237,6 +326,15 @@ config_lib.DEFINE_integer(
     help="Time in seconds between the dumps of stats "
     "data into the stats store.")
 
+config_lib.DEFINE_choice(
+    "StatsStore.storage_format", "attributes",
+    ["attributes", "columnar", "dual"],
+    "How stats values are stored. 'attributes' stores every value as a "
+    "separate attribute version, 'columnar' stores an hour of values of a "
+    "metric as packed arrays in a single attribute version. 'dual' writes "
+    "both formats and reads the attributes one: use it for StatsStore.ttl "
+    "seconds before switching from 'attributes' to 'columnar'.")
+
 config_lib.DEFINE_integer(
     "StatsStore.ttl",
     default=60 * 60 * 24 * 3,
@@ -6,8 +6,10 @@ This contains an AFF4 data model implementation.
 
 import __builtin__
 import abc
+import collections
 import itertools
 import StringIO
+import threading
 import time
 import zlib
 
@@ -22,6 +24,7 @@ from grr.lib import lexer
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
+from grr.lib import threadpool
 from grr.lib import type_info
 from grr.lib import utils
 from grr.lib.rdfvalues import aff4_rdfvalues
@@ -281,9 +284,7 @@ class Factory(object):
   def __init__(self):
     if not flags.FLAGS.disable_aff4_cache:
       # This is a relatively short lived cache of objects.
-      self.cache = utils.AgeBasedCache(
-          max_size=config_lib.CONFIG["AFF4.cache_max_size"],
-          max_age=config_lib.CONFIG["AFF4.cache_age"])
+      self.cache = self._MakeCache()
     self.intermediate_cache = utils.AgeBasedCache(
         max_size=config_lib.CONFIG["AFF4.intermediate_cache_max_size"],
         max_age=config_lib.CONFIG["AFF4.intermediate_cache_age"])
@@ -297,6 +298,49 @@ class Factory(object):
     self.notification_rules = []
     self.notification_rules_timestamp = 0
 
+  def _MakeCache(self):
+    """Creates the AFF4 objects cache selected in the config."""
+    cache_type = config_lib.CONFIG["AFF4.cache_type"]
+    if cache_type == "ShardedAgeBasedCache":
+      return utils.ShardedAgeBasedCache(
+          max_bytes=config_lib.CONFIG["AFF4.cache_max_bytes"],
+          max_age=config_lib.CONFIG["AFF4.cache_age"],
+          shards=config_lib.CONFIG["AFF4.cache_shards"],
+          size_fn=self._CachedAttributesSize,
+          shard_fn=self._CacheKeySubject)
+
+    return utils.AgeBasedCache(
+        max_size=config_lib.CONFIG["AFF4.cache_max_size"],
+        max_age=config_lib.CONFIG["AFF4.cache_age"])
+
+  @staticmethod
+  def _CachedAttributesSize(values):
+    """Estimates the memory used by a cached list of attribute values."""
+    size = 0
+    for attribute, value, _ in values:
+      size += len(attribute) + 8
+      if isinstance(value, basestring):
+        size += len(value)
+      else:
+        size += 8
+    return size
+
+  @staticmethod
+  def _CacheKeySubject(key):
+    """Extracts the subject from a key built by _MakeCacheInvariant."""
+    length, rest = key.split(":", 1)
+    return rest[:int(length)]
+
+  def CacheStats(self):
+    """Returns a dict with statistics about the AFF4 objects cache."""
+    if flags.FLAGS.disable_aff4_cache:
+      return {}
+
+    return dict(
+        entries=len(self.cache),
+        bytes=getattr(self.cache, "total_bytes", 0),
+        evictions=getattr(self.cache, "evictions", 0))
+
   @classmethod
   def ParseAgeSpecification(cls, age):
     """Parses an aff4 age and returns a datastore age specification."""
@@ -372,7 +416,7 @@ class Factory(object):
       try:
         # Expire all entries in the cache for this urn (for all tokens, and
         # timestamps)
-        self.cache.ExpirePrefix(utils.SmartStr(urn) + ":")
+        self.cache.ExpirePrefix(self._MakeCachePrefix(urn))
       except KeyError:
         pass
 
@@ -494,8 +538,15 @@ class Factory(object):
     Returns:
        A key into the cache.
     """
-    return "%s:%s:%s" % (utils.SmartStr(urn), utils.SmartStr(token),
-                         self.ParseAgeSpecification(age))
+    return "%s%s:%s" % (self._MakeCachePrefix(urn), utils.SmartStr(token),
+                        self.ParseAgeSpecification(age))
+
+  def _MakeCachePrefix(self, urn):
+    """Returns the prefix shared by all the cache keys of an urn."""
+    # The length allows us to recover the urn from the key and makes sure a
+    # prefix can't match the keys of a longer urn.
+    urn = utils.SmartStr(urn)
+    return "%d:%s:" % (len(urn), urn)
 
   def CreateWithLock(self,
                      urn,
@@ -2779,6 +2830,32 @@ class AFF4UnversionedMemoryStream(AFF4MemoryStreamBase):
         versioned=False)
 
 
+class _Prefetch(object):
+  """A group of chunks fetched in the background by the prefetch pool."""
+
+  def __init__(self, fetch_fn, group):
+    self.fetch_fn = fetch_fn
+    self.group = group
+    self.result = None
+    self.exception = None
+    self.done = threading.Event()
+
+  def Run(self):
+    try:
+      self.result = self.fetch_fn(self.group)
+    except Exception as e:  # pylint: disable=broad-except
+      self.exception = e
+    finally:
+      self.done.set()
+
+  def Result(self):
+    """Waits for the fetch to finish and returns its result."""
+    self.done.wait()
+    if self.exception is not None:
+      raise self.exception  # pylint: disable=raising-bad-type
+    return self.result
+
+
 class ChunkCache(utils.FastStore):
   """A cache which closes its objects when they expire."""
 
@@ -2843,6 +2920,87 @@ class AFF4ImageBase(AFF4Stream):
 
   MULTI_STREAM_CHUNKS_READ_AHEAD = 1000
 
+  # The pool of threads that prefetch chunk groups, shared by all MultiStream
+  # calls.
+  prefetch_pool = None
+  prefetch_pool_lock = threading.Lock()
+
+  @classmethod
+  def _GetPrefetchPool(cls, workers):
+    with cls.prefetch_pool_lock:
+      if AFF4ImageBase.prefetch_pool is None:
+        AFF4ImageBase.prefetch_pool = threadpool.ThreadPool.Factory(
+            "MultiStreamPrefetch", min_threads=workers, max_threads=workers)
+        AFF4ImageBase.prefetch_pool.Start()
+
+      return AFF4ImageBase.prefetch_pool
+
+  @classmethod
+  def _PrefetchChunkGroups(cls, chunk_fd_pairs, fetch_fn):
+    """Fetches groups of chunks ahead of the consumer.
+
+    Chunks are grouped by MULTI_STREAM_CHUNKS_READ_AHEAD and every group is
+    fetched with fetch_fn on a shared pool of
+    AFF4.multi_stream_prefetch_workers threads, so that the data store round
+    trips for the next groups overlap with the processing of the current one.
+    The groups being fetched and the group being consumed together hold at
+    most AFF4.multi_stream_max_chunks_in_flight chunks.
+
+    Args:
+      chunk_fd_pairs: An iterable of (chunk_id, fd) tuples.
+      fetch_fn: A callable that takes a list of (chunk_id, fd) tuples and
+        returns a dictionary mapping chunk ids to their contents.
+
+    Yields:
+      Tuples (chunk_fd_pairs, contents_map) in the order of the input.
+    """
+    groups = utils.Grouper(chunk_fd_pairs, cls.MULTI_STREAM_CHUNKS_READ_AHEAD)
+
+    workers = config_lib.CONFIG["AFF4.multi_stream_prefetch_workers"]
+    max_groups = (config_lib.CONFIG["AFF4.multi_stream_max_chunks_in_flight"] /
+                  cls.MULTI_STREAM_CHUNKS_READ_AHEAD)
+    # The consumer still holds the previous group while we fetch more.
+    max_in_flight = min(workers, max_groups - 1)
+    if max_in_flight <= 0:
+      for group in groups:
+        yield group, fetch_fn(group)
+      return
+
+    pool = cls._GetPrefetchPool(workers)
+    in_flight = collections.deque()
+    while True:
+      while len(in_flight) < max_in_flight:
+        group = next(groups, None)
+        if group is None:
+          break
+        prefetch = _Prefetch(fetch_fn, group)
+        pool.AddTask(
+            prefetch.Run, (),
+            name="MultiStreamPrefetch",
+            blocking=True,
+            inline=False)
+        in_flight.append(prefetch)
+
+      if not in_flight:
+        break
+
+      prefetch = in_flight.popleft()
+      group, result = prefetch.group, prefetch.Result()
+      prefetch = None
+      yield group, result
+      group = result = None
+
+  @classmethod
+  def _FetchMultiStreamChunks(cls, chunk_fd_pairs, token=None):
+    """Reads the contents of the given chunk streams."""
+    chunks_map = dict(chunk_fd_pairs)
+    contents_map = {}
+    for chunk_fd in FACTORY.MultiOpen(chunks_map, mode="r", token=token):
+      if isinstance(chunk_fd, AFF4Stream):
+        contents_map[chunk_fd.urn] = chunk_fd.read()
+
+    return contents_map
+
   @classmethod
   def _MultiStream(cls, fds):
     """Effectively streams data from multiple opened AFF4ImageBase objects.
@@ -2860,17 +3018,12 @@ class AFF4ImageBase(AFF4Stream):
       it's still possible to yield a truncated file.
     """
 
-    missing_chunks_by_fd = {}
-    for chunk_fd_pairs in utils.Grouper(
-        cls._GenerateChunkPaths(fds), cls.MULTI_STREAM_CHUNKS_READ_AHEAD):
+    token = fds[0].token
+    fetch_fn = lambda pairs: cls._FetchMultiStreamChunks(pairs, token=token)
 
-      chunks_map = dict(chunk_fd_pairs)
-      contents_map = {}
-      for chunk_fd in FACTORY.MultiOpen(
-          chunks_map, mode="r", token=fds[0].token):
-        if isinstance(chunk_fd, AFF4Stream):
-          fd = chunks_map[chunk_fd.urn]
-          contents_map[chunk_fd.urn] = chunk_fd.read()
+    missing_chunks_by_fd = {}
+    for chunk_fd_pairs, contents_map in cls._PrefetchChunkGroups(
+        cls._GenerateChunkPaths(fds), fetch_fn):
 
       for chunk_urn, fd in chunk_fd_pairs:
         if chunk_urn not in contents_map or not contents_map[chunk_urn]:
@@ -3146,6 +3299,17 @@ class AFF4InitHook(registry.InitHook):
     # pylint: enable=unused-variable,global-statement,g-import-not-at-top
     stats.STATS.RegisterCounterMetric("aff4_cache_hits")
     stats.STATS.RegisterCounterMetric("aff4_cache_misses")
+    stats.STATS.RegisterGaugeMetric("aff4_cache_entries", int)
+    stats.STATS.SetGaugeCallback("aff4_cache_entries",
+                                 lambda: FACTORY.CacheStats().get("entries", 0))
+    stats.STATS.RegisterGaugeMetric(
+        "aff4_cache_bytes", int, units=stats.MetricUnits.BYTES)
+    stats.STATS.SetGaugeCallback("aff4_cache_bytes",
+                                 lambda: FACTORY.CacheStats().get("bytes", 0))
+    stats.STATS.RegisterGaugeMetric("aff4_cache_evictions", int)
+    stats.STATS.SetGaugeCallback(
+        "aff4_cache_evictions",
+        lambda: FACTORY.CacheStats().get("evictions", 0))
 
 
 class AFF4Filter(object):
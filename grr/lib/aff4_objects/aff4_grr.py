@@ -483,6 +483,9 @@ class GRRForeman(aff4.AFF4Object):
         creates_new_object_version=False,
         default=rdf_foreman.ForemanRules())
 
+  # The compiled ForemanRuleIndex for the current RULES.
+  rule_index = None
+
   def ExpireRules(self):
     """Removes any rules with an expiration date in the past."""
     rules = self.Get(self.Schema.RULES)
@@ -509,25 +512,46 @@ class GRRForeman(aff4.AFF4Object):
       self.Set(self.Schema.RULES, new_rules)
       self.Flush()
 
-  def _CheckIfHuntTaskWasAssigned(self, client_id, hunt_id):
-    """Will return True if hunt's task was assigned to this client before."""
-    for _ in aff4.FACTORY.Stat(
-        [client_id.Add("flows/%s:hunt" % rdfvalue.RDFURN(hunt_id).Basename())],
-        token=self.token):
-      return True
+  def _GetRuleIndex(self, rules):
+    """Returns the compiled index of rules, rebuilding it if they changed."""
+    # Get() keeps returning the same rules object until RULES is set again.
+    if self.rule_index is None or self.rule_index.rules is not rules:
+      self.rule_index = rdf_foreman.ForemanRuleIndex(rules)
+
+    return self.rule_index
+
+  def _HuntTaskUrn(self, client_id, hunt_id):
+    return client_id.Add("flows/%s:hunt" % rdfvalue.RDFURN(hunt_id).Basename())
 
-    return False
+  def _GetAssignedHuntTasks(self, client_rules):
+    """Finds hunts that were started on the clients before.
+
+    Args:
+      client_rules: A list of (client_id, rule) pairs.
+
+    Returns:
+      A set of hunt task urns, as strings, that exist already.
+    """
+    urns = set()
+    for client_id, rule in client_rules:
+      for action in rule.actions:
+        if action.HasField("hunt_id"):
+          urns.add(self._HuntTaskUrn(client_id, action.hunt_id))
 
-  def _EvaluateRules(self, objects, rule, client_id):
-    """Evaluates the rules."""
-    return rule.client_rule_set.Evaluate(objects, client_id)
+    if not urns:
+      return set()
 
-  def _RunActions(self, rule, client_id):
+    return set(
+        str(stat["urn"]) for stat in aff4.FACTORY.Stat(urns, token=self.token))
+
+  def _RunActions(self, rule, client_id, assigned_hunt_tasks):
     """Run all the actions specified in the rule.
 
     Args:
       rule: Rule which actions are to be executed.
       client_id: Id of a client where rule's actions are to be executed.
+      assigned_hunt_tasks: A set of hunt task urns of hunts that were started
+          before. Hunts started here are added to it.
 
     Returns:
       Number of actions started.
@@ -541,7 +565,8 @@ class GRRForeman(aff4.AFF4Object):
         token.username = "Foreman"
 
         if action.HasField("hunt_id"):
-          if self._CheckIfHuntTaskWasAssigned(client_id, action.hunt_id):
+          hunt_task_urn = str(self._HuntTaskUrn(client_id, action.hunt_id))
+          if hunt_task_urn in assigned_hunt_tasks:
             logging.info("Foreman: ignoring hunt %s on client %s: was started "
                          "here before", client_id, action.hunt_id)
           else:
@@ -550,6 +575,7 @@ class GRRForeman(aff4.AFF4Object):
 
             flow_cls = flow.GRRFlow.classes[action.hunt_name]
             flow_cls.StartClients(action.hunt_id, [client_id])
+            assigned_hunt_tasks.add(hunt_task_urn)
             actions_count += 1
         else:
           flow.GRRFlow.StartFlow(
@@ -575,59 +601,86 @@ class GRRForeman(aff4.AFF4Object):
     Returns:
       Number of assigned tasks.
     """
-    client_id = rdf_client.ClientURN(client_id)
+    return self.AssignTasksToClients([client_id])
 
-    rules = self.Get(self.Schema.RULES)
-    if not rules:
-      return 0
+  def AssignTasksToClients(self, client_ids):
+    """Examines our rules and starts up flows based on the clients.
 
-    client = aff4.FACTORY.Open(client_id, mode="rw", token=self.token)
-    try:
-      last_foreman_run = client.Get(client.Schema.LAST_FOREMAN_TIME) or 0
-    except AttributeError:
-      last_foreman_run = 0
+    All the clients are checked in one pass: the clients, the objects the rules
+    need and the hunts already running on them are each read in a single round
+    trip, and the rules are compiled once and reused until they change.
 
-    latest_rule = max(rule.created for rule in rules)
+    Args:
+      client_ids: Client ids of the clients for tasks to be assigned.
 
-    if latest_rule <= int(last_foreman_run):
+    Returns:
+      Number of assigned tasks.
+    """
+    rules = self.Get(self.Schema.RULES)
+    if not rules:
       return 0
 
-    # Update the latest checked rule on the client.
-    client.Set(client.Schema.LAST_FOREMAN_TIME(latest_rule))
-    client.Close()
+    rule_index = self._GetRuleIndex(rules)
+    now = time.time() * 1e6
+
+    client_ids = [rdf_client.ClientURN(client_id) for client_id in client_ids]
+    clients = {}
+    for client in aff4.FACTORY.MultiOpen(
+        client_ids, mode="rw", token=self.token):
+      clients[str(client.urn)] = client
 
     # For efficiency we collect all the objects we want to open first and then
     # open them all in one round trip.
+    objects = {}
     object_urns = {}
     relevant_rules = []
-    expired_rules = False
-
-    now = time.time() * 1e6
-
-    for rule in rules:
-      if rule.expires < now:
-        expired_rules = True
-        continue
-      if rule.created <= int(last_foreman_run):
+    for client_id in client_ids:
+      client = clients.get(str(client_id))
+      if client is None:
         continue
 
-      relevant_rules.append(rule)
+      try:
+        last_foreman_run = client.Get(client.Schema.LAST_FOREMAN_TIME) or 0
+      except AttributeError:
+        last_foreman_run = 0
 
-      for path in rule.client_rule_set.GetPathsToCheck():
-        aff4_object = client_id.Add(path)
-        object_urns[str(aff4_object)] = aff4_object
+      last_foreman_run = int(last_foreman_run)
+      if rule_index.latest_created <= last_foreman_run:
+        continue
 
-    # Retrieve all aff4 objects we need.
-    objects = {}
+      # Update the latest checked rule on the client.
+      client.Set(client.Schema.LAST_FOREMAN_TIME(rule_index.latest_created))
+      objects[client.urn] = client
+
+      client_rules = rule_index.GetRelevantRules(last_foreman_run, now)
+      relevant_rules.append((client_id, client_rules))
+      for _, _, paths in client_rules:
+        for path in paths:
+          aff4_object = client_id.Add(path)
+          object_urns[str(aff4_object)] = aff4_object
+
+    # Retrieve all aff4 objects we need, the clients themselves are open
+    # already.
+    for urn in objects:
+      object_urns.pop(str(urn), None)
     for fd in aff4.FACTORY.MultiOpen(object_urns, token=self.token):
       objects[fd.urn] = fd
 
+    matching_rules = []
+    for client_id, client_rules in relevant_rules:
+      for rule, matcher, _ in client_rules:
+        if matcher(objects, client_id):
+          matching_rules.append((client_id, rule))
+
+    for client_id, _ in relevant_rules:
+      clients[str(client_id)].Close()
+
+    assigned_hunt_tasks = self._GetAssignedHuntTasks(matching_rules)
     actions_count = 0
-    for rule in relevant_rules:
-      if self._EvaluateRules(objects, rule, client_id):
-        actions_count += self._RunActions(rule, client_id)
+    for client_id, rule in matching_rules:
+      actions_count += self._RunActions(rule, client_id, assigned_hunt_tasks)
 
-    if expired_rules:
+    if relevant_rules and rule_index.earliest_expiry < now:
       self.ExpireRules()
 
     return actions_count
@@ -2,11 +2,13 @@
 """This tests the performance of the AFF4 subsystem."""
 
 
+import threading
 
 from grr.lib import aff4
 from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import test_lib
+from grr.lib import utils
 from grr.lib.aff4_objects import aff4_grr
 from grr.lib.aff4_objects import standard
 from grr.lib.rdfvalues import client as rdf_client
@@ -114,6 +116,39 @@ class AFF4Benchmark(test_lib.AverageMicroBenchmarks):
     self.TimeIt(
         ReadAVersionedAFF4Attribute, name="Read one versioned Attributes")
 
+  def testAFF4CacheTypes(self):
+    """Compare the AFF4 object cache implementations under concurrency."""
+    client_ids = ["C.%016X" % i for i in range(100)]
+    for client_id in client_ids:
+      with aff4.FACTORY.Create(
+          client_id, aff4_grr.VFSGRRClient, token=self.token) as fd:
+        fd.Set(fd.Schema.HOSTNAME("Foobar"))
+
+    def OpenClients():
+      for client_id in client_ids:
+        fd = aff4.FACTORY.Open(client_id, token=self.token)
+        self.assertEqual(fd.Get(fd.Schema.HOSTNAME), "Foobar")
+
+    def OpenClientsThreaded(threads=10):
+      workers = [threading.Thread(target=OpenClients) for _ in range(threads)]
+      for worker in workers:
+        worker.start()
+      for worker in workers:
+        worker.join()
+
+    for cache_type in ["AgeBasedCache", "ShardedAgeBasedCache"]:
+      with test_lib.ConfigOverrider({"AFF4.cache_type": cache_type}):
+        factory = aff4.Factory()
+
+      with utils.Stubber(aff4, "FACTORY", factory):
+        # Warm the cache up so we measure cache hits.
+        OpenClients()
+        self.TimeIt(OpenClients, name="Open cached objects (%s)" % cache_type)
+        self.TimeIt(
+            OpenClientsThreaded,
+            name="Open cached objects, 10 threads (%s)" % cache_type,
+            repetitions=5)
+
 
 def main(argv):
   # Run the full test suite
@@ -170,10 +170,13 @@ class RDFValueCollection(aff4.AFF4Object):
       if not rdf_value.age:
         rdf_value.age = rdfvalue.RDFDatetime.Now()
 
+    serialized = rdf_protodict.EmbeddedRDFValue.SerializeMany([
+        rdf_protodict.EmbeddedRDFValue(payload=rdf_value)
+        for rdf_value in rdf_values
+    ])
+
     buf = cStringIO.StringIO()
-    for index, rdf_value in enumerate(rdf_values):
-      data = rdf_protodict.EmbeddedRDFValue(
-          payload=rdf_value).SerializeToString()
+    for index, (rdf_value, data) in enumerate(zip(rdf_values, serialized)):
       buf.write(struct.pack("<i", len(data)))
       buf.write(data)
 
@@ -542,7 +545,7 @@ class PackedVersionedCollection(RDFValueCollection):
     if token is None:
       raise ValueError("Token can't be None.")
 
-    data_attrs = []
+    embedded_values = []
     for rdf_value in rdf_values:
       if rdf_value is None:
         raise ValueError("Can't add None to the collection.")
@@ -554,9 +557,11 @@ class PackedVersionedCollection(RDFValueCollection):
       if not rdf_value.age:
         rdf_value.age = rdfvalue.RDFDatetime.Now()
 
-      data_attrs.append(
-          cls.SchemaCls.DATA(
-              rdf_protodict.EmbeddedRDFValue(payload=rdf_value)))
+      embedded_values.append(rdf_protodict.EmbeddedRDFValue(payload=rdf_value))
+
+    # The data store stores serialized strings as they are, so we can encode
+    # all the values in one go.
+    data_attrs = rdf_protodict.EmbeddedRDFValue.SerializeMany(embedded_values)
 
     attrs_to_set = {cls.SchemaCls.DATA: data_attrs}
     if cls.IsJournalingEnabled():
@@ -682,17 +687,17 @@ class PackedVersionedCollection(RDFValueCollection):
           timestamp=(0, freeze_timestamp)):
 
         if results is not None:
-          results.append(data_obj.FromSerializedString(value).payload)
+          results.append(value)
           if max_reversed_results and len(results) > max_reversed_results:
-            for result in results:
-              yield result
+            for result in data_obj.ParseMany(results):
+              yield result.payload
             results = None
         else:
           yield data_obj.FromSerializedString(value).payload
 
       if results is not None:
-        for result in reversed(results):
-          yield result
+        for result in reversed(data_obj.ParseMany(results)):
+          yield result.payload
 
   def GenerateItems(self, offset=0):
     """First iterate over the versions, and then iterate over the stream."""
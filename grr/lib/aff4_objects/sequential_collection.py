@@ -4,6 +4,7 @@
 
 import collections
 import random
+import struct
 import threading
 import time
 
@@ -35,6 +36,9 @@ class SequentialCollection(aff4.AFF4Object):
   # The largest possible suffix - maximum value expressible by 6 hex digits.
   MAX_SUFFIX = 2**24 - 1
 
+  # How many records Scan() parses at once.
+  SCAN_BATCH_SIZE = 1000
+
   @classmethod
   def _MakeURN(cls, urn, timestamp, suffix=None):
     if suffix is None:
@@ -190,27 +194,35 @@ class SequentialCollection(aff4.AFF4Object):
           self._MakeURN(
               self.urn, after_timestamp, suffix=suffix))
 
-    for subject, timestamp, value in data_store.DB.ScanAttribute(
+    records = data_store.DB.ScanAttribute(
         self.urn.Add("Results"),
         self.ATTRIBUTE,
         after_urn=after_urn,
         max_records=max_records,
-        token=self.token):
-      rdf_value = self.RDF_TYPE.FromSerializedString(value)
-      rdf_value.age = timestamp
-      if include_suffix:
-        yield (self._ParseURN(subject), rdf_value)
-      else:
-        yield (timestamp, rdf_value)
+        token=self.token)
+
+    # Parse the records in batches, this is much faster than parsing them one
+    # at a time.
+    for batch in utils.Grouper(records, self.SCAN_BATCH_SIZE):
+      rdf_values = self.RDF_TYPE.ParseMany([value for _, _, value in batch])
+      for (subject, timestamp, _), rdf_value in zip(batch, rdf_values):
+        rdf_value.age = timestamp
+        if include_suffix:
+          yield (self._ParseURN(subject), rdf_value)
+        else:
+          yield (timestamp, rdf_value)
 
   def MultiResolve(self, timestamps):
     """Lookup multiple values by (timestamp, suffix) pairs."""
+    records = []
     for _, v in data_store.DB.MultiResolvePrefix(
         [self._MakeURN(self.urn, ts, suffix) for (ts, suffix) in timestamps],
         self.ATTRIBUTE,
         token=self.token):
-      _, value, timestamp = v[0]
-      rdf_value = self.RDF_TYPE.FromSerializedString(value)
+      records.append(v[0])
+
+    rdf_values = self.RDF_TYPE.ParseMany([value for _, value, _ in records])
+    for (_, _, timestamp), rdf_value in zip(records, rdf_values):
       rdf_value.age = timestamp
       yield rdf_value
 
@@ -237,6 +249,8 @@ class BackgroundIndexUpdater(object):
 
   def __init__(self):
     self.to_process = collections.deque()
+    # The urns in to_process, a collection only needs to be queued once.
+    self.queued = set()
     self.cv = threading.Condition()
 
   def ExitNow(self):
@@ -247,6 +261,10 @@ class BackgroundIndexUpdater(object):
 
   def AddIndexToUpdate(self, index_urn):
     with self.cv:
+      key = utils.SmartUnicode(index_urn)
+      if key in self.queued:
+        return
+      self.queued.add(key)
       self.to_process.append((index_urn, time.time() + self.INDEX_DELAY))
       self.cv.notify()
 
@@ -274,6 +292,10 @@ class BackgroundIndexUpdater(object):
         time.sleep(next_time - now)
         now = time.time()
 
+      # Records added from now on need another update.
+      with self.cv:
+        self.queued.discard(utils.SmartUnicode(next_urn))
+
       self.ProcessCollection(next_urn, token)
 
 
@@ -308,9 +330,23 @@ class IndexedSequentialCollection(SequentialCollection):
 
   INDEX_SPACING = 1024
 
-  # An attribute name of the form "index:sc_<i>" at timestamp <t> indicates that
+  # The index is stored packed in versions of a single attribute. Every
+  # version starts with the record count up to the last indexed record and the
+  # position (timestamp, suffix) of that record, followed by one (record
+  # number, timestamp, suffix) entry for every index marker added since the
+  # previous version. Versions are appended when the index grows and merged
+  # into one by UpdateIndex() once there are more than INDEX_MAX_VERSIONS.
+
+  INDEX_ATTRIBUTE = "index:packed"
+  INDEX_HEADER_FORMAT = "<QQI"
+  INDEX_ENTRY_FORMAT = "<QQI"
+  INDEX_MAX_VERSIONS = 32
+
+  # Older collections store every index marker in its own attribute. An
+  # attribute name of the form "index:sc_<i>" at timestamp <t> indicates that
   # the item with record number i was stored at timestamp t. The timestamp
-  # suffix is stored as the value.
+  # suffix is stored as the value. These are only read when the packed index
+  # has not been written yet.
 
   INDEX_ATTRIBUTE_PREFIX = "index:sc_"
 
@@ -328,32 +364,109 @@ class IndexedSequentialCollection(SequentialCollection):
       return
     self._index = {0: (0, 0)}
     self._max_indexed = 0
+    # The number of records up to the last indexed one, and its position.
+    self._indexed_count = 0
+    self._indexed_ts = None
+    # Markers and count which are not stored yet.
+    self._new_markers = []
+    self._count_dirty = False
+    self._index_versions = 0
+
+    for _, packed_index, _ in data_store.DB.ResolveMulti(
+        self.urn, [self.INDEX_ATTRIBUTE],
+        timestamp=data_store.DB.ALL_TIMESTAMPS,
+        token=self.token):
+      self._UnpackIndex(packed_index)
+      self._index_versions += 1
+
+    if self._index_versions:
+      return
+
     for (attr, value, ts) in data_store.DB.ResolvePrefix(
         self.urn, self.INDEX_ATTRIBUTE_PREFIX, token=self.token):
       i = int(attr[len(self.INDEX_ATTRIBUTE_PREFIX):], 16)
       self._index[i] = (ts, int(value, 16))
       self._max_indexed = max(i, self._max_indexed)
 
-  def _MaybeWriteIndex(self, i, ts, mutation_pool):
-    """Write index marker i."""
+  def _UnpackIndex(self, packed_index):
+    header_size = struct.calcsize(self.INDEX_HEADER_FORMAT)
+    entry_size = struct.calcsize(self.INDEX_ENTRY_FORMAT)
+
+    count, ts, suffix = struct.unpack_from(self.INDEX_HEADER_FORMAT,
+                                           packed_index)
+    if count > self._indexed_count:
+      self._indexed_count = count
+      self._indexed_ts = (ts, suffix)
+
+    for offset in xrange(header_size, len(packed_index), entry_size):
+      i, ts, suffix = struct.unpack_from(self.INDEX_ENTRY_FORMAT, packed_index,
+                                         offset)
+      self._index[i] = (ts, suffix)
+      self._max_indexed = max(i, self._max_indexed)
+
+  def _PackIndex(self, markers):
+    ts, suffix = self._indexed_ts or (0, 0)
+    result = [
+        struct.pack(self.INDEX_HEADER_FORMAT, self._indexed_count, ts, suffix)
+    ]
+    for i in sorted(markers):
+      if i:
+        result.append(struct.pack(self.INDEX_ENTRY_FORMAT, i, *self._index[i]))
+    return "".join(result)
+
+  def _MaybeUpdateIndex(self, i, ts, cutoff):
+    """Record that record i is at position ts."""
+    # We only index records if the timestamp is more than INDEX_WRITE_DELAY in
+    # the past: hacky defense against a late write changing the count.
+    if ts[0] >= cutoff:
+      return
+
+    if i >= self._indexed_count:
+      self._indexed_count = i + 1
+      self._indexed_ts = ts
+      self._count_dirty = True
+
     if i > self._max_indexed and i % self.INDEX_SPACING == 0:
-      # We only write the index if the timestamp is more than 5 minutes in the
-      # past: hacky defense against a late write changing the count.
-      if ts[0] < (rdfvalue.RDFDatetime.Now() - self.INDEX_WRITE_DELAY
-                 ).AsMicroSecondsFromEpoch():
-        # We may be used in contexts were we don't have write access, so simply
-        # give up in that case. TODO(user): Remove this when the ACL
-        # system allows.
-        try:
-          mutation_pool.Set(self.urn,
-                            self.INDEX_ATTRIBUTE_PREFIX + "%08x" % i,
-                            "%06x" % ts[1],
-                            timestamp=ts[0],
-                            replace=True)
-          self._index[i] = ts
-          self._max_indexed = max(i, self._max_indexed)
-        except access_control.UnauthorizedAccess:
-          pass
+      self._index[i] = ts
+      self._max_indexed = i
+      self._new_markers.append(i)
+
+  def _MaybeWriteIndex(self, compact=False):
+    """Appends the new index markers to the stored index.
+
+    Args:
+      compact: If set, also store an advanced record count on its own and
+        merge all the stored versions into one.
+    """
+    merge = compact and self._index_versions > self.INDEX_MAX_VERSIONS
+    if not (merge or self._new_markers or (compact and self._count_dirty)):
+      return
+
+    # Until the first packed version is stored, the index may hold markers
+    # read from the legacy attributes, so that version has to hold them all.
+    if merge or not self._index_versions:
+      packed_index = self._PackIndex(self._index)
+      replace = True
+    else:
+      packed_index = self._PackIndex(self._new_markers)
+      replace = False
+
+    # We may be used in contexts were we don't have write access, so simply
+    # give up in that case. The access is checked when the pool is flushed.
+    # TODO(user): Remove this when the ACL system allows.
+    try:
+      with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
+        mutation_pool.Set(
+            self.urn, self.INDEX_ATTRIBUTE, packed_index, replace=replace)
+    except access_control.UnauthorizedAccess:
+      return
+
+    self._index_versions = 1 if replace else self._index_versions + 1
+    self._new_markers = []
+    self._count_dirty = False
+
+  def _LastIndexedRecord(self):
+    return max(self._max_indexed, self._indexed_count - 1)
 
   def _IndexedScan(self, i, max_records=None):
     """Scan records starting with index i."""
@@ -376,18 +489,28 @@ class IndexedSequentialCollection(SequentialCollection):
       except KeyError:
         pass
 
+    # The last indexed record may be closer than any index marker.
+    if idx < self._indexed_count - 1 <= i:
+      start_ts = (self._indexed_ts[0], self._indexed_ts[1] - 1)
+      idx = self._indexed_count - 1
+
     if max_records is not None:
       max_records += i - idx
 
-    with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
+    cutoff = (rdfvalue.RDFDatetime.Now() - self.INDEX_WRITE_DELAY
+             ).AsMicroSecondsFromEpoch()
+
+    try:
       for (ts, value) in self.Scan(
           after_timestamp=start_ts,
           max_records=max_records,
           include_suffix=True):
-        self._MaybeWriteIndex(idx, ts, mutation_pool)
+        self._MaybeUpdateIndex(idx, ts, cutoff)
         if idx >= i:
           yield (idx, ts, value)
         idx += 1
+    finally:
+      self._MaybeWriteIndex()
 
   def GenerateItems(self, offset=0):
     for (_, _, value) in self._IndexedScan(offset):
@@ -404,7 +527,7 @@ class IndexedSequentialCollection(SequentialCollection):
   def CalculateLength(self):
     self._ReadIndex()
     highest_index = None
-    for (i, _, _) in self._IndexedScan(self._max_indexed):
+    for (i, _, _) in self._IndexedScan(self._LastIndexedRecord()):
       highest_index = i
     if highest_index is None:
       return 0
@@ -414,9 +537,11 @@ class IndexedSequentialCollection(SequentialCollection):
     return self.CalculateLength()
 
   def UpdateIndex(self):
+    """Indexes the new records and stores the index."""
     self._ReadIndex()
-    for _ in self._IndexedScan(self._max_indexed):
+    for _ in self._IndexedScan(self._LastIndexedRecord()):
       pass
+    self._MaybeWriteIndex(compact=True)
 
   @classmethod
   def StaticAdd(cls,
@@ -429,8 +554,9 @@ class IndexedSequentialCollection(SequentialCollection):
     r = super(IndexedSequentialCollection, cls).StaticAdd(collection_urn, token,
                                                           rdf_value, timestamp,
                                                           suffix, **kwargs)
-    if random.randint(0, cls.INDEX_SPACING) == 0:
-      BACKGROUND_INDEX_UPDATER.AddIndexToUpdate(collection_urn)
+    # Keep the stored index close to the end of the collection, so that
+    # finding the length only needs to read the most recent records.
+    BACKGROUND_INDEX_UPDATER.AddIndexToUpdate(collection_urn)
     return r
 
 
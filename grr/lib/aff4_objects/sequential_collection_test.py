@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 """Tests for SequentialCollection and related subclasses."""
 
+import struct
 import threading
 
+from grr.lib import access_control
 from grr.lib import aff4
+from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import test_lib
@@ -183,6 +186,140 @@ class IndexedSequentialCollectionTest(test_lib.AFF4ObjectTest):
           sorted(collection._index.keys()),
           [0, 1024, 2048, 3072, 4096, 5120, 6144, 7168, 8192, 9216])
 
+  def testLengthStartsFromLastIndexedRecord(self):
+    test_urn = "aff4:/sequential_collection/testLengthStartsFromLastIndexed"
+    with aff4.FACTORY.Create(
+        test_urn, TestIndexedSequentialCollection,
+        token=self.token) as collection:
+      timestamps = []
+      for i in range(100):
+        timestamps.append(collection.Add(rdfvalue.RDFInteger(i)))
+
+    with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() + rdfvalue.Duration(
+        "10m")):
+      collection = aff4.FACTORY.Open(test_urn, token=self.token)
+      collection.UpdateIndex()
+
+      # The packed index remembers the last indexed record, so a fresh
+      # collection only scans from there.
+      collection = aff4.FACTORY.Open(test_urn, token=self.token)
+      with test_lib.Instrument(sequential_collection.SequentialCollection,
+                               "Scan") as scan:
+        self.assertEqual(len(collection), 100)
+        self.assertEqual(collection[99], 99)
+        self.assertEqual(collection[5], 5)
+
+      self.assertEqual(scan.kwargs[0]["after_timestamp"],
+                       (timestamps[99][0], timestamps[99][1] - 1))
+      self.assertEqual(scan.kwargs[1]["after_timestamp"],
+                       (timestamps[99][0], timestamps[99][1] - 1))
+      self.assertEqual(collection._indexed_count, 100)
+
+  def _ReadPackedIndexVersions(self, urn):
+    return [
+        value
+        for _, value, _ in data_store.DB.ResolveMulti(
+            urn, [TestIndexedSequentialCollection.INDEX_ATTRIBUTE],
+            timestamp=data_store.DB.ALL_TIMESTAMPS,
+            token=self.token)
+    ]
+
+  def testIndexIsAppendedAndCompacted(self):
+    test_urn = "aff4:/sequential_collection/testIndexIsAppendedAndCompacted"
+    isq = sequential_collection.IndexedSequentialCollection
+    with utils.MultiStubber((isq, "INDEX_SPACING", 8),
+                            (isq, "INDEX_MAX_VERSIONS", 2)):
+      with aff4.FACTORY.Create(
+          test_urn, TestIndexedSequentialCollection,
+          token=self.token) as collection:
+        for i in range(40):
+          collection.Add(rdfvalue.RDFInteger(i))
+
+      with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() + rdfvalue.Duration(
+          "10m")):
+        # Every read that adds index markers appends only those markers.
+        for i in [8, 16, 24, 32]:
+          collection = aff4.FACTORY.Open(test_urn, token=self.token)
+          self.assertEqual(collection[i + 1], i + 1)
+
+        versions = self._ReadPackedIndexVersions(test_urn)
+        self.assertEqual(len(versions), 4)
+        for version in versions:
+          self.assertEqual(
+              len(version),
+              struct.calcsize(isq.INDEX_HEADER_FORMAT) +
+              struct.calcsize(isq.INDEX_ENTRY_FORMAT))
+
+        # Reading an indexed record does not write anything.
+        collection = aff4.FACTORY.Open(test_urn, token=self.token)
+        self.assertEqual(collection[20], 20)
+        self.assertEqual(len(self._ReadPackedIndexVersions(test_urn)), 4)
+
+        # The index updater merges the versions.
+        collection = aff4.FACTORY.Open(test_urn, token=self.token)
+        collection.UpdateIndex()
+        self.assertEqual(len(self._ReadPackedIndexVersions(test_urn)), 1)
+
+        collection = aff4.FACTORY.Open(test_urn, token=self.token)
+        self.assertEqual(len(collection), 40)
+        self.assertEqual(sorted(collection._index), [0, 8, 16, 24, 32])
+        self.assertEqual(collection._indexed_count, 40)
+
+  def testLegacyIndexIsKeptWhenPackedIndexIsFirstWritten(self):
+    test_urn = "aff4:/sequential_collection/testLegacyIndexIsKept"
+    isq = sequential_collection.IndexedSequentialCollection
+    with utils.Stubber(isq, "INDEX_SPACING", 8):
+      with aff4.FACTORY.Create(
+          test_urn, TestIndexedSequentialCollection,
+          token=self.token) as collection:
+        timestamps = []
+        for i in range(40):
+          timestamps.append(collection.Add(rdfvalue.RDFInteger(i)))
+
+      # Index the first records the way older collections did.
+      for i in [8, 16]:
+        ts, suffix = timestamps[i]
+        data_store.DB.Set(
+            test_urn,
+            isq.INDEX_ATTRIBUTE_PREFIX + "%08x" % i,
+            "%06x" % suffix,
+            timestamp=ts,
+            token=self.token)
+
+      with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() + rdfvalue.Duration(
+          "10m")):
+        collection = aff4.FACTORY.Open(test_urn, token=self.token)
+        self.assertEqual(collection[33], 33)
+
+        collection = aff4.FACTORY.Open(test_urn, token=self.token)
+        with test_lib.Instrument(sequential_collection.SequentialCollection,
+                                 "Scan") as scan:
+          self.assertEqual(collection[17], 17)
+
+        self.assertEqual(sorted(collection._index), [0, 8, 16, 24, 32])
+        self.assertEqual(scan.kwargs[0]["after_timestamp"],
+                         (timestamps[16][0], timestamps[16][1] - 1))
+
+  def testReadingWithoutWriteAccessKeepsIndexInMemory(self):
+    test_urn = "aff4:/sequential_collection/testReadingWithoutWriteAccess"
+    with aff4.FACTORY.Create(
+        test_urn, TestIndexedSequentialCollection,
+        token=self.token) as collection:
+      for i in range(2 * 1024 + 1):
+        collection.Add(rdfvalue.RDFInteger(i))
+
+    def Deny(*_, **__):
+      raise access_control.UnauthorizedAccess("Denied.")
+
+    with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() + rdfvalue.Duration(
+        "10m")):
+      collection = aff4.FACTORY.Open(test_urn, token=self.token)
+      with utils.Stubber(data_store.DB, "MultiSet", Deny):
+        self.assertEqual(collection[2048], 2048)
+
+      self.assertEqual(sorted(collection._index), [0, 1024, 2048])
+      self.assertFalse(self._ReadPackedIndexVersions(test_urn))
+
   def testIndexedReads(self):
     with aff4.FACTORY.Create(
         "aff4:/sequential_collection/testIndexedReads",
@@ -132,12 +132,14 @@ class BlobImage(aff4.AFF4ImageBase):
       possible to yield a truncated file.
     """
 
+    token = fds[0].token
+    fetch_fn = lambda pairs: data_store.DB.ReadBlobs(
+        dict(pairs).keys(), token=token)
+
     broken_fds = set()
     missing_blobs_fd_pairs = []
-    for chunk_fd_pairs in utils.Grouper(
-        cls._GenerateChunkIds(fds), cls.MULTI_STREAM_CHUNKS_READ_AHEAD):
-      results_map = data_store.DB.ReadBlobs(
-          dict(chunk_fd_pairs).keys(), token=fds[0].token)
+    for chunk_fd_pairs, results_map in cls._PrefetchChunkGroups(
+        cls._GenerateChunkIds(fds), fetch_fn):
 
       for chunk_id, fd in chunk_fd_pairs:
         if chunk_id not in results_map or results_map[chunk_id] is None:
@@ -426,6 +428,19 @@ class AFF4SparseImage(aff4.AFF4ImageBase):
         "The highest numbered chunk in this object.",
         default=-1)
 
+  @classmethod
+  def _FetchMultiStreamChunks(cls, chunk_fd_pairs, token=None):
+    """Resolves the hashes stored in the chunk streams to their blobs."""
+    chunk_hashes = super(AFF4SparseImage, cls)._FetchMultiStreamChunks(
+        chunk_fd_pairs, token=token)
+    blob_hashes = dict((chunk_urn, hsh[:cls._HASH_SIZE].encode("hex"))
+                       for chunk_urn, hsh in chunk_hashes.iteritems() if hsh)
+    blobs = data_store.DB.ReadBlobs(
+        list(set(blob_hashes.values())), token=token)
+
+    return dict((chunk_urn, blobs.get(blob_hash))
+                for chunk_urn, blob_hash in blob_hashes.iteritems())
+
   def _ReadChunks(self, chunks):
     chunk_hashes = self._ChunkNrsToHashes(chunks)
     chunk_nrs = {}
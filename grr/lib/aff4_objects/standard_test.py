@@ -299,6 +299,27 @@ class AFF4SparseImageTest(test_lib.AFF4ObjectTest):
 
     self.assertChunkEqual(fd, chunk_number, blob_contents)
 
+  def testMultiStreamReadsBlobContents(self):
+    urn = aff4.ROOT_URN.Add("temp_sparse_image.dd")
+    with aff4.FACTORY.Create(
+        urn,
+        aff4_type=aff4_standard.AFF4SparseImage,
+        token=self.token,
+        mode="rw") as fd:
+      fd.Set(fd.Schema._CHUNKSIZE, rdfvalue.RDFInteger(1024))
+      fd.chunksize = 1024
+
+      blob_contents = "A" * 1000
+      blob_hash = self.AddBlobToBlobStore(blob_contents).decode("hex")
+      fd.AddBlob(blob_hash, len(blob_contents), chunk_number=0)
+
+    fd = aff4.FACTORY.Open(urn, token=self.token)
+    chunks_fds = list(aff4.AFF4Stream.MultiStream([fd]))
+
+    self.assertEqual(len(chunks_fds), 1)
+    self.assertEqual(chunks_fds[0][1], blob_contents)
+    self.assertIsNone(chunks_fds[0][2])
+
   def testReadAhead(self):
     """Read a chunk, and test that the next few are in cache."""
 
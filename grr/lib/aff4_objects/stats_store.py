@@ -31,11 +31,23 @@ stored as datastore row attributes.
 Statistics is written to the data store by StatsStoreWorker. It periodically
 fetches values for all the metrics and writes them to corresponding
 object on AFF4.
+
+Depending on StatsStore.storage_format, values can instead (or additionally)
+be stored in a columnar format: all the values of a metric written by a
+process within one hour are stored in a single
+aff4:stats_store_columns/<metric name> attribute version (timestamped with the
+start of the hour), as packed arrays of delta-encoded timestamps and values.
+Values of the current hour are written as one small version per write and get
+compacted into the hour's version once the process starts writing the next
+hour.
+Reading a week of data then means decoding a few hundred blobs instead of
+parsing tens of thousands of individual values.
 """
 
 
 
 import re
+import struct
 import threading
 import time
 
@@ -119,6 +131,100 @@ class StatsStoreValue(structs.RDFProtoStruct):
     self.value_type = value_type
 
 
+class StatsStoreColumn(structs.RDFProtoStruct):
+  """Values of a single metric (with given fields values) in packed form."""
+
+  protobuf = jobs_pb2.StatsStoreColumn
+
+  # struct format characters for the value types that are stored packed.
+  PACKED_FORMATS = {
+      stats.MetricMetadata.ValueType.INT: "q",
+      stats.MetricMetadata.ValueType.FLOAT: "d"
+  }
+
+  @property
+  def key(self):
+    return tuple(field_value.value for field_value in self.fields_values)
+
+  @staticmethod
+  def _Unpack(packed, fmt):
+    return struct.unpack("<%d%s" % (len(packed) // 8, fmt), packed)
+
+  @staticmethod
+  def _Pack(values, fmt):
+    return struct.pack("<%d%s" % (len(values), fmt), *values)
+
+  def GetPoints(self):
+    """Returns a list of (value, timestamp) tuples stored in this column."""
+    timestamps = []
+    current = 0
+    for delta in self._Unpack(self.timestamps or "", "q"):
+      current += delta
+      timestamps.append(current)
+
+    fmt = self.PACKED_FORMATS.get(self.value_type)
+    if fmt:
+      values = self._Unpack(self.values or "", fmt)
+    else:
+      values = [stored_value.value for stored_value in self.other_values]
+
+    return zip(values, timestamps)
+
+  def SetPoints(self, points):
+    """Replaces the contents of this column with (value, timestamp) points."""
+    deltas = []
+    previous = 0
+    for _, timestamp in points:
+      deltas.append(timestamp - previous)
+      previous = timestamp
+    self.timestamps = self._Pack(deltas, "q")
+
+    fmt = self.PACKED_FORMATS.get(self.value_type)
+    if fmt:
+      self.values = self._Pack([value for value, _ in points], fmt)
+    else:
+      other_values = []
+      for value, _ in points:
+        stored_value = StatsStoreValue()
+        stored_value.SetValue(value, self.value_type)
+        other_values.append(stored_value)
+      self.other_values = other_values
+
+  def AppendPoint(self, value, timestamp):
+    """Appends a single point to the packed contents of this column."""
+    last_timestamp = sum(self._Unpack(self.timestamps or "", "q"))
+    self.timestamps = (self.timestamps or "") + self._Pack(
+        [timestamp - last_timestamp], "q")
+
+    fmt = self.PACKED_FORMATS.get(self.value_type)
+    if fmt:
+      self.values = (self.values or "") + self._Pack([value], fmt)
+    else:
+      stored_value = StatsStoreValue()
+      stored_value.SetValue(value, self.value_type)
+      self.other_values.Append(stored_value)
+
+
+class StatsStoreColumns(structs.RDFProtoStruct):
+  """All the columns of a metric for a period of time."""
+
+  protobuf = jobs_pb2.StatsStoreColumns
+
+  def Append(self, store_value, timestamp):
+    """Appends a StatsStoreValue written at timestamp to its column."""
+    key = tuple(field_value.value for field_value in store_value.fields_values)
+    for column in self.columns:
+      if column.key == key:
+        break
+    else:
+      column = StatsStoreColumn(
+          fields_values=list(store_value.fields_values),
+          value_type=store_value.value_type)
+      self.columns.Append(column)
+
+    column.AppendPoint(store_value.value, timestamp)
+
+
 class StatsStoreMetricsMetadata(structs.RDFProtoStruct):
   """Container with metadata for all the metrics in a given process."""
 
@@ -136,6 +242,10 @@ class StatsStoreProcessData(aff4.AFF4Object):
   """Stores stats data for a particular process."""
 
   STATS_STORE_PREFIX = "aff4:stats_store/"
+  STATS_STORE_COLUMNS_PREFIX = "aff4:stats_store_columns/"
+
+  # Columnar values are stored in blocks of one hour (in microseconds).
+  COLUMNS_BLOCK_SIZE = 3600 * 1000000
 
   ALL_TIMESTAMPS = data_store.DataStore.ALL_TIMESTAMPS
   NEWEST_TIMESTAMP = data_store.DataStore.NEWEST_TIMESTAMP
@@ -163,12 +273,9 @@ class StatsStoreProcessData(aff4.AFF4Object):
           self.Schema.METRICS_METADATA, store_metadata, age=timestamp)
       self.Flush(sync=sync)
 
-  def WriteStats(self, timestamp=None, sync=False):
+  def _CollectStats(self, metrics_metadata):
+    """Returns current metrics values as StatsStoreValues keyed by attribute."""
     to_set = {}
-    metrics_metadata = stats.STATS.GetAllMetricsMetadata()
-    self.WriteMetadataDescriptors(
-        metrics_metadata, timestamp=timestamp, sync=sync)
-
     for name, metadata in metrics_metadata.iteritems():
       if metadata.fields_defs:
         for fields_values in stats.STATS.GetMetricFields(name):
@@ -194,14 +301,125 @@ class StatsStoreProcessData(aff4.AFF4Object):
 
         to_set[self.STATS_STORE_PREFIX + name] = [store_value]
 
-    # Write actual data
+    return to_set
+
+  def WriteStats(self, timestamp=None, sync=False):
+    metrics_metadata = stats.STATS.GetAllMetricsMetadata()
+    self.WriteMetadataDescriptors(
+        metrics_metadata, timestamp=timestamp, sync=sync)
+
+    to_set = self._CollectStats(metrics_metadata)
+    storage_format = config_lib.CONFIG["StatsStore.storage_format"]
+
+    if storage_format in ["attributes", "dual"]:
+      # Write actual data
+      data_store.DB.MultiSet(
+          self.urn,
+          to_set,
+          replace=False,
+          token=self.token,
+          timestamp=timestamp,
+          sync=sync)
+
+    if storage_format in ["columnar", "dual"]:
+      self._WriteColumns(to_set, timestamp=timestamp)
+
+  @classmethod
+  def ColumnsBlockStart(cls, timestamp):
+    """Returns the start of the columns block that timestamp belongs to."""
+    timestamp = int(timestamp)
+    return timestamp - timestamp % cls.COLUMNS_BLOCK_SIZE
+
+  def _ReadColumns(self, timestamp):
+    """Reads the columns cells written within the given time range."""
+    blocks = {}
+    for predicate, value, ts in data_store.DB.ResolvePrefix(
+        self.urn,
+        self.STATS_STORE_COLUMNS_PREFIX,
+        timestamp=timestamp,
+        token=self.token):
+      blocks[(predicate, ts)] = StatsStoreColumns.FromSerializedString(value)
+    return blocks
+
+  def _WriteColumns(self, to_set, timestamp=None):
+    """Writes the values as a new columns cell at the given timestamp.
+
+    Every write only stores its own samples, so the cost of a write doesn't
+    depend on how many samples were written before it. Once the writes move
+    on to the next hour, the cells of the previous hour are compacted into a
+    single cell at the start of that hour.
+
+    Args:
+      to_set: Dict of lists of StatsStoreValues keyed by attribute name.
+      timestamp: Timestamp of the values, defaults to now.
+    """
+    if timestamp is None:
+      timestamp = rdfvalue.RDFDatetime.Now()
+    timestamp = int(timestamp)
+    block_start = self.ColumnsBlockStart(timestamp)
+
+    newest = [ts for _, _, ts in data_store.DB.ResolvePrefix(
+        self.urn,
+        self.STATS_STORE_COLUMNS_PREFIX,
+        timestamp=self.NEWEST_TIMESTAMP,
+        token=self.token)]
+    if newest:
+      last_write = max(newest)
+      last_block_start = self.ColumnsBlockStart(last_write)
+      # A cell at the very start of a block is either a compacted block or
+      # the only sample of that block, so there is nothing to compact.
+      if last_block_start < block_start and last_write != last_block_start:
+        self._CompactColumns(last_block_start)
+
+    blocks = {}
+    for predicate, store_values in to_set.iteritems():
+      name = predicate[len(self.STATS_STORE_PREFIX):]
+      block = blocks.setdefault(self.STATS_STORE_COLUMNS_PREFIX + name,
+                                StatsStoreColumns())
+      for store_value in store_values:
+        block.Append(store_value, timestamp)
+
     data_store.DB.MultiSet(
         self.urn,
-        to_set,
-        replace=False,
-        token=self.token,
+        dict((predicate, [block.SerializeToString()])
+             for predicate, block in blocks.iteritems()),
         timestamp=timestamp,
-        sync=sync)
+        replace=False,
+        token=self.token)
+
+  def _CompactColumns(self, block_start):
+    """Merges the columns cells of a block into a cell at its start."""
+    block_end = block_start + self.COLUMNS_BLOCK_SIZE - 1
+
+    # Points of every column, keyed by predicate and the column's key.
+    merged = {}
+    for (predicate, _), block in sorted(
+        self._ReadColumns((block_start, block_end)).iteritems(),
+        key=lambda x: x[0][1]):
+      columns = merged.setdefault(predicate, {})
+      for column in block.columns:
+        if column.key not in columns:
+          columns[column.key] = (StatsStoreColumn(
+              fields_values=list(column.fields_values),
+              value_type=column.value_type), [])
+        columns[column.key][1].extend(column.GetPoints())
+
+    if not merged:
+      return
+
+    to_set = {}
+    for predicate, columns in merged.iteritems():
+      block = StatsStoreColumns()
+      for column, points in columns.itervalues():
+        column.SetPoints(points)
+        block.columns.Append(column)
+      to_set[predicate] = [block.SerializeToString()]
+
+    with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
+      mutation_pool.DeleteAttributes(
+          self.urn, to_set.keys(), start=block_start, end=block_end)
+      mutation_pool.MultiSet(
+          self.urn, to_set, timestamp=block_start, replace=False)
 
   def DeleteStats(self, timestamp=ALL_TIMESTAMPS, sync=False):
     """Deletes all stats in the given time range."""
@@ -221,6 +439,42 @@ class StatsStoreProcessData(aff4.AFF4Object):
     data_store.DB.DeleteAttributes(
         self.urn, predicates, start=start, end=end, token=self.token, sync=sync)
 
+    if config_lib.CONFIG["StatsStore.storage_format"] != "attributes":
+      self._DeleteColumns(start=start, end=end)
+
+  def _DeleteColumns(self, start=None, end=None):
+    """Deletes the values in the given time range from the columns blocks."""
+    if start is None and end is None:
+      blocks = self._ReadColumns(self.ALL_TIMESTAMPS)
+    else:
+      start = int(start or 0)
+      end = int(end)
+      blocks = self._ReadColumns((self.ColumnsBlockStart(start), end))
+
+    if not blocks:
+      return
+
+    with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
+      for (predicate, cell_timestamp), block in blocks.iteritems():
+        mutation_pool.DeleteAttributes(
+            self.urn, [predicate], start=cell_timestamp, end=cell_timestamp)
+
+        remaining = StatsStoreColumns()
+        for column in block.columns:
+          points = [(value, ts) for value, ts in column.GetPoints()
+                    if start is not None and not start <= ts <= end]
+          if points:
+            column.SetPoints(points)
+            remaining.columns.Append(column)
+
+        if remaining.columns:
+          mutation_pool.Set(
+              self.urn,
+              predicate,
+              remaining.SerializeToString(),
+              timestamp=cell_timestamp,
+              replace=False)
+
 
 class StatsStore(aff4.AFF4Volume):
   """Implementation of the long-term storage of collected stats data.
@@ -327,6 +581,14 @@ class StatsStore(aff4.AFF4Volume):
         self.DATA_STORE_ROOT.Add(process_id) for process_id in process_ids
     ]
 
+    if config_lib.CONFIG["StatsStore.storage_format"] == "columnar":
+      return self._MultiReadColumns(
+          subjects,
+          multi_metadata,
+          metric_name=metric_name,
+          timestamp=timestamp,
+          limit=limit)
+
     multi_query_results = data_store.DB.MultiResolvePrefix(
         subjects,
         StatsStoreProcessData.STATS_STORE_PREFIX + (metric_name or ""),
@@ -357,17 +619,79 @@ class StatsStore(aff4.AFF4Volume):
           for stored_field_value in stored_value.fields_values:
             fields_values.append(stored_field_value.value)
 
-          current_dict = part_results.setdefault(metric_name, {})
-          for field_value in fields_values[:-1]:
-            new_dict = {}
-            current_dict.setdefault(field_value, new_dict)
-            current_dict = new_dict
+        result_values_list = self._GetResultValuesList(
+            part_results, metric_name, metadata, fields_values)
+        result_values_list.append((stored_value.value, timestamp))
 
-          result_values_list = current_dict.setdefault(fields_values[-1], [])
-        else:
-          result_values_list = part_results.setdefault(metric_name, [])
+      results[subject.Basename()] = part_results
 
-        result_values_list.append((stored_value.value, timestamp))
+    return results
+
+  def _GetResultValuesList(self, part_results, metric_name, metadata,
+                           fields_values):
+    """Returns the list the values of a metric series are collected in."""
+    if not metadata.fields_defs:
+      return part_results.setdefault(metric_name, [])
+
+    current_dict = part_results.setdefault(metric_name, {})
+    for field_value in fields_values[:-1]:
+      new_dict = {}
+      current_dict.setdefault(field_value, new_dict)
+      current_dict = new_dict
+
+    return current_dict.setdefault(fields_values[-1], [])
+
+  def _MultiReadColumns(self,
+                        subjects,
+                        multi_metadata,
+                        metric_name=None,
+                        timestamp=ALL_TIMESTAMPS,
+                        limit=10000):
+    """Reads historical data stored in the columnar format."""
+    start = end = None
+    query_timestamp = timestamp
+    if timestamp not in [self.ALL_TIMESTAMPS, self.NEWEST_TIMESTAMP]:
+      start, end = [int(t) for t in timestamp]
+      # The block holding the first values starts before the range.
+      query_timestamp = (StatsStoreProcessData.ColumnsBlockStart(start), end)
+
+    multi_query_results = data_store.DB.MultiResolvePrefix(
+        subjects,
+        StatsStoreProcessData.STATS_STORE_COLUMNS_PREFIX + (metric_name or ""),
+        token=self.token,
+        timestamp=query_timestamp,
+        limit=limit)
+
+    results = {}
+    for subject, subject_results in multi_query_results:
+      subject = rdfvalue.RDFURN(subject)
+      subject_results = sorted(subject_results, key=lambda x: x[2])
+      subject_metadata_map = multi_metadata.get(
+          subject.Basename(), StatsStoreMetricsMetadata()).AsDict()
+
+      part_results = {}
+      for predicate, value_string, _ in subject_results:
+        metric_name = predicate[len(
+            StatsStoreProcessData.STATS_STORE_COLUMNS_PREFIX):]
+
+        try:
+          metadata = subject_metadata_map[metric_name]
+        except KeyError:
+          continue
+
+        block = StatsStoreColumns.FromSerializedString(value_string)
+        for column in block.columns:
+          points = column.GetPoints()
+          if start is not None:
+            points = [(value, ts) for value, ts in points
+                      if start <= ts <= end]
+          elif timestamp == self.NEWEST_TIMESTAMP:
+            points = points[-1:]
+
+          if points:
+            result_values_list = self._GetResultValuesList(
+                part_results, metric_name, metadata, list(column.key))
+            result_values_list.extend(points)
 
       results[subject.Basename()] = part_results
 
@@ -451,6 +451,162 @@ class StatsStoreTest(test_lib.AFF4ObjectTest):
     self.assertTrue("counter" in metadata_by_id["pid2"].AsDict())
 
 
+class ColumnarStatsStoreTest(test_lib.AFF4ObjectTest):
+  """Tests for the columnar storage format of StatsStore."""
+
+  HOUR = 3600 * 1000000
+
+  def setUp(self):
+    super(ColumnarStatsStoreTest, self).setUp()
+
+    self.config_overrider = test_lib.ConfigOverrider({
+        "StatsStore.storage_format": "columnar"
+    })
+    self.config_overrider.Start()
+
+    self.process_id = "some_pid"
+    self.stats_store = aff4.FACTORY.Create(
+        None, stats_store.StatsStore, mode="w", token=self.token)
+
+  def tearDown(self):
+    self.config_overrider.Stop()
+    super(ColumnarStatsStoreTest, self).tearDown()
+
+  def _GetRow(self):
+    return data_store.DB.ResolvePrefix(
+        "aff4:/stats_store/some_pid",
+        "",
+        timestamp=data_store.DB.ALL_TIMESTAMPS,
+        token=self.token)
+
+  def testValuesOfAnHourAreCompactedIntoSingleAttributeVersion(self):
+    stats.STATS.RegisterCounterMetric("counter")
+
+    for timestamp in [42, 43, self.HOUR + 42]:
+      stats.STATS.IncrementCounter("counter")
+      self.stats_store.WriteStats(
+          process_id=self.process_id, timestamp=timestamp, sync=True)
+
+    row = self._GetRow()
+    self.assertFalse([x for x in row if x[0] == "aff4:stats_store/counter"])
+
+    blocks = sorted((x[2], x[1]) for x in row
+                    if x[0] == "aff4:stats_store_columns/counter")
+    self.assertEqual([ts for ts, _ in blocks], [0, self.HOUR + 42])
+
+    columns = stats_store.StatsStoreColumns.FromSerializedString(blocks[0][1])
+    self.assertEqual(len(columns.columns), 1)
+    self.assertEqual(columns.columns[0].GetPoints(), [(1, 42), (2, 43)])
+
+  def testWritesOfCurrentHourDoNotRewritePreviousValues(self):
+    stats.STATS.RegisterCounterMetric("counter")
+
+    for timestamp in [42, 43, 44]:
+      stats.STATS.IncrementCounter("counter")
+      self.stats_store.WriteStats(
+          process_id=self.process_id, timestamp=timestamp, sync=True)
+
+    blocks = sorted((x[2], x[1]) for x in self._GetRow()
+                    if x[0] == "aff4:stats_store_columns/counter")
+    self.assertEqual([ts for ts, _ in blocks], [42, 43, 44])
+
+    columns = stats_store.StatsStoreColumns.FromSerializedString(blocks[2][1])
+    self.assertEqual(columns.columns[0].GetPoints(), [(3, 44)])
+
+    stats_history = self.stats_store.ReadStats(process_id=self.process_id)
+    self.assertEqual(stats_history["counter"], [(1, 42), (2, 43), (3, 44)])
+
+  def testColumnAppendPointExtendsPackedValues(self):
+    column = stats_store.StatsStoreColumn(
+        value_type=stats.MetricMetadata.ValueType.INT)
+    column.SetPoints([(1, 42), (2, 50)])
+    column.AppendPoint(3, 70)
+
+    self.assertEqual(column.GetPoints(), [(1, 42), (2, 50), (3, 70)])
+
+  def testDualFormatWritesBothFormats(self):
+    stats.STATS.RegisterCounterMetric("counter")
+    stats.STATS.IncrementCounter("counter")
+
+    with test_lib.ConfigOverrider({"StatsStore.storage_format": "dual"}):
+      self.stats_store.WriteStats(
+          process_id=self.process_id, timestamp=42, sync=True)
+
+    predicates = [x[0] for x in self._GetRow()]
+    self.assertTrue("aff4:stats_store/counter" in predicates)
+    self.assertTrue("aff4:stats_store_columns/counter" in predicates)
+
+  def testValuesAreFetchedCorrectly(self):
+    stats.STATS.RegisterCounterMetric("counter", fields=[("source", str)])
+    stats.STATS.RegisterGaugeMetric("float_gauge", float)
+    stats.STATS.RegisterGaugeMetric("str_gauge", str)
+    stats.STATS.RegisterEventMetric("foo_event")
+    stats.STATS.SetGaugeValue("float_gauge", 0.5)
+    stats.STATS.SetGaugeValue("str_gauge", "foo")
+
+    stats.STATS.IncrementCounter("counter", fields=["http"])
+    stats.STATS.RecordEvent("foo_event", 5)
+    self.stats_store.WriteStats(
+        process_id=self.process_id, timestamp=42, sync=True)
+
+    stats.STATS.IncrementCounter("counter", fields=["http"])
+    stats.STATS.IncrementCounter("counter", fields=["rpc"])
+    stats.STATS.RecordEvent("foo_event", 15)
+    self.stats_store.WriteStats(
+        process_id=self.process_id, timestamp=self.HOUR + 43, sync=True)
+
+    stats_history = self.stats_store.ReadStats(
+        process_id=self.process_id, timestamp=self.stats_store.ALL_TIMESTAMPS)
+    self.assertEqual(stats_history["counter"]["http"],
+                     [(1, 42), (2, self.HOUR + 43)])
+    self.assertEqual(stats_history["counter"]["rpc"], [(1, self.HOUR + 43)])
+    self.assertEqual(stats_history["float_gauge"],
+                     [(0.5, 42), (0.5, self.HOUR + 43)])
+    self.assertEqual(stats_history["str_gauge"],
+                     [("foo", 42), ("foo", self.HOUR + 43)])
+    self.assertEqual([(d.count, d.sum) for d, _ in stats_history["foo_event"]],
+                     [(1, 5), (2, 20)])
+
+  def testFetchedValuesCanBeLimitedByTimeRange(self):
+    stats.STATS.RegisterCounterMetric("counter")
+
+    for timestamp in [42, 43, self.HOUR + 42]:
+      stats.STATS.IncrementCounter("counter")
+      self.stats_store.WriteStats(
+          process_id=self.process_id, timestamp=timestamp, sync=True)
+
+    stats_history = self.stats_store.ReadStats(
+        process_id=self.process_id, timestamp=(43, self.HOUR + 42))
+    self.assertEqual(stats_history["counter"], [(2, 43), (3, self.HOUR + 42)])
+
+    stats_history = self.stats_store.ReadStats(
+        process_id=self.process_id, timestamp=(0, 42))
+    self.assertEqual(stats_history["counter"], [(1, 42)])
+
+  def testDeleteStatsInTimeRangeWorksCorrectly(self):
+    stats.STATS.RegisterCounterMetric("counter")
+
+    for timestamp in [42, 44, self.HOUR + 42]:
+      stats.STATS.IncrementCounter("counter")
+      self.stats_store.WriteStats(
+          process_id=self.process_id, timestamp=timestamp, sync=True)
+
+    self.stats_store.DeleteStats(
+        process_id=self.process_id, timestamp=(0, 43), sync=True)
+
+    stats_history = self.stats_store.ReadStats(process_id=self.process_id)
+    self.assertEqual(stats_history["counter"], [(2, 44), (3, self.HOUR + 42)])
+
+    self.stats_store.DeleteStats(
+        process_id=self.process_id, timestamp=(0, self.HOUR), sync=True)
+
+    stats_history = self.stats_store.ReadStats(process_id=self.process_id)
+    self.assertEqual(stats_history["counter"], [(3, self.HOUR + 42)])
+    blocks = [x for x in self._GetRow()
+              if x[0] == "aff4:stats_store_columns/counter"]
+    self.assertEqual(len(blocks), 1)
+
+
 class StatsStoreDataQueryTest(test_lib.AFF4ObjectTest):
   """Tests for StatsStoreDataQuery class."""
 
@@ -518,6 +518,52 @@ class AFF4ImageTest(test_lib.AFF4ObjectTest):
 
     self.assertEqual(count, 0)
 
+  @mock.patch.object(aff4.AFF4Image, "MULTI_STREAM_CHUNKS_READ_AHEAD", 1)
+  def testMultiStreamPrefetchingPreservesOrder(self):
+    for i in range(5):
+      with aff4.FACTORY.Create(
+          "aff4:/foo%d" % i, aff4_type=aff4.AFF4Image, token=self.token) as fd:
+        fd.SetChunksize(10)
+        fd.Write("%d" % i * 10 + "*" * 10 + "abcd")
+
+    fds = list(
+        aff4.FACTORY.MultiOpen(
+            ["aff4:/foo%d" % i for i in range(5)], token=self.token))
+    fds.sort(key=lambda fd: fd.urn)
+
+    results = []
+    for workers in [0, 4]:
+      with test_lib.ConfigOverrider({
+          "AFF4.multi_stream_prefetch_workers": workers
+      }):
+        results.append([(fd.urn, chunk, e)
+                        for fd, chunk, e in aff4.AFF4Stream.MultiStream(fds)])
+
+    self.assertEqual(results[0], results[1])
+    self.assertEqual(len(results[1]), 15)
+    self.assertEqual(results[1][3], (fds[1].urn, "1" * 10, None))
+
+  @mock.patch.object(aff4.AFF4Image, "MULTI_STREAM_CHUNKS_READ_AHEAD", 1)
+  def testMultiStreamPrefetchingStaysWithinChunkBudget(self):
+    fetched = []
+
+    def Fetch(group):
+      fetched.append(group)
+      return {}
+
+    with test_lib.ConfigOverrider({
+        "AFF4.multi_stream_prefetch_workers": 4,
+        "AFF4.multi_stream_max_chunks_in_flight": 3
+    }):
+      for i, (group, _) in enumerate(
+          aff4.AFF4Image._PrefetchChunkGroups(
+              ((chunk, None) for chunk in range(20)), Fetch)):
+        self.assertEqual(group, [(i, None)])
+        # The group being consumed counts against the budget too.
+        self.assertLessEqual(len(fetched) - i, 3)
+
+    self.assertEqual(len(fetched), 20)
+
 
 @mock.patch.object(aff4.AFF4Stream, "MULTI_STREAM_CHUNK_SIZE", 10)
 class AFF4StreamTest(test_lib.AFF4ObjectTest):
@@ -773,6 +819,32 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
     obj = aff4.FACTORY.Open("foobar", token=self.token)
     self.assertEqual(obj.Get(obj.Schema.STORED), "bar")
 
+  def testShardedCacheIsInvalidatedOnWrite(self):
+    with test_lib.ConfigOverrider({"AFF4.cache_type": "ShardedAgeBasedCache"}):
+      factory = aff4.Factory()
+
+    with utils.Stubber(aff4, "FACTORY", factory):
+      with aff4.FACTORY.Create(
+          "aff4:/foo:bar", aff4.AFF4Object, token=self.token) as obj:
+        obj.Set(obj.Schema.STORED("foo"))
+      with aff4.FACTORY.Create(
+          "aff4:/foo", aff4.AFF4Object, token=self.token) as obj:
+        obj.Set(obj.Schema.STORED("foo"))
+
+      # Populate the cache.
+      for urn in ["aff4:/foo", "aff4:/foo:bar"]:
+        obj = aff4.FACTORY.Open(urn, token=self.token)
+        self.assertEqual(obj.Get(obj.Schema.STORED), "foo")
+      self.assertGreater(aff4.FACTORY.CacheStats()["bytes"], 0)
+
+      with aff4.FACTORY.Open("aff4:/foo", mode="rw", token=self.token) as obj:
+        obj.Set(obj.Schema.STORED("bar"))
+
+      obj = aff4.FACTORY.Open("aff4:/foo", token=self.token)
+      self.assertEqual(obj.Get(obj.Schema.STORED), "bar")
+      obj = aff4.FACTORY.Open("aff4:/foo:bar", token=self.token)
+      self.assertEqual(obj.Get(obj.Schema.STORED), "foo")
+
   def testFlushNewestTime(self):
     """Flush with age policy NEWEST_TIME should only keep a single version."""
     # Create an object to carry attributes
@@ -2241,6 +2313,49 @@ class ForemanTests(test_lib.AFF4ObjectTest):
         rules = foreman.Get(foreman.Schema.RULES)
         self.assertEqual(len(rules), num_rules)
 
+  def testAssignTasksToClientsCompilesRulesOnce(self):
+    client_ids = ["C.00000000000000%d1" % i for i in range(4)]
+    for i, client_id in enumerate(client_ids):
+      fd = aff4.FACTORY.Create(
+          client_id, aff4_grr.VFSGRRClient, token=self.token)
+      fd.Set(fd.Schema.SYSTEM,
+             rdfvalue.RDFString("Windows 7" if i % 2 else "Linux"))
+      fd.Close()
+
+    with utils.Stubber(flow.GRRFlow, "StartFlow", self.StartFlow):
+      now = time.time() * 1e6
+      expires = (time.time() + 3600) * 1e6
+      foreman = aff4.FACTORY.Open("aff4:/foreman", mode="rw", token=self.token)
+
+      rule = rdf_foreman.ForemanRule(
+          created=int(now), expires=int(expires), description="Test rule")
+      rule.client_rule_set = rdf_foreman.ForemanClientRuleSet(rules=[
+          rdf_foreman.ForemanClientRule(
+              rule_type=rdf_foreman.ForemanClientRule.Type.OS,
+              os=rdf_foreman.ForemanOsClientRule(os_windows=True))
+      ])
+      rule.actions.Append(
+          flow_name="Test Flow", argv=rdf_protodict.Dict(foo="bar"))
+
+      rule_set = foreman.Schema.RULES()
+      rule_set.Append(rule)
+      foreman.Set(foreman.Schema.RULES, rule_set)
+      foreman.Close()
+
+      self.clients_launched = []
+      with test_lib.Instrument(rdf_foreman, "ForemanRuleIndex") as index:
+        self.assertEqual(foreman.AssignTasksToClients(client_ids[:2]), 1)
+        self.assertEqual(foreman.AssignTasksToClients(client_ids[2:]), 1)
+        # Clients are only checked against rules created since the last check.
+        self.assertEqual(foreman.AssignTasksToClients(client_ids), 0)
+
+      # The rules did not change, so they were only compiled once.
+      self.assertEqual(index.call_count, 1)
+      self.assertEqual([client_id for client_id, _ in self.clients_launched], [
+          rdf_client.ClientURN(client_ids[1]),
+          rdf_client.ClientURN(client_ids[3])
+      ])
+
 
 def main(argv):
   # Run the full test suite
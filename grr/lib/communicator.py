@@ -2,11 +2,12 @@
 """Abstracts encryption and authentication."""
 
 
+import hashlib
 import struct
 import time
-import zlib
 
 
+from grr.lib import compression
 from grr.lib import config_lib
 from grr.lib import rdfvalue
 from grr.lib import registry
@@ -29,6 +30,10 @@ class CommunicatorInit(registry.InitHook):
     stats.STATS.RegisterCounterMetric("grr_authenticated_messages")
     stats.STATS.RegisterCounterMetric("grr_unauthenticated_messages")
     stats.STATS.RegisterCounterMetric("grr_rsa_operations")
+    stats.STATS.RegisterCounterMetric("grr_cipher_cache_hits")
+    stats.STATS.RegisterCounterMetric("grr_cipher_cache_misses")
+    stats.STATS.RegisterCounterMetric(
+        "grr_cipher_cache_saved_time", units="MICROSECONDS")
 
 
 class Error(stats.CountingExceptionMixin, Exception):
@@ -117,6 +122,9 @@ class Cipher(object):
 class ReceivedCipher(Cipher):
   """A cipher which we received from our peer."""
 
+  # Microseconds spent decrypting and verifying this cipher.
+  setup_time = 0
+
   # pylint: disable=super-init-not-called
   def __init__(self, response_comms, private_key):
     self.private_key = private_key
@@ -281,26 +289,51 @@ class Communicator(object):
     self.private_key = private_key
     self.certificate = certificate
 
-    # A cache for encrypted ciphers
-    self.encrypted_cipher_cache = utils.FastStore(max_size=50000)
+    # A cache of received ciphers which were already decrypted and verified,
+    # keyed by a hash of the encrypted cipher and its metadata.
+    self.encrypted_cipher_cache = utils.TimeBasedCache(
+        max_size=50000, max_age=24 * 3600)
 
     # A cache of public keys
     self.pub_key_cache = utils.FastStore(max_size=50000)
 
-  def EncodeMessageList(self, message_list, signed_message_list):
+    # The compression types our peers announced they accept.
+    self.accepted_compression_cache = utils.FastStore(max_size=50000)
+
+  @staticmethod
+  def _PeerKey(peer):
+    """Normalizes a peer CN or urn so both name the same cache entry."""
+    return str(rdfvalue.RDFURN(peer))
+
+  def EncodeMessageList(self,
+                        message_list,
+                        signed_message_list,
+                        destination=None,
+                        api_version=3):
     """Encode the MessageList into the signed_message_list rdfvalue."""
     # By default uncompress
     uncompressed_data = message_list.SerializeToString()
     signed_message_list.message_list = uncompressed_data
+    signed_message_list.accepted_compression = (
+        compression.AcceptedCompression(api_version))
+
+    try:
+      accepted_compression = self.accepted_compression_cache.Get(
+          self._PeerKey(destination))
+    except KeyError:
+      accepted_compression = None
 
-    if config_lib.CONFIG["Network.compression"] == "ZCOMPRESS":
-      compressed_data = zlib.compress(uncompressed_data)
+    codec = compression.SelectCodec(config_lib.CONFIG["Network.compression"],
+                                    api_version, accepted_compression)
+    if codec is None:
+      return
 
-      # Only compress if it buys us something.
-      if len(compressed_data) < len(uncompressed_data):
-        signed_message_list.compression = (
-            rdf_flows.SignedMessageList.CompressionType.ZCOMPRESSION)
-        signed_message_list.message_list = compressed_data
+    compressed_data = codec.Compress(uncompressed_data)
+
+    # Only compress if it buys us something.
+    if len(compressed_data) < len(uncompressed_data):
+      signed_message_list.compression = codec.compression_type
+      signed_message_list.message_list = compressed_data
 
   def EncodeMessages(self,
                      message_list,
@@ -355,7 +388,11 @@ class Communicator(object):
       self.cipher_cache.Put(destination, cipher)
 
     signed_message_list = rdf_flows.SignedMessageList(timestamp=timestamp)
-    self.EncodeMessageList(message_list, signed_message_list)
+    self.EncodeMessageList(
+        message_list,
+        signed_message_list,
+        destination=destination,
+        api_version=api_version)
 
     result.encrypted_cipher_metadata = cipher.encrypted_cipher_metadata
 
@@ -416,19 +453,16 @@ class Communicator(object):
     Raises:
       DecodingError: If decompression fails.
     """
-    compression = signed_message_list.compression
-    if compression == rdf_flows.SignedMessageList.CompressionType.UNCOMPRESSED:
-      data = signed_message_list.message_list
-
-    elif (compression ==
-          rdf_flows.SignedMessageList.CompressionType.ZCOMPRESSION):
-      try:
-        data = zlib.decompress(signed_message_list.message_list)
-      except zlib.error as e:
-        raise DecodingError("Failed to decompress: %s" % e)
-    else:
+    try:
+      codec = compression.GetDecoder(signed_message_list.compression)
+    except KeyError:
       raise DecodingError("Compression scheme not supported")
 
+    try:
+      data = codec.Decompress(signed_message_list.message_list)
+    except compression.DecompressionError as e:
+      raise DecodingError("Failed to decompress: %s" % e)
+
     try:
       result = rdf_flows.MessageList.FromSerializedString(data)
     except rdfvalue.DecodeError:
@@ -436,6 +470,15 @@ class Communicator(object):
 
     return result
 
+  def _EncryptedCipherCacheKey(self, response_comms):
+    """Returns the encrypted_cipher_cache key for the session of the comms."""
+    encrypted_cipher = response_comms.encrypted_cipher or ""
+    encrypted_cipher_metadata = response_comms.encrypted_cipher_metadata or ""
+    # The length prefix keeps the boundary between the two fields unambiguous.
+    return hashlib.sha256(
+        struct.pack("<I", len(encrypted_cipher)) + encrypted_cipher +
+        encrypted_cipher_metadata).digest()
+
   def DecodeMessages(self, response_comms):
     """Extract and verify server message.
 
@@ -450,27 +493,35 @@ class Communicator(object):
     """
     # Have we seen this cipher before?
     cipher_verified = False
+    cache_key = self._EncryptedCipherCacheKey(response_comms)
     try:
-      cipher = self.encrypted_cipher_cache.Get(response_comms.encrypted_cipher)
+      cipher = self.encrypted_cipher_cache.Get(cache_key)
       # Even though we have seen this encrypted cipher already, we should still
       # make sure that all the other fields are sane and verify the HMAC.
       cipher.VerifyReceivedHMAC(response_comms)
       cipher_verified = True
+      stats.STATS.IncrementCounter("grr_cipher_cache_hits")
+      stats.STATS.IncrementCounter(
+          "grr_cipher_cache_saved_time", delta=cipher.setup_time)
 
       # If we have the cipher in the cache, we know the source and
       # should have a corresponding public key.
       source = cipher.GetSource()
       remote_public_key = self._GetRemotePublicKey(source)
     except KeyError:
+      stats.STATS.IncrementCounter("grr_cipher_cache_misses")
+      start_time = time.time()
       cipher = ReceivedCipher(response_comms, self.private_key)
 
       source = cipher.GetSource()
       try:
         remote_public_key = self._GetRemotePublicKey(source)
         if cipher.VerifyCipherSignature(remote_public_key):
-          # At this point we know this cipher is legit, we can cache it.
-          self.encrypted_cipher_cache.Put(response_comms.encrypted_cipher,
-                                          cipher)
+          # At this point we know this cipher is legit, we can cache it. Later
+          # packets of this session only need the HMAC check. We remember how
+          # long the RSA operations took so cache hits can report the saving.
+          cipher.setup_time = int((time.time() - start_time) * 1e6)
+          self.encrypted_cipher_cache.Put(cache_key, cipher)
           cipher_verified = True
 
       except UnknownClientCert:
@@ -494,6 +545,14 @@ class Communicator(object):
                                              response_comms.api_version,
                                              remote_public_key)
 
+    # Remember which codecs we may use for messages going back to the source.
+    # Only an authenticated peer may change them, otherwise anyone could pick
+    # the codecs we use towards a client by naming it as the source.
+    if auth_state == rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED:
+      self.accepted_compression_cache.Put(
+          self._PeerKey(source),
+          list(signed_message_list.accepted_compression))
+
     # Mark messages as authenticated and where they came from.
     for msg in message_list.job:
       msg.auth_state = auth_state
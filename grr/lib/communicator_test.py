@@ -136,6 +136,24 @@ class ClientCommsTest(test_lib.GRRBaseTest):
       self.assertEqual(decoded_messages[i].auth_state,
                        rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
 
+  def testUnauthenticatedMessagesDoNotSetAcceptedCompression(self):
+    """Only authenticated peers choose the codecs used towards them."""
+    self.ClientServerCommunicate()
+
+    self.assertRaises(KeyError,
+                      self.server_communicator.accepted_compression_cache.Get,
+                      self.server_communicator._PeerKey(
+                          self.client_communicator.common_name))
+
+  def testAuthenticatedMessagesSetAcceptedCompression(self):
+    self.MakeClientAFF4Record()
+    self.ClientServerCommunicate()
+
+    self.assertTrue(
+        self.server_communicator.accepted_compression_cache.Get(
+            self.server_communicator._PeerKey(
+                self.client_communicator.common_name)))
+
   def testClientPingAndClockIsUpdated(self):
     """Check PING and CLOCK are updated, simulate bad client clock."""
     new_client = self.MakeClientAFF4Record()
@@ -363,7 +381,8 @@ class HTTPClientTests(test_lib.GRRBaseTest):
     # And cache it in the server
     self.CreateNewServerCommunicator()
 
-    self.requests_stubber = utils.Stubber(requests, "request", self.UrlMock)
+    self.requests_stubber = utils.Stubber(requests.Session, "request",
+                                          self.UrlMock)
     self.requests_stubber.Start()
     self.sleep_stubber = utils.Stubber(time, "sleep", lambda x: None)
     self.sleep_stubber.Start()
@@ -642,12 +661,61 @@ class HTTPClientTests(test_lib.GRRBaseTest):
     self.assertEqual(
         stats.STATS.GetMetricValue("grr_rsa_operations"), metric_value)
 
+  def testCipherCacheStats(self):
+    """Repeat packets of a session are verified from the cipher cache."""
+    self.SendToServer()
+    self.client_communicator.RunOnce()
+    self.CheckClientQueue()
+
+    hits = stats.STATS.GetMetricValue("grr_cipher_cache_hits")
+    misses = stats.STATS.GetMetricValue("grr_cipher_cache_misses")
+    saved_time = stats.STATS.GetMetricValue("grr_cipher_cache_saved_time")
+
+    for _ in range(10):
+      self.SendToServer()
+      self.client_communicator.RunOnce()
+      self.CheckClientQueue()
+
+    # Client and server both decode from their cipher caches.
+    self.assertGreaterEqual(
+        stats.STATS.GetMetricValue("grr_cipher_cache_hits"), hits + 10)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("grr_cipher_cache_misses"), misses)
+    self.assertGreater(
+        stats.STATS.GetMetricValue("grr_cipher_cache_saved_time"), saved_time)
+
+  def testCompressionNegotiation(self):
+    """Codecs beyond the api baseline are used once the peer accepts them."""
+    compression_type = rdf_flows.SignedMessageList.CompressionType
+    with test_lib.ConfigOverrider({"Network.compression": "ZCOMPRESS_DICT"}):
+      with test_lib.Instrument(self.server_communicator,
+                               "DecompressMessageList") as server_decompress:
+        with test_lib.Instrument(self.client_communicator.communicator,
+                                 "DecompressMessageList") as client_decompress:
+          self.SendToServer()
+          self.client_communicator.RunOnce()
+          self.CheckClientQueue()
+
+          # The client does not know yet which codecs the server accepts, but
+          # its messages told the server.
+          self.assertEqual(server_decompress.args[-1][0].compression,
+                           compression_type.ZCOMPRESSION)
+          self.assertEqual(client_decompress.args[-1][0].compression,
+                           compression_type.ZCOMPRESSION_DICT)
+
+          self.SendToServer()
+          self.client_communicator.RunOnce()
+          self.CheckClientQueue()
+
+          self.assertEqual(server_decompress.args[-1][0].compression,
+                           compression_type.ZCOMPRESSION_DICT)
+
   def testCorruption(self):
     """Simulate corruption of the http payload."""
 
     self.corruptor_field = None
 
-    def Corruptor(url="", data=None, **kwargs):
+    def Corruptor(unused_session, url="", data=None, **kwargs):
       """Futz with some of the fields."""
       comm_cls = rdf_flows.ClientCommunication
       if data is not None:
@@ -681,7 +749,7 @@ class HTTPClientTests(test_lib.GRRBaseTest):
       data = self.client_communication.SerializeToString()
       return self.UrlMock(url=url, data=data, **kwargs)
 
-    with utils.Stubber(requests, "request", Corruptor):
+    with utils.Stubber(requests.Session, "request", Corruptor):
       self.SendToServer()
       status = self.client_communicator.RunOnce()
       self.assertEqual(status.code, 200)
@@ -709,18 +777,52 @@ class HTTPClientTests(test_lib.GRRBaseTest):
 
         self.assertEqual(status.code, 500)
 
+  def testServerOverloaded(self):
+    """Test that the client backs off as asked when the server is busy."""
+    overloaded = True
+
+    def BusyServer(unused_session, url=None, **kwargs):
+      if not overloaded or "server.pem" in url:
+        return self.UrlMock(url=url, **kwargs)
+
+      error = MakeHTTPException(503)
+      error.response.headers["Retry-After"] = "120"
+      raise error
+
+    timer = self.client_communicator.timer
+    timer.poll_max = 600
+    timer.FastPoll()
+
+    with utils.Stubber(requests.Session, "request", BusyServer):
+      self.SendToServer()
+      status = self.client_communicator.RunOnce()
+      self.assertEqual(status.code, 503)
+      self.assertEqual(status.retry_after, 120)
+      self.assertEqual(timer.sleep_time, 120)
+
+      # The server is reachable, so the messages are kept for the next poll.
+      self.assertEqual(len(self.messages), 0)
+      self.assertEqual(
+          self.client_communicator.http_manager.consecutive_connection_errors,
+          0)
+
+      overloaded = False
+      status = self.client_communicator.RunOnce()
+      self.assertEqual(status.code, 200)
+      self.assertEqual(len(self.messages), 10)
+
   def testClientRetransmission(self):
     """Test that client retransmits failed messages."""
     fail = True
     num_messages = 10
 
-    def FlakyServer(url=None, **kwargs):
+    def FlakyServer(unused_session, url=None, **kwargs):
       if not fail or "server.pem" in url:
         return self.UrlMock(num_messages=num_messages, url=url, **kwargs)
 
       raise MakeHTTPException(500)
 
-    with utils.Stubber(requests, "request", FlakyServer):
+    with utils.Stubber(requests.Session, "request", FlakyServer):
       self.SendToServer()
       status = self.client_communicator.RunOnce()
       self.assertEqual(status.code, 500)
@@ -744,6 +846,28 @@ class HTTPClientTests(test_lib.GRRBaseTest):
       # Server should have received 10 messages this time.
       self.assertEqual(len(self.messages), 10)
 
+  def testLargeUploadsAreSentBackToBack(self):
+    """Messages that do not fit in one post are sent in the next ones."""
+    post_sizer = self.client_communicator.post_sizer
+    post_sizer.min_size = post_sizer.size = 2500
+
+    for i in range(10):
+      self.client_communicator.client_worker.SendReply(
+          rdf_flows.GrrStatus(error_message="x" * 1000),
+          session_id=rdfvalue.SessionID("W:session"),
+          response_id=i)
+
+    sent = []
+    while True:
+      status = self.client_communicator.RunOnce()
+      self.assertEqual(status.code, 200)
+      sent.append(len(self.messages))
+      if not self.client_communicator.upload_pending:
+        break
+
+    self.assertEqual(sent[0], 3)
+    self.assertEqual(sum(sent), 10)
+
   def testClientStatsCollection(self):
     """Tests that the client stats are collected automatically."""
     now = 1000000
@@ -853,7 +977,7 @@ class HTTPClientTests(test_lib.GRRBaseTest):
   def testClientConnectionErrors(self):
     client_obj = comms.GRRHTTPClient()
     # Make the connection unavailable and skip the retry interval.
-    with utils.Stubber(requests, "request", self.RaiseError):
+    with utils.Stubber(requests.Session, "request", self.RaiseError):
       with test_lib.ConfigOverrider({"Client.connection_error_limit": 8}):
         # Simulate a client run. The client will retry the connection limit by
         # itself. The Run() method will quit when connection_error_limit is
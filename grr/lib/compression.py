@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+"""Compression codecs for the message lists exchanged with clients.
+
+SignedMessageList.compression names the codec the message_list field was
+compressed with. Every api version has a baseline of codecs which all
+endpoints speaking it can decode. Other codecs are only used towards a peer
+once it has announced that it accepts them in
+SignedMessageList.accepted_compression, so old and new endpoints can keep
+talking to each other.
+"""
+
+import collections
+import heapq
+import zlib
+
+
+# pylint: disable=g-import-not-at-top
+try:
+  import lz4.block as lz4_block
+except ImportError:
+  # lz4 is optional, without it the LZ4 codec is not offered to peers.
+  lz4_block = None
+# pylint: enable=g-import-not-at-top
+
+from grr.lib import registry
+from grr.lib.rdfvalues import flows as rdf_flows
+
+CompressionType = rdf_flows.SignedMessageList.CompressionType
+
+# The codecs every endpoint speaking an api version can decode.
+BASELINE_COMPRESSION = {
+    3: [CompressionType.UNCOMPRESSED, CompressionType.ZCOMPRESSION],
+}
+
+# Strings which make up most of the serialized GrrMessages exchanged with
+# clients. This is a raw content dictionary: the deflate stream of a message
+# continues from it, so any of these can be referenced from the first byte on.
+# Peers only agree on the dictionary through the ZCOMPRESSION_DICT wire type,
+# so a changed dictionary needs a new CompressionType value.
+GRR_MESSAGE_DICTIONARY = "".join([
+    # Paths commonly found in StatEntry and PathSpec payloads.
+    "C:\\Program Files\\", "C:\\Users\\", "C:\\Windows\\System32\\",
+    "HKEY_LOCAL_MACHINE\\SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\",
+    "HKEY_USERS\\", "/registry/HKEY_LOCAL_MACHINE/", "/fs/tsk/", "/fs/os/",
+    "/Library/", "/Users/", "/Applications/", "/System/Library/", "/var/log/",
+    "/var/lib/", "/tmp/", "/etc/", "/home/", "/root/", "/proc/", "/sys/",
+    "/dev/", "/lib/x86_64-linux-gnu/", "/usr/share/", "/usr/local/bin/",
+    "/usr/sbin/", "/usr/bin/", "/usr/lib/",
+    # Names of the client actions and the types of their responses.
+    "ExecuteBinaryCommand", "ExecuteCommand", "ExecutePython", "WmiQuery",
+    "EnumerateRunningServices", "EnumerateFilesystems", "EnumerateUsers",
+    "EnumerateInterfaces", "GetLibraryVersions", "GetConfiguration",
+    "GetPlatformInfo", "GetInstallDate", "GetClientInfo", "GetClientStats",
+    "GetClientStatsAuto", "SendStartupInfo", "ListProcesses", "Netstat",
+    "FingerprintFile", "HashFile", "Grep", "Find", "StatFile",
+    "IteratedListDirectory", "ListDirectory", "HashBuffer", "TransferBuffer",
+    "ClientInformation", "ClientStats", "CpuSample", "IOSample", "Uname",
+    "Interface", "NetworkAddress", "Filesystem", "Volume", "User", "Process",
+    "KnowledgeBase", "FingerprintResponse", "Dict", "KeyValue", "DataBlob",
+    "GrrStatus", "PathSpec", "BufferReference", "StatEntry",
+    # Urns of the flows and clients messages are exchanged between.
+    "aff4:/hunts/H:", ":Flow", "aff4:/flows/F:", "aff4:/flows/W:", "aff4:/C.",
+])
+
+
+class Error(Exception):
+  """Base class for all exceptions in this module."""
+
+
+class DecompressionError(Error):
+  """Raised when data can not be decompressed."""
+
+
+class CompressionCodec(object):
+  """Base class for compression codecs."""
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  # The Network.compression value selecting this codec.
+  name = None
+
+  # The SignedMessageList.CompressionType of the data this codec produces.
+  compression_type = None
+
+  @classmethod
+  def IsAvailable(cls):
+    """Returns False if the codec's dependencies are not installed."""
+    return True
+
+  def Compress(self, data):
+    raise NotImplementedError()
+
+  def Decompress(self, data):
+    """Decompresses data.
+
+    Args:
+      data: A string compressed with this codec.
+
+    Returns:
+      The uncompressed string.
+
+    Raises:
+      DecompressionError: If data is corrupt.
+    """
+    raise NotImplementedError()
+
+
+class UncompressedCodec(CompressionCodec):
+  """Leaves the data as it is."""
+
+  name = "UNCOMPRESSED"
+  compression_type = CompressionType.UNCOMPRESSED
+
+  def Compress(self, data):
+    return data
+
+  def Decompress(self, data):
+    return data
+
+
+class ZlibCodec(CompressionCodec):
+  """Compresses using the zlib.compress() function."""
+
+  name = "ZCOMPRESS"
+  compression_type = CompressionType.ZCOMPRESSION
+  level = zlib.Z_DEFAULT_COMPRESSION
+
+  def Compress(self, data):
+    return zlib.compress(data, self.level)
+
+  def Decompress(self, data):
+    try:
+      return zlib.decompress(data)
+    except zlib.error as e:
+      raise DecompressionError(e)
+
+
+class FastZlibCodec(ZlibCodec):
+  """Trades compression ratio for speed.
+
+  The output is a regular zlib stream, so every peer can decode it.
+  """
+
+  name = "ZCOMPRESS_FAST"
+  level = 1
+
+
+class DictionaryZlibCodec(CompressionCodec):
+  """Compresses using deflate primed with GRR_MESSAGE_DICTIONARY.
+
+  The zlib module of python 2 can not set a preset dictionary, so we compress
+  the dictionary itself, flush it to a byte boundary and keep the compressor
+  and decompressor states at that point. Every message is then a raw deflate
+  stream continuing from a copy of those states, free to refer back into the
+  dictionary.
+  """
+
+  name = "ZCOMPRESS_DICT"
+  compression_type = CompressionType.ZCOMPRESSION_DICT
+  level = zlib.Z_DEFAULT_COMPRESSION
+
+  def __init__(self, dictionary=GRR_MESSAGE_DICTIONARY):
+    # Negative window bits give raw deflate streams without a zlib header.
+    self.compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                       -zlib.MAX_WBITS)
+    prefix = (self.compressor.compress(dictionary) +
+              self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    self.decompressor.decompress(prefix)
+
+  def Compress(self, data):
+    compressor = self.compressor.copy()
+    return compressor.compress(data) + compressor.flush()
+
+  def Decompress(self, data):
+    decompressor = self.decompressor.copy()
+    try:
+      return decompressor.decompress(data) + decompressor.flush()
+    except zlib.error as e:
+      raise DecompressionError(e)
+
+
+class LZ4Codec(CompressionCodec):
+  """Compresses using the lz4 block format, much faster than zlib."""
+
+  name = "LZ4"
+  compression_type = CompressionType.LZ4COMPRESSION
+
+  @classmethod
+  def IsAvailable(cls):
+    return lz4_block is not None
+
+  def Compress(self, data):
+    # By default the uncompressed size is stored in front of the block.
+    return lz4_block.compress(data)
+
+  def Decompress(self, data):
+    try:
+      return lz4_block.decompress(data)
+    except (lz4_block.LZ4BlockError, ValueError) as e:
+      raise DecompressionError(e)
+
+
+# Codec instances by name and by the compression type they decode.
+_CODECS = None
+_DECODERS = None
+
+
+def _InitCodecs():
+  """Instantiates all available codecs."""
+  global _CODECS, _DECODERS  # pylint: disable=global-statement
+
+  codecs = {}
+  decoders = {}
+  for cls in CompressionCodec.classes.values():
+    if cls.name is None or not cls.IsAvailable():
+      continue
+
+    codec = cls()
+    codecs[cls.name] = codec
+    # Codecs producing the same compression type can all decode it.
+    decoders.setdefault(cls.compression_type, codec)
+
+  _DECODERS = decoders
+  _CODECS = codecs
+
+
+def GetCodec(name):
+  """Returns the codec called name, raises KeyError if it is not available."""
+  if _CODECS is None:
+    _InitCodecs()
+  return _CODECS[name]
+
+
+def GetDecoder(compression_type):
+  """Returns a codec for compression_type, raises KeyError if there is none."""
+  if _DECODERS is None:
+    _InitCodecs()
+  return _DECODERS[compression_type]
+
+
+def AcceptedCompression(api_version):
+  """Returns the compression types we decode beyond the api baseline."""
+  if _DECODERS is None:
+    _InitCodecs()
+
+  baseline = BASELINE_COMPRESSION.get(api_version, [])
+  return sorted(
+      compression_type for compression_type in _DECODERS
+      if compression_type not in baseline)
+
+
+def SelectCodec(name, api_version, accepted_compression=None):
+  """Selects the codec to compress data sent to a peer with.
+
+  Args:
+    name: The name of the configured codec.
+    api_version: The api version spoken with the peer.
+    accepted_compression: The compression types the peer announced it accepts
+      beyond the api baseline, if known.
+
+  Returns:
+    The configured codec if the peer can decode it, zlib if the peer can not,
+    or None if data should be sent uncompressed.
+  """
+  try:
+    codec = GetCodec(name)
+  except KeyError:
+    return None
+
+  usable = set(BASELINE_COMPRESSION.get(api_version, []))
+  usable.update(accepted_compression or [])
+  if codec.compression_type in usable:
+    return codec
+
+  if CompressionType.ZCOMPRESSION in usable:
+    return GetCodec(ZlibCodec.name)
+
+
+def TrainDictionary(samples, size=len(GRR_MESSAGE_DICTIONARY), segment_size=48,
+                    kmer_size=8):
+  """Builds a raw content dictionary from sample messages.
+
+  Segments of the samples are scored by how many samples share their k-mers
+  and the best ones are picked greedily, each k-mer counting only once. This
+  is the idea of the cover algorithm zstd trains dictionaries with.
+
+  Args:
+    samples: A list of serialized message lists.
+    size: The maximum size of the dictionary.
+    segment_size: The size of the segments the dictionary is made of.
+    kmer_size: The length of the substrings segments are scored by.
+
+  Returns:
+    A dictionary string for DictionaryZlibCodec.
+  """
+  # The number of samples each k-mer occurs in.
+  frequencies = collections.Counter()
+  for sample in samples:
+    frequencies.update(
+        set(sample[i:i + kmer_size]
+            for i in xrange(len(sample) - kmer_size + 1)))
+
+  def Score(segment):
+    # K-mers occurring in a single sample do not help compressing others.
+    return sum(
+        max(0, frequencies[kmer] - 1)
+        for kmer in set(segment[i:i + kmer_size]
+                        for i in xrange(len(segment) - kmer_size + 1)))
+
+  candidates = []
+  seen = set()
+  for sample in samples:
+    for start in xrange(0, max(1, len(sample) - segment_size + 1),
+                        segment_size // 2):
+      segment = sample[start:start + segment_size]
+      if segment not in seen:
+        seen.add(segment)
+        candidates.append((-Score(segment), segment))
+  heapq.heapify(candidates)
+
+  selected = []
+  total_size = 0
+  while candidates and total_size + segment_size <= size:
+    score, segment = heapq.heappop(candidates)
+    # Scores only drop as k-mers get covered, so a segment whose score is
+    # still up to date and at least as good as the next one is the best.
+    current = -Score(segment)
+    if current != score and candidates and current > candidates[0][0]:
+      heapq.heappush(candidates, (current, segment))
+      continue
+    if not current:
+      break
+
+    selected.append(segment)
+    total_size += len(segment)
+    for i in xrange(len(segment) - kmer_size + 1):
+      frequencies[segment[i:i + kmer_size]] = 0
+
+  # Matches closer to the data are cheaper, so the best segments go last.
+  return "".join(reversed(selected))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Tests for grr.lib.compression."""
+
+import zlib
+
+from grr.lib import client_fixture
+from grr.lib import compression
+from grr.lib import flags
+from grr.lib import queues
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.lib import utils
+from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
+
+CompressionType = rdf_flows.SignedMessageList.CompressionType
+
+
+def BuildCorpus(messages_per_list=20):
+  """Builds serialized MessageLists of StatEntry responses from the fixture."""
+  messages = []
+  for _, (_, attributes) in client_fixture.VFS:
+    attrs = attributes.get("aff4:stat")
+    if not attrs:
+      continue
+
+    stat = rdf_client.StatEntry.FromTextFormat(
+        utils.SmartStr(attrs % {"client_id": "C.1000000000000000"}))
+    messages.append(
+        rdf_flows.GrrMessage(
+            session_id=rdfvalue.SessionID(
+                base="aff4:/flows", queue=queues.FLOWS, flow_name="ABCDEF12"),
+            name="ListDirectory",
+            request_id=len(messages) // messages_per_list + 1,
+            response_id=len(messages) % messages_per_list + 1,
+            payload=stat,
+            source="aff4:/C.1000000000000000"))
+
+  corpus = []
+  for i in xrange(0, len(messages), messages_per_list):
+    message_list = rdf_flows.MessageList(job=messages[i:i + messages_per_list])
+    corpus.append(message_list.SerializeToString())
+
+  return corpus
+
+
+class CompressionTest(test_lib.GRRBaseTest):
+  """Tests the compression codecs."""
+
+  def testCodecsRoundTrip(self):
+    data = "".join(BuildCorpus())
+    for name in ["UNCOMPRESSED", "ZCOMPRESS", "ZCOMPRESS_FAST",
+                 "ZCOMPRESS_DICT", "LZ4"]:
+      try:
+        codec = compression.GetCodec(name)
+      except KeyError:
+        # LZ4 is only available when the lz4 module is installed.
+        self.assertEqual(name, "LZ4")
+        continue
+
+      for payload in ["", "x", data]:
+        compressed = codec.Compress(payload)
+        decoder = compression.GetDecoder(codec.compression_type)
+        self.assertEqual(decoder.Decompress(compressed), payload)
+
+  def testFastZlibIsReadableByEveryPeer(self):
+    data = "".join(BuildCorpus())
+    compressed = compression.GetCodec("ZCOMPRESS_FAST").Compress(data)
+    self.assertEqual(zlib.decompress(compressed), data)
+
+  def testDictionaryHelpsSmallMessages(self):
+    data = BuildCorpus(messages_per_list=1)[0]
+    self.assertLess(
+        len(compression.GetCodec("ZCOMPRESS_DICT").Compress(data)),
+        len(compression.GetCodec("ZCOMPRESS").Compress(data)))
+
+  def testCorruptData(self):
+    codec = compression.GetCodec("ZCOMPRESS_DICT")
+    with self.assertRaises(compression.DecompressionError):
+      codec.Decompress("\xff" * 20)
+
+  def testSelectCodec(self):
+    # Peers which did not announce anything only get the api baseline.
+    self.assertEqual(
+        compression.SelectCodec("ZCOMPRESS_DICT", 3).name, "ZCOMPRESS")
+    self.assertEqual(
+        compression.SelectCodec("ZCOMPRESS_DICT", 3,
+                                [CompressionType.ZCOMPRESSION_DICT]).name,
+        "ZCOMPRESS_DICT")
+    self.assertEqual(
+        compression.SelectCodec("ZCOMPRESS_FAST", 3).name, "ZCOMPRESS_FAST")
+    self.assertIsNone(compression.SelectCodec("SOMECRAZYCOMPRESSION", 3))
+    self.assertIsNone(compression.SelectCodec("ZCOMPRESS", 1))
+
+  def testAcceptedCompression(self):
+    accepted = compression.AcceptedCompression(3)
+    self.assertIn(CompressionType.ZCOMPRESSION_DICT, accepted)
+    self.assertNotIn(CompressionType.ZCOMPRESSION, accepted)
+
+  def testTrainDictionary(self):
+    corpus = BuildCorpus(messages_per_list=1)
+    dictionary = compression.TrainDictionary(corpus[::2], size=4096)
+    self.assertTrue(dictionary)
+    self.assertLessEqual(len(dictionary), 4096)
+
+    codec = compression.DictionaryZlibCodec(dictionary)
+    trained_size = sum(len(codec.Compress(data)) for data in corpus[1::2])
+    zlib_size = sum(len(zlib.compress(data)) for data in corpus[1::2])
+    self.assertLess(trained_size, zlib_size)
+
+
+class CompressionBenchmark(test_lib.AverageMicroBenchmarks):
+  """Compares compression ratio and CPU time of the codecs."""
+
+  REPEATS = 100
+
+  def testCodecs(self):
+    corpus = BuildCorpus()
+    samples = BuildCorpus(messages_per_list=1)
+    uncompressed_size = float(sum(len(data) for data in corpus))
+
+    codecs = [compression.GetCodec(name)
+              for name in ["ZCOMPRESS", "ZCOMPRESS_FAST", "ZCOMPRESS_DICT"]]
+    # A dictionary trained on every other message, to show what a dictionary
+    # trained on real traffic would buy over the built in one.
+    trained = compression.DictionaryZlibCodec(
+        compression.TrainDictionary(samples[::2]))
+    trained.name = "ZCOMPRESS_DICT (trained)"
+    codecs.append(trained)
+    if compression.LZ4Codec.IsAvailable():
+      codecs.append(compression.GetCodec("LZ4"))
+
+    for codec in codecs:
+
+      def Compress(codec=codec):
+        return sum(len(codec.Compress(data)) for data in corpus) / (
+            uncompressed_size)
+
+      compressed = [codec.Compress(data) for data in corpus]
+
+      def Decompress(codec=codec, compressed=compressed):
+        for data in compressed:
+          codec.Decompress(data)
+
+      self.TimeIt(Compress, name="Compress %s (ratio)" % codec.name)
+      self.TimeIt(Decompress, name="Decompress %s" % codec.name)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
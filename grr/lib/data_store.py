@@ -137,33 +137,8 @@ class MutationPool(object):
 
   def Flush(self):
     """Flushing actually applies all the operations in the pool."""
-    DB.DeleteSubjects(
-        self.delete_subject_requests, token=self.token, sync=False)
-
-    for req in self.delete_attributes_requests:
-      subject, attributes, start, end = req
-      DB.DeleteAttributes(
-          subject,
-          attributes,
-          start=start,
-          end=end,
-          token=self.token,
-          sync=False)
-
-    for req in self.set_requests:
-      subject, values, timestamp, replace, to_delete = req
-      DB.MultiSet(
-          subject,
-          values,
-          timestamp=timestamp,
-          replace=replace,
-          to_delete=to_delete,
-          token=self.token,
-          sync=False)
-
-    if (self.delete_subject_requests or self.delete_attributes_requests or
-        self.set_requests):
-      DB.Flush()
+    if self.Size():
+      DB.ApplyMutations(self)
 
     self.delete_subject_requests = []
     self.set_requests = []
@@ -659,6 +634,40 @@ class DataStore(object):
   def GetMutationPool(self, token=None):
     return self.mutation_pool_cls(token=token)
 
+  def ApplyMutations(self, mutation_pool):
+    """Applies all the mutations queued in a mutation pool.
+
+    Subjects are deleted first, then attributes, then the new values are
+    written. This default implementation replays the mutations one by one,
+    data stores that can apply a whole batch in a single transaction or
+    request should override it.
+
+    Args:
+      mutation_pool: The MutationPool holding the mutations to apply.
+    """
+    token = mutation_pool.token
+
+    self.DeleteSubjects(
+        mutation_pool.delete_subject_requests, token=token, sync=False)
+
+    for req in mutation_pool.delete_attributes_requests:
+      subject, attributes, start, end = req
+      self.DeleteAttributes(
+          subject, attributes, start=start, end=end, token=token, sync=False)
+
+    for req in mutation_pool.set_requests:
+      subject, values, timestamp, replace, to_delete = req
+      self.MultiSet(
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          to_delete=to_delete,
+          token=token,
+          sync=False)
+
+    self.Flush()
+
 
 class Transaction(object):
   """This abstracts operations on a subject which is locked.
@@ -1840,6 +1840,53 @@ class _DataStoreTest(test_lib.GRRBaseTest):
     self.assertEqual(stored, "hello")
     self.assertEqual(type(stored), str)
 
+  @DeletionTest
+  def testPoolAppliesAllMutations(self):
+    predicate = "metadata:predicate"
+    rows = ["aff4:/row:%s" % i for i in range(5)]
+    for row in rows:
+      data_store.DB.MultiSet(
+          row, {predicate: ["old"],
+                "aff4:size": [1]}, token=self.token)
+
+    pool = data_store.DB.GetMutationPool(token=self.token)
+    pool.DeleteSubject(rows[0])
+    pool.DeleteAttributes(rows[1], [predicate])
+    for row in rows[2:]:
+      pool.MultiSet(row, {predicate: ["new"]})
+    pool.MultiSet(rows[0], {predicate: ["recreated"]})
+
+    applied = []
+    apply_mutations = data_store.DB.ApplyMutations
+
+    def ApplyMutations(mutation_pool):
+      applied.append(mutation_pool.Size())
+      apply_mutations(mutation_pool)
+
+    # The whole pool is handed to the data store at once.
+    with utils.Stubber(data_store.DB, "ApplyMutations", ApplyMutations):
+      pool.Flush()
+    self.assertEqual(applied, [6])
+    self.assertEqual(pool.Size(), 0)
+
+    stored, _ = data_store.DB.Resolve(rows[0], predicate, token=self.token)
+    self.assertEqual(stored, "recreated")
+    stored, _ = data_store.DB.Resolve(rows[0], "aff4:size", token=self.token)
+    self.assertIsNone(stored)
+
+    stored, _ = data_store.DB.Resolve(rows[1], predicate, token=self.token)
+    self.assertIsNone(stored)
+    stored, _ = data_store.DB.Resolve(rows[1], "aff4:size", token=self.token)
+    self.assertEqual(stored, 1)
+
+    for row in rows[2:]:
+      values = list(
+          data_store.DB.ResolveMulti(
+              row, [predicate],
+              timestamp=data_store.DB.ALL_TIMESTAMPS,
+              token=self.token))
+      self.assertEqual([value for _, value, _ in values], ["new"])
+
   @DeletionTest
   def testPoolDeleteAttributes(self):
     predicate = "metadata:predicate"
@@ -178,6 +178,11 @@ class FakeDataStore(data_store.DataStore):
                  replace=replace,
                  sync=sync)
 
+  @utils.Synchronized
+  def ApplyMutations(self, mutation_pool):
+    # Holding the lock makes all the mutations visible at once.
+    super(FakeDataStore, self).ApplyMutations(mutation_pool)
+
   @utils.Synchronized
   def DeleteAttributes(self,
                        subject,
@@ -4,6 +4,7 @@
 
 import base64
 import binascii
+import collections
 import httplib
 import random
 import re
@@ -90,32 +91,48 @@ class DataServerConnection(object):
       left = n - len(ret)
     return ret
 
-  def _ReadReply(self):
+  def _ReadSerializedReply(self):
+    """Reads one serialized DataStoreResponse, or None on error."""
     try:
       replylen_str = self._ReadExactly(sutils.SIZE_PACKER.size)
       replylen = sutils.SIZE_PACKER.unpack(replylen_str)[0]
-      reply = self._ReadExactly(replylen)
-      response = rdf_data_store.DataStoreResponse.FromSerializedString(reply)
-      CheckResponseStatus(response)
-      return response
+      return self._ReadExactly(replylen)
     except (socket.error, socket.timeout, IOError) as e:
       logging.warning("Cannot read reply from server %s:%d : %s",
                       self.Address(), self.Port(), e)
       return None
 
+  def _ReadReply(self):
+    reply = self._ReadSerializedReply()
+    if reply is None:
+      return None
+
+    response = rdf_data_store.DataStoreResponse.FromSerializedString(reply)
+    CheckResponseStatus(response)
+    return response
+
   def _Sync(self):
     """Read responses from the pending requests."""
     self.sock.settimeout(config_lib.CONFIG["HTTPDataStore.read_timeout"])
+    replies = []
+    success = True
     while self.requests:
-      response = self._ReadReply()
-      if not response:
+      reply = self._ReadSerializedReply()
+      if reply is None:
         # Could not read response. Let's exit and force a reconnection
         # followed by a replay.
         # TODO(user): Maybe we need to assign an unique ID for each
         # request so that the server knows which ones were already applied.
-        return False
+        success = False
+        break
+      replies.append(reply)
       self.requests.pop()
-    return True
+
+    # Decode all the replies we got in one go.
+    for response in rdf_data_store.DataStoreResponse.ParseMany(replies):
+      CheckResponseStatus(response)
+
+    return success
 
   def _SendRequest(self, command):
     request_str = command.SerializeToString()
@@ -539,6 +556,20 @@ class HTTPDataStore(data_store.DataStore):
                        token=None):
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
 
+    request = self._MakeDeleteAttributesRequest(
+        subject, attributes, start=start, end=end, sync=sync, token=token)
+
+    typ = rdf_data_server.DataStoreCommand.Command.DELETE_ATTRIBUTES
+    self._MakeRequestSyncOrAsync(request, typ, sync)
+
+  def _MakeDeleteAttributesRequest(self,
+                                   subject,
+                                   attributes,
+                                   start=None,
+                                   end=None,
+                                   sync=True,
+                                   token=None):
+    """Builds the request for a DeleteAttributes command."""
     request = rdf_data_store.DataStoreRequest(subject=[subject])
 
     if isinstance(attributes, basestring):
@@ -563,18 +594,23 @@ class HTTPDataStore(data_store.DataStore):
     for attr in attributes:
       request.values.Append(attribute=attr)
 
-    typ = rdf_data_server.DataStoreCommand.Command.DELETE_ATTRIBUTES
-    self._MakeRequestSyncOrAsync(request, typ, sync)
+    return request
 
   def DeleteSubject(self, subject, sync=False, token=None):
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
 
+    request = self._MakeDeleteSubjectRequest(subject, token=token)
+
+    typ = rdf_data_server.DataStoreCommand.Command.DELETE_SUBJECT
+    self._MakeRequestSyncOrAsync(request, typ, sync)
+
+  def _MakeDeleteSubjectRequest(self, subject, token=None):
+    """Builds the request for a DeleteSubject command."""
     request = rdf_data_store.DataStoreRequest(subject=[subject])
     if token:
       request.token = token
 
-    typ = rdf_data_server.DataStoreCommand.Command.DELETE_SUBJECT
-    self._MakeRequestSyncOrAsync(request, typ, sync)
+    return request
 
   def _MakeRequest(self,
                    subjects,
@@ -687,6 +723,27 @@ class HTTPDataStore(data_store.DataStore):
     """MultiSet."""
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
 
+    request = self._MakeMultiSetRequest(
+        subject,
+        values,
+        timestamp=timestamp,
+        replace=replace,
+        sync=sync,
+        to_delete=to_delete,
+        token=token)
+
+    typ = rdf_data_server.DataStoreCommand.Command.MULTI_SET
+    self._MakeRequestSyncOrAsync(request, typ, sync)
+
+  def _MakeMultiSetRequest(self,
+                           subject,
+                           values,
+                           timestamp=None,
+                           replace=True,
+                           sync=True,
+                           to_delete=None,
+                           token=None):
+    """Builds the request for a MultiSet command."""
     request = rdf_data_store.DataStoreRequest(sync=sync)
     token = token or data_store.default_token
     if token:
@@ -728,8 +785,58 @@ class HTTPDataStore(data_store.DataStore):
         if v is not None:
           new_value.value.SetValue(v)
 
-    typ = rdf_data_server.DataStoreCommand.Command.MULTI_SET
-    self._MakeRequestSyncOrAsync(request, typ, sync)
+    return request
+
+  def ApplyMutations(self, mutation_pool):
+    """Sends all the mutations for a data server in a single command."""
+    token = mutation_pool.token or data_store.default_token
+    subjects = set(mutation_pool.delete_subject_requests)
+    subjects.update(req[0] for req in mutation_pool.delete_attributes_requests)
+    subjects.update(req[0] for req in mutation_pool.set_requests)
+    self.security_manager.CheckDataStoreAccess(token, list(subjects), "w")
+
+    command = rdf_data_server.DataStoreCommand.Command
+    mutations = []
+    for subject in mutation_pool.delete_subject_requests:
+      request = self._MakeDeleteSubjectRequest(subject, token=token)
+      mutations.append((subject, command.DELETE_SUBJECT, request))
+
+    for subject, attributes, start, end in (
+        mutation_pool.delete_attributes_requests):
+      request = self._MakeDeleteAttributesRequest(
+          subject, attributes, start=start, end=end, sync=False, token=token)
+      mutations.append((subject, command.DELETE_ATTRIBUTES, request))
+
+    for subject, values, timestamp, replace, to_delete in (
+        mutation_pool.set_requests):
+      request = self._MakeMultiSetRequest(
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          sync=False,
+          to_delete=to_delete,
+          token=token)
+      mutations.append((subject, command.MULTI_SET, request))
+
+    batches = collections.OrderedDict()
+    for subject, typ, request in mutations:
+      data_server = self.cache.Get(subject)
+      batch = batches.get(data_server)
+      if batch is None:
+        batch = rdf_data_server.DataStoreCommand(
+            command=command.APPLY_MUTATIONS,
+            request=rdf_data_store.DataStoreRequest())
+        if token:
+          batch.request.token = token
+        batches[data_server] = batch
+
+      batch.mutations.Append(command=typ, request=request)
+
+    for data_server, batch in batches.iteritems():
+      data_server.GetConnection().MakeRequestAndContinue(batch, None)
+
+    self.Flush()
 
   def ResolveMulti(self,
                    subject,
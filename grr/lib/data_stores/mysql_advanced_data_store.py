@@ -2,6 +2,7 @@
 # -*- mode: python; encoding: utf-8 -*-
 """An implementation of a data store based on mysql."""
 
+import collections
 import logging
 import Queue
 import thread
@@ -146,6 +147,10 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
   POOL = None
 
+  # The maximum number of (subject, attribute) pairs deleted by a single
+  # DELETE statement when replacing values.
+  REPLACE_DELETE_BATCH_SIZE = 1000
+
   def __init__(self):
     self.database_name = config_lib.CONFIG["Mysql.database_name"]
     # Use the global connection pool.
@@ -391,13 +396,53 @@ class MySQLAdvancedDataStore(data_store.DataStore):
                token=None):
     """Set multiple attributes' values for this subject in one operation."""
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
-    to_delete = set(to_delete or [])
-
-    # Prepare a bulk insert operation.
     subject = utils.SmartUnicode(subject)
+    to_replace, to_insert, to_delete = self._PrepareMultiSet(
+        subject, values, timestamp=timestamp, replace=replace,
+        to_delete=to_delete)
+
+    if to_delete:
+      self.DeleteAttributes(subject, to_delete, token=token)
+
+    if sync:
+      transaction = []
+      if to_replace:
+        transaction.extend(self._BuildReplaces(to_replace))
+      if to_insert:
+        transaction.extend(self._BuildInserts(to_insert))
+      if transaction:
+        self._ExecuteTransaction(transaction)
+    else:
+      if to_replace:
+        with self.buffer_lock:
+          self.to_replace.extend(to_replace)
+      if to_insert:
+        with self.buffer_lock:
+          self.to_insert.extend(to_insert)
+
+  def _PrepareMultiSet(self,
+                       subject,
+                       values,
+                       timestamp=None,
+                       replace=True,
+                       to_delete=None):
+    """Splits the values of a MultiSet into rows to replace and to insert.
+
+    Args:
+      subject: The subject as a unicode string.
+      values: A dict of attributes and values as passed to MultiSet.
+      timestamp: The default timestamp of the values.
+      replace: Bool whether or not to overwrite current records.
+      to_delete: An iterable of attributes to clear prior to setting.
+    Returns:
+      A tuple (to_replace, to_insert, to_delete) where to_replace and
+      to_insert are lists of [subject, attribute, data, timestamp] and
+      to_delete is the set of attributes that must be deleted because no new
+      value is written for them.
+    """
+    to_delete = set(to_delete or [])
     to_insert = []
     to_replace = []
-    transaction = []
 
     # Build a document for each unique timestamp.
     for attribute, sequence in values.items():
@@ -417,44 +462,70 @@ class MySQLAdvancedDataStore(data_store.DataStore):
         attribute = utils.SmartUnicode(attribute)
         data = self._Encode(value)
 
-        # Replacing means to delete all versions of the attribute first.
+        # Replacing means to delete all versions of the attribute first. We
+        # don't check for existing rows here, _BuildReplaces deletes all the
+        # replaced attributes in a single statement when the buffer is written.
         if replace or attribute in to_delete:
-          existing = self._CountExistingRows(subject, attribute)
-          if existing:
-            to_replace.append([subject, attribute, data, entry_timestamp])
-          else:
-            to_insert.append([subject, attribute, data, entry_timestamp])
+          to_replace.append([subject, attribute, data, entry_timestamp])
           if attribute in to_delete:
             to_delete.remove(attribute)
 
         else:
           to_insert.append([subject, attribute, data, entry_timestamp])
 
-    if to_delete:
-      self.DeleteAttributes(subject, to_delete, token=token)
+    return to_replace, to_insert, to_delete
 
-    if sync:
-      if to_replace:
-        transaction.extend(self._BuildReplaces(to_replace))
-      if to_insert:
-        transaction.extend(self._BuildInserts(to_insert))
-      if transaction:
-        self._ExecuteTransaction(transaction)
-    else:
-      if to_replace:
-        with self.buffer_lock:
-          self.to_replace.extend(to_replace)
-      if to_insert:
-        with self.buffer_lock:
-          self.to_insert.extend(to_insert)
+  def ApplyMutations(self, mutation_pool):
+    """Applies all the mutations of the pool in a single transaction."""
+    token = mutation_pool.token
+    subjects = set(mutation_pool.delete_subject_requests)
+    subjects.update(req[0] for req in mutation_pool.delete_attributes_requests)
+    subjects.update(req[0] for req in mutation_pool.set_requests)
+    self.security_manager.CheckDataStoreAccess(token, list(subjects), "w")
 
-  def _CountExistingRows(self, subject, attribute):
-    query = ("SELECT count(*) AS total FROM aff4 "
-             "WHERE subject_hash=unhex(md5(%s)) "
-             "AND attribute_hash=unhex(md5(%s))")
-    args = [subject, attribute]
-    result = self.ExecuteQuery(query, args)
-    return int(result[0]["total"])
+    transaction = []
+    for subject in mutation_pool.delete_subject_requests:
+      transaction.extend(self._BuildDelete(utils.SmartUnicode(subject)))
+
+    for req in mutation_pool.delete_attributes_requests:
+      subject, attributes, start, end = req
+      if isinstance(attributes, basestring):
+        raise ValueError(
+            "String passed to DeleteAttributes (non string iterable expected).")
+
+      timestamp = self._MakeTimestamp(start, end)
+      for attribute in attributes:
+        transaction.extend(
+            self._BuildDelete(
+                utils.SmartUnicode(subject),
+                utils.SmartUnicode(attribute), timestamp))
+
+    # Values buffered by earlier asynchronous writes go into the same
+    # transaction so they can't overwrite the newer values from the pool.
+    with self.buffer_lock:
+      to_replace = self.to_replace
+      to_insert = self.to_insert
+      self.to_replace = []
+      self.to_insert = []
+
+    for req in mutation_pool.set_requests:
+      subject, values, timestamp, replace, to_delete = req
+      subject = utils.SmartUnicode(subject)
+      replaces, inserts, deletes = self._PrepareMultiSet(
+          subject, values, timestamp=timestamp, replace=replace,
+          to_delete=to_delete)
+      for attribute in deletes:
+        transaction.extend(
+            self._BuildDelete(subject, utils.SmartUnicode(attribute)))
+      to_replace.extend(replaces)
+      to_insert.extend(inserts)
+
+    if to_replace:
+      transaction.extend(self._BuildReplaces(to_replace))
+    if to_insert:
+      transaction.extend(self._BuildInserts(to_insert))
+    if transaction:
+      self._ExecuteTransaction(transaction)
 
   @utils.Synchronized
   def Flush(self):
@@ -487,22 +558,46 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       self._ExecuteTransaction(transaction)
 
   def _BuildReplaces(self, values):
-    transaction = []
-    updates = {}
-    to_insert = []
+    """Build the queries to replace the given values.
+
+    All existing versions of the replaced (subject, attribute) pairs are
+    removed by batched DELETE statements, followed by one bulk insert of the
+    new values. If a pair is replaced more than once, the last value wins.
+
+    The pairs are matched with ORed equality conditions on the master index
+    rather than a (subject_hash, attribute_hash) IN row constructor, since
+    MySQL versions before 5.7.3 don't use the index for the latter.
+    Pairs that have no rows yet therefore only cost an index lookup.
+
+    Args:
+      values: A list of [subject, attribute, data, timestamp] lists.
+    Returns:
+      A list of queries to be executed in one transaction.
+    """
+    updates = collections.OrderedDict()
 
     for (subject, attribute, data, timestamp) in values:
-      updates.setdefault(subject, {})[attribute] = [data, timestamp]
-
-    for subject in updates:
-      for attribute in updates[subject]:
-        data = updates[subject][attribute][0]
-        timestamp = updates[subject][attribute][1]
-        to_insert.append([subject, attribute, data, timestamp])
-        delete_q = self._BuildDelete(subject, attribute)[0]
-        transaction.append(delete_q)
-    transaction.extend(self._BuildInserts(to_insert))
-    return transaction
+      updates[(subject, attribute)] = [data, timestamp]
+
+    pairs = updates.keys()
+    queries = []
+    for i in range(0, len(pairs), self.REPLACE_DELETE_BATCH_SIZE):
+      batch = pairs[i:i + self.REPLACE_DELETE_BATCH_SIZE]
+      delete_q = {
+          "query": "DELETE aff4 FROM aff4 WHERE %s" % " OR ".join(
+              ["(subject_hash=unhex(md5(%s)) AND "
+               "attribute_hash=unhex(md5(%s)))"] * len(batch)),
+          "args": []
+      }
+      for subject, attribute in batch:
+        delete_q["args"].extend([subject, attribute])
+      queries.append(delete_q)
+
+    to_insert = []
+    for (subject, attribute), (data, timestamp) in updates.iteritems():
+      to_insert.append([subject, attribute, data, timestamp])
+
+    return queries + self._BuildInserts(to_insert)
 
   def _BuildInserts(self, values):
     subjects_q = {}
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 """Benchmark tests for MySQL advanced data store."""
 
+import time
 
+from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
 from grr.lib import test_lib
+from grr.lib import utils
 from grr.lib.data_stores import mysql_advanced_data_store_test
 
 
@@ -13,6 +16,57 @@ class MysqlAdvancedDataStoreBenchmarks(
     data_store_test.DataStoreBenchmarks):
   """Benchmark the mysql data store abstraction."""
 
+  # Number of attributes written by each MultiSet, roughly what a VFSGRRClient
+  # flush writes.
+  ATTRIBUTES_PER_MULTISET = 20
+
+  def _CountStatements(self, callback):
+    """Runs callback and counts the statements sent to the server."""
+    statements = [0]
+    execute_query = data_store.DB.ExecuteQuery
+    execute_transaction = data_store.DB._ExecuteTransaction
+
+    def CountingExecuteQuery(query, args=None):
+      statements[0] += 1
+      return execute_query(query, args)
+
+    def CountingExecuteTransaction(transaction):
+      # START TRANSACTION and COMMIT are sent as well.
+      statements[0] += len(transaction) + 2
+      return execute_transaction(transaction)
+
+    with utils.MultiStubber(
+        (data_store.DB, "ExecuteQuery", CountingExecuteQuery),
+        (data_store.DB, "_ExecuteTransaction", CountingExecuteTransaction)):
+      callback()
+
+    return statements[0]
+
+  @test_lib.SetLabel("benchmark")
+  def testMultiSetReplaceRoundTrips(self):
+    """Statements issued per replacing MultiSet."""
+    self.units = "ms"
+    n = 100
+    values = dict(("metadata:attribute%d" % i, ["value%d" % i])
+                  for i in range(self.ATTRIBUTES_PER_MULTISET))
+
+    def WriteAll(sync):
+      for i in xrange(n):
+        data_store.DB.MultiSet(
+            "aff4:/C.%016X" % i, values, sync=sync, token=self.token)
+      data_store.DB.Flush()
+
+    for sync in [True, False]:
+      # The first round creates the rows, the second one replaces them.
+      for action in ["insert", "replace"]:
+        start_time = time.time()
+        statements = self._CountStatements(lambda: WriteAll(sync))
+        elapsed_time = time.time() - start_time
+
+        self.AddResult("MultiSet %s (sync=%s, %.1f stmts/call)" %
+                       (action, sync, float(statements) / n),
+                       elapsed_time / n, n)
+
 
 class MysqlAdvancedDataStoreCSVBenchmarks(
     mysql_advanced_data_store_test.MysqlAdvancedTestMixin,
@@ -6,6 +6,7 @@ SQLite database files are created by taking the root of each AFF4 object.
 
 
 
+import collections
 import itertools
 import os
 import re
@@ -660,33 +661,37 @@ class SqliteDataStore(data_store.DataStore):
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
     # All operations are synchronized.
     _ = sync
+
+    with self.cache.Get(subject) as sqlite_connection:
+      self._MultiSet(sqlite_connection, subject, values, timestamp, replace,
+                     to_delete)
+
+  def _MultiSet(self, sqlite_connection, subject, values, timestamp, replace,
+                to_delete):
+    """Writes the values of a MultiSet using the given connection."""
     if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
       timestamp = time.time() * 1000000
 
-    if to_delete is None:
-      to_delete = []
+    to_delete = list(to_delete or [])
+    if replace:
+      to_delete.extend(values.keys())
 
-    with self.cache.Get(subject) as sqlite_connection:
-      if replace:
-        to_delete.extend(values.keys())
-
-      # Delete attribute if needed.
-      if to_delete:
-        for attribute in to_delete:
-          sqlite_connection.DeleteAttribute(subject, attribute)
-
-      for attribute, seq in values.items():
-        for v in seq:
-          element_timestamp = None
-          if isinstance(v, (list, tuple)):
-            v, element_timestamp = v
-          if element_timestamp is None:
-            element_timestamp = timestamp
-
-          element_timestamp = long(element_timestamp)
-          value = self._Encode(v)
-          sqlite_connection.SetAttribute(subject, attribute, value,
-                                         element_timestamp)
+    # Delete attribute if needed.
+    for attribute in to_delete:
+      sqlite_connection.DeleteAttribute(subject, attribute)
+
+    for attribute, seq in values.items():
+      for v in seq:
+        element_timestamp = None
+        if isinstance(v, (list, tuple)):
+          v, element_timestamp = v
+        if element_timestamp is None:
+          element_timestamp = timestamp
+
+        element_timestamp = long(element_timestamp)
+        value = self._Encode(v)
+        sqlite_connection.SetAttribute(subject, attribute, value,
+                                       element_timestamp)
 
   def DeleteAttributes(self,
                        subject,
@@ -699,30 +704,70 @@ class SqliteDataStore(data_store.DataStore):
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
     _ = sync
 
+    with self.cache.Get(subject) as sqlite_connection:
+      self._DeleteAttributes(sqlite_connection, subject, attributes, start,
+                             end)
+
+  def _DeleteAttributes(self, sqlite_connection, subject, attributes, start,
+                        end):
+    """Deletes attributes using the given connection."""
     if isinstance(attributes, basestring):
       raise ValueError(
           "String passed to DeleteAttributes (non string iterable expected).")
 
-    with self.cache.Get(subject) as sqlite_connection:
-      if start is None and end is None:
-        # This is done when we delete all attributes at once without
-        # caring about timestamps.
-        for attribute in list(attributes):
-          sqlite_connection.DeleteAttribute(subject, attribute)
-      else:
-        # This code path is taken when we have a timestamp range.
-        start = start or 0
-        if end is None:
-          end = (2**63) - 1  # sys.maxint
-        for attribute in list(attributes):
-          sqlite_connection.DeleteAttributeRange(subject, attribute, start, end)
+    if start is None and end is None:
+      # This is done when we delete all attributes at once without
+      # caring about timestamps.
+      for attribute in list(attributes):
+        sqlite_connection.DeleteAttribute(subject, attribute)
+    else:
+      # This code path is taken when we have a timestamp range.
+      start = start or 0
+      if end is None:
+        end = (2**63) - 1  # sys.maxint
+      for attribute in list(attributes):
+        sqlite_connection.DeleteAttributeRange(subject, attribute, start, end)
 
   def DeleteSubject(self, subject, sync=False, token=None):
     _ = sync
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
 
     with self.cache.Get(subject) as sqlite_connection:
-      sqlite_connection.DeleteSubject(subject)
+      self._DeleteSubject(sqlite_connection, subject)
+
+  def _DeleteSubject(self, sqlite_connection, subject):
+    sqlite_connection.DeleteSubject(subject)
+
+  def ApplyMutations(self, mutation_pool):
+    """Applies the mutations of the pool with one commit per database file."""
+    token = mutation_pool.token
+    subjects = set(mutation_pool.delete_subject_requests)
+    subjects.update(req[0] for req in mutation_pool.delete_attributes_requests)
+    subjects.update(req[0] for req in mutation_pool.set_requests)
+    self.security_manager.CheckDataStoreAccess(token, list(subjects), "w")
+
+    # Group the mutations by database file, keeping their relative order. A
+    # subject always maps to the same file so per subject order is preserved.
+    mutations = []
+    for subject in mutation_pool.delete_subject_requests:
+      mutations.append((subject, self._DeleteSubject, (subject,)))
+
+    for req in mutation_pool.delete_attributes_requests:
+      mutations.append((req[0], self._DeleteAttributes, req))
+
+    for req in mutation_pool.set_requests:
+      mutations.append((req[0], self._MultiSet, req))
+
+    by_database = collections.OrderedDict()
+    for subject, method, args in mutations:
+      filename = self.cache.Get(subject).Filename()
+      by_database.setdefault(filename, (subject, []))[1].append((method, args))
+
+    for subject, database_mutations in by_database.itervalues():
+      # The connection is only committed when the with block exits.
+      with self.cache.Get(subject) as sqlite_connection:
+        for method, args in database_mutations:
+          method(sqlite_connection, *args)
 
   def MultiResolvePrefix(self,
                          subjects,
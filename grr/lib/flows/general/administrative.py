@@ -369,9 +369,19 @@ class Foreman(flow.WellKnownFlow):
 
   def ProcessMessage(self, message):
     """Run the foreman on the client."""
-    # Only accept authenticated messages
-    if (message.auth_state !=
-        rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED):
+    self.ProcessMessages([message])
+
+  def ProcessMessages(self, msgs):
+    """Run the foreman on all the clients that sent messages at once."""
+    client_ids = []
+    for message in msgs:
+      # Only accept authenticated messages
+      if (message.auth_state ==
+          rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED and
+          message.source):
+        client_ids.append(message.source)
+
+    if not client_ids:
       return
 
     now = time.time()
@@ -384,8 +394,7 @@ class Foreman(flow.WellKnownFlow):
             "aff4:/foreman", mode="rw", token=self.token)
         self.foreman_cache.age = now
 
-    if message.source:
-      self.foreman_cache.AssignTasksToClient(message.source)
+    self.foreman_cache.AssignTasksToClients(client_ids)
 
 
 class OnlineNotificationArgs(rdf_structs.RDFProtoStruct):
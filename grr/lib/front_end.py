@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 """The GRR frontend server."""
 
+import contextlib
 import operator
+import random
+import sys
+import threading
 import time
 
 
@@ -24,15 +28,104 @@ from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 
 
+class ClientLivenessTracker(object):
+  """Records when clients were last seen, writing to the data store in bulk.
+
+  Polls only update an in-memory table of the clients' ip, clock and ping
+  time. The table is written to the client objects every flush_interval
+  seconds using a single mutation pool, or on every update if flush_interval
+  is 0.
+  """
+
+  def __init__(self, flush_interval, token=None):
+    self.flush_interval = flush_interval
+    self.token = token
+    self.lock = threading.Lock()
+    # Maps client ids to dicts of the attribute values not yet written.
+    self.pending = {}
+    # The latest clock of every client we have seen recently.
+    self.clocks = utils.FastStore(max_size=50000)
+
+    self.flusher_thread = None
+    if flush_interval:
+      self.flusher_thread = utils.InterruptableThread(
+          name="Client liveness flusher thread",
+          target=self._PeriodicFlush,
+          sleep_time=flush_interval)
+      self.flusher_thread.start()
+
+  def GetClock(self, client_id):
+    """Returns the latest clock the client reported or None if unknown."""
+    try:
+      return self.clocks.Get(client_id)
+    except KeyError:
+      return None
+
+  def Update(self, client_id, ip, clock=None, ping=None):
+    """Records a poll from a client.
+
+    Args:
+      client_id: The client that polled.
+      ip: The ip address the client polled from.
+      clock: If set, an RDFDatetime of the client's clock.
+      ping: If set, an RDFDatetime of the time the poll was received.
+    """
+    schema = aff4.AFF4Object.classes["VFSGRRClient"].SchemaCls
+    values = {schema.CLIENT_IP: schema.CLIENT_IP(ip)}
+    if clock is not None:
+      values[schema.CLOCK] = schema.CLOCK(clock)
+      self.clocks.Put(client_id, clock)
+    if ping is not None:
+      values[schema.PING] = schema.PING(ping)
+
+    with self.lock:
+      self.pending.setdefault(client_id, {}).update(values)
+
+    if not self.flush_interval:
+      self.Flush()
+
+  def _PeriodicFlush(self):
+    try:
+      self.Flush()
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Failed to write client liveness data: %s", e)
+
+  def Flush(self):
+    """Writes all the pending updates to the data store."""
+    with self.lock:
+      pending, self.pending = self.pending, {}
+
+    if not pending:
+      return
+
+    with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
+      for client_id, values in pending.iteritems():
+        # These attributes are not versioned, so just like AFF4Object.Set we
+        # replace the old values and write the new ones at timestamp 0.
+        aff4.FACTORY.SetAttributes(
+            rdf_client.ClientURN(client_id),
+            dict((attribute, [(value.SerializeToDataStore(), 0)])
+                 for attribute, value in values.iteritems()),
+            set(values),
+            add_child_index=False,
+            mutation_pool=mutation_pool,
+            token=self.token)
+
+
 class ServerCommunicator(communicator.Communicator):
   """A communicator which stores certificates using AFF4."""
 
   def __init__(self, certificate, private_key, token=None):
     self.client_cache = utils.FastStore(1000)
     self.token = token
+    self.liveness_tracker = ClientLivenessTracker(
+        config_lib.CONFIG["Frontend.liveness_flush_interval"], token=token)
     super(ServerCommunicator, self).__init__(
         certificate=certificate, private_key=private_key)
     self.pub_key_cache = utils.FastStore(max_size=50000)
+    self.encrypted_cipher_cache = utils.TimeBasedCache(
+        max_size=config_lib.CONFIG["Frontend.cipher_cache_size"],
+        max_age=config_lib.CONFIG["Frontend.cipher_cache_ttl"])
     # Our common name as an RDFURN.
     self.common_name = rdfvalue.RDFURN(self.certificate.GetCN())
 
@@ -105,10 +198,10 @@ class ServerCommunicator(communicator.Communicator):
                                   len(self.client_cache))
 
       ip = response_comms.orig_request.source_ip
-      client.Set(client.Schema.CLIENT_IP(ip))
 
       # The very first packet we see from the client we do not have its clock
-      remote_time = client.Get(client.Schema.CLOCK) or 0
+      remote_time = (self.liveness_tracker.GetClock(client_id) or
+                     client.Get(client.Schema.CLOCK) or 0)
       client_time = signed_message_list.timestamp or 0
 
       # This used to be a strict check here so absolutely no out of
@@ -132,16 +225,18 @@ class ServerCommunicator(communicator.Communicator):
       # Update the client and server timestamps only if the client
       # time moves forward.
       if client_time > long(remote_time):
-        client.Set(client.Schema.CLOCK, rdfvalue.RDFDatetime(client_time))
-        client.Set(client.Schema.PING, rdfvalue.RDFDatetime.Now())
+        self.liveness_tracker.Update(
+            client_id,
+            ip,
+            clock=rdfvalue.RDFDatetime(client_time),
+            ping=rdfvalue.RDFDatetime.Now())
         for label in client.Get(client.Schema.LABELS, []):
           stats.STATS.IncrementCounter(
               "client_pings_by_label", fields=[label.name])
       else:
         logging.warning("Out of order message for %s: %s >= %s", client_id,
                         long(remote_time), int(client_time))
-
-      client.Flush(sync=False)
+        self.liveness_tracker.Update(client_id, ip)
 
     except communicator.UnknownClientCert:
       pass
@@ -149,6 +244,119 @@ class ServerCommunicator(communicator.Communicator):
     return rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
 
 
+class ServerOverloaded(Exception):
+  """Raised when a poll is turned away to shed load."""
+
+  def __init__(self, retry_after):
+    super(ServerOverloaded, self).__init__(
+        "Server overloaded, retry in %s seconds." % retry_after)
+    # The number of seconds the client should wait before polling again.
+    self.retry_after = retry_after
+
+
+class AdmissionController(object):
+  """Turns polls away while the frontend has more work than it can handle.
+
+  The load is the larger of the number of messages being received relative to
+  max_inflight_messages, and the average time the data store work of a poll
+  takes relative to target_latency. Polls carrying responses to flow requests
+  are admitted until the load reaches 1, idle pings only until it reaches
+  ping_load_limit. A poll is always admitted when no other poll is in flight,
+  so the latency average keeps following the data store.
+  """
+
+  # The weight of the latest poll in the moving latency average.
+  LATENCY_DECAY = 0.1
+
+  def __init__(self, max_inflight_messages, target_latency, ping_load_limit,
+               min_backoff, max_backoff):
+    self.max_inflight_messages = max_inflight_messages
+    self.target_latency = target_latency
+    self.ping_load_limit = ping_load_limit
+    self.min_backoff = min_backoff
+    self.max_backoff = max_backoff
+
+    self.lock = threading.Lock()
+    self.inflight_requests = 0
+    self.inflight_messages = 0
+    self.latency = 0.0
+
+  def Load(self, num_messages=0):
+    """Returns the load, including num_messages about to be received."""
+    return max(
+        float(self.inflight_messages + num_messages) /
+        self.max_inflight_messages, self.latency / self.target_latency)
+
+  def RetryAfter(self, overload):
+    """Returns the backoff for a poll turned away at the given overload."""
+    backoff = self.min_backoff * overload
+    # Spread the retries out so turned away clients do not return together.
+    return int(min(self.max_backoff, backoff * random.uniform(1, 2)))
+
+  def _UpdateGauges(self):
+    stats.STATS.SetGaugeValue("frontend_admission_inflight_requests",
+                              self.inflight_requests)
+    stats.STATS.SetGaugeValue("frontend_admission_inflight_messages",
+                              self.inflight_messages)
+    stats.STATS.SetGaugeValue("frontend_admission_latency", self.latency)
+
+  @contextlib.contextmanager
+  def Admit(self, messages):
+    """Admits a poll for the duration of the context.
+
+    Args:
+      messages: The messages the client sent with the poll.
+
+    Yields:
+      None, once the poll is admitted.
+
+    Raises:
+      ServerOverloaded: If the poll is turned away.
+    """
+    # Messages with a request id are responses to flow requests.
+    if any(message.request_id for message in messages):
+      priority, limit = "flow", 1.0
+    else:
+      priority, limit = "ping", self.ping_load_limit
+
+    with self.lock:
+      load = self.Load(len(messages))
+      if self.inflight_requests and load >= limit:
+        stats.STATS.IncrementCounter(
+            "frontend_admission_rejected_count", fields=[priority])
+        raise ServerOverloaded(self.RetryAfter(load / limit))
+
+      self.inflight_requests += 1
+      self.inflight_messages += len(messages)
+      self._UpdateGauges()
+
+    start = time.time()
+    try:
+      yield
+    finally:
+      with self.lock:
+        self.inflight_requests -= 1
+        self.inflight_messages -= len(messages)
+        self.latency += self.LATENCY_DECAY * (
+            time.time() - start - self.latency)
+        self._UpdateGauges()
+
+
+class _IngestionBatch(object):
+  """Messages from concurrent client polls that are written together."""
+
+  def __init__(self):
+    # Tuples of (client_id, messages).
+    self.entries = []
+    # Set once the messages were written to the data store.
+    self.done = threading.Event()
+    # sys.exc_info() of the entries whose messages could not be queued, by
+    # index into entries.
+    self.entry_errors = {}
+    # Set when writing the whole batch failed.
+    self.error = None
+
+
 class FrontEndServer(object):
   """This is the front end server.
 
@@ -202,6 +410,25 @@ class FrontEndServer(object):
     self.well_known_flows_blacklist = set(config_lib.CONFIG[
         "Frontend.DEBUG_well_known_flows_blacklist"])
 
+    # Messages received from concurrent polls are written in batches.
+    self.ingestion_batch_window = config_lib.CONFIG[
+        "Frontend.ingestion_batch_window"]
+    self.ingestion_max_batch_size = config_lib.CONFIG[
+        "Frontend.ingestion_max_batch_size"]
+    self.ingestion_lock = threading.Lock()
+    self.ingestion_batch = None
+
+    self.client_queue_mode = config_lib.CONFIG["Frontend.client_queue_mode"]
+
+    self.admission_controller = AdmissionController(
+        max_inflight_messages=config_lib.CONFIG[
+            "Frontend.admission_max_inflight_messages"],
+        target_latency=config_lib.CONFIG["Frontend.admission_target_latency"],
+        ping_load_limit=config_lib.CONFIG[
+            "Frontend.admission_ping_load_limit"],
+        min_backoff=config_lib.CONFIG["Frontend.admission_min_backoff"],
+        max_backoff=config_lib.CONFIG["Frontend.admission_max_backoff"])
+
   @stats.Counted("grr_frontendserver_handle_num")
   @stats.Timed("grr_frontendserver_handle_time")
   def HandleMessageBundles(self, request_comms, response_comms):
@@ -221,25 +448,32 @@ class FrontEndServer(object):
     Returns:
        tuple of (source, message_count) where message_count is the number of
        messages received from the client with common name source.
+
+    Raises:
+       ServerOverloaded: If the frontend is too busy to process the poll.
     """
     messages, source, timestamp = self._communicator.DecodeMessages(
         request_comms)
 
-    now = time.time()
-    if messages:
-      # Receive messages in line.
-      self.ReceiveMessages(source, messages)
-
-    # We send the client a maximum of self.max_queue_size messages
-    required_count = max(0, self.max_queue_size - request_comms.queue_size)
     tasks = []
-
     message_list = rdf_flows.MessageList()
-    # Only give the client messages if we are able to receive them in a
-    # reasonable time.
-    if time.time() - now < 10:
-      tasks = self.DrainTaskSchedulerQueueForClient(source, required_count)
-      message_list.job = tasks
+
+    # The data store work is only done for polls the frontend has capacity
+    # for, others are asked to come back later.
+    with self.admission_controller.Admit(messages):
+      now = time.time()
+      if messages:
+        # Receive messages in line.
+        self.ReceiveMessages(source, messages)
+
+      # We send the client a maximum of self.max_queue_size messages
+      required_count = max(0, self.max_queue_size - request_comms.queue_size)
+
+      # Only give the client messages if we are able to receive them in a
+      # reasonable time.
+      if time.time() - now < 10:
+        tasks = self.DrainTaskSchedulerQueueForClient(source, required_count)
+        message_list.job = tasks
 
     # Encode the message_list in the response_comms using the same API version
     # the client used.
@@ -253,7 +487,10 @@ class FrontEndServer(object):
     except communicator.UnknownClientCert:
       # We can not encode messages to the client yet because we do not have the
       # client certificate - return them to the queue so we can try again later.
-      queue_manager.QueueManager(token=self.token).Schedule(tasks)
+      # Tasks from FetchClientTasks were not taken off the queue, they are
+      # handed out again once their delivery expires.
+      if self.client_queue_mode != "log":
+        queue_manager.QueueManager(token=self.token).Schedule(tasks)
       raise
 
     return source, len(messages)
@@ -283,10 +520,17 @@ class FrontEndServer(object):
 
     start_time = time.time()
     # Drain the queue for this client
-    new_tasks = queue_manager.QueueManager(token=self.token).QueryAndOwn(
-        queue=client.Queue(),
-        limit=max_count,
-        lease_seconds=self.message_expiry_time)
+    manager = queue_manager.QueueManager(token=self.token)
+    if self.client_queue_mode == "log":
+      new_tasks = manager.FetchClientTasks(
+          queue=client.Queue(),
+          limit=max_count,
+          lease_seconds=self.message_expiry_time)
+    else:
+      new_tasks = manager.QueryAndOwn(
+          queue=client.Queue(),
+          limit=max_count,
+          lease_seconds=self.message_expiry_time)
 
     initial_ttl = rdf_flows.GrrMessage().task_ttl
     check_before_sending = []
@@ -323,59 +567,127 @@ class FrontEndServer(object):
     response in that request's queue. If the request is complete, we
     send a message to the worker.
 
+    Messages arriving from other clients within Frontend.ingestion_batch_window
+    are written to the data store together with these. This method only
+    returns once the messages were written.
+
     Args:
       client_id: The client which sent the messages.
       messages: A list of GrrMessage RDFValues.
+
+    Raises:
+      Exception: Queuing these messages or writing the batch failed.
     """
+    if not self.ingestion_batch_window:
+      batch = _IngestionBatch()
+      batch.entries.append((client_id, messages))
+      self._ReceiveMessageBatch(batch)
+      self._RaiseEntryError(batch, 0)
+      return
+
+    with self.ingestion_lock:
+      batch = self.ingestion_batch
+      # The first poll to arrive starts a new batch and writes it.
+      leader = (batch is None or
+                len(batch.entries) >= self.ingestion_max_batch_size)
+      if leader:
+        batch = self.ingestion_batch = _IngestionBatch()
+      index = len(batch.entries)
+      batch.entries.append((client_id, messages))
+
+    if not leader:
+      batch.done.wait()
+      if batch.error is not None:
+        raise batch.error
+      self._RaiseEntryError(batch, index)
+      return
+
+    time.sleep(self.ingestion_batch_window)
+    with self.ingestion_lock:
+      if self.ingestion_batch is batch:
+        self.ingestion_batch = None
+
+    try:
+      self._ReceiveMessageBatch(batch)
+    except Exception as e:  # pylint: disable=broad-except
+      batch.error = e
+      raise
+    finally:
+      batch.done.set()
+
+    self._RaiseEntryError(batch, index)
+
+  def _RaiseEntryError(self, batch, index):
+    """Re-raises the error queuing the messages of an entry, if any."""
+    error = batch.entry_errors.get(index)
+    if error is not None:
+      raise error[0], error[1], error[2]
+
+  def _ReceiveMessageBatch(self, batch):
+    """Writes messages from one or more clients in one queue manager flush.
+
+    An error in the messages of one client does not stop the messages of the
+    other clients from being written, it is recorded in batch.entry_errors.
+
+    Args:
+      batch: An _IngestionBatch.
+    """
+    entries = batch.entries
     now = time.time()
     with queue_manager.QueueManager(
         token=self.token, store=self.data_store) as manager:
-      sessions_handled = []
-      for session_id, msgs in utils.GroupBy(
-          messages, operator.attrgetter("session_id")).iteritems():
-
-        # Remove and handle messages to WellKnownFlows
-        unprocessed_msgs = self.HandleWellKnownFlows(msgs)
-
-        if not unprocessed_msgs:
-          continue
-
-        # Keep track of all the flows we handled in this request.
-        sessions_handled.append(session_id)
-
-        for msg in unprocessed_msgs:
-          manager.QueueResponse(session_id, msg)
-
-        for msg in unprocessed_msgs:
-          # Messages for well known flows should notify even though they don't
-          # have a status.
-          if msg.request_id == 0:
-            manager.QueueNotification(
-                session_id=msg.session_id, priority=msg.priority)
-            # Those messages are all the same, one notification is enough.
-            break
-          elif msg.type == rdf_flows.GrrMessage.Type.STATUS:
-            # If we receive a status message from the client it means the client
-            # has finished processing this request. We therefore can de-queue it
-            # from the client queue. msg.task_id will raise if the task id is
-            # not set (message originated at the client, there was no request on
-            # the server) so we have to use .Get() instead.
-            if msg.HasTaskID():
-              manager.DeQueueClientRequest(client_id, msg.task_id)
-
-            manager.QueueNotification(
-                session_id=msg.session_id,
-                priority=msg.priority,
-                last_status=msg.request_id)
-
-            stat = rdf_flows.GrrStatus(msg.payload)
-            if stat.status == rdf_flows.GrrStatus.ReturnedStatus.CLIENT_KILLED:
-              # A client crashed while performing an action, fire an event.
-              events.Events.PublishEvent(
-                  "ClientCrash", rdf_flows.GrrMessage(msg), token=self.token)
-
-    logging.debug("Received %s messages in %s sec",
-                  len(messages), time.time() - now)
+      for index, (client_id, messages) in enumerate(entries):
+        try:
+          self._QueueMessages(manager, client_id, messages)
+        except Exception:  # pylint: disable=broad-except
+          batch.entry_errors[index] = sys.exc_info()
+
+    stats.STATS.RecordEvent("frontend_ingestion_batch_size", len(entries))
+    logging.debug("Received %s messages from %s polls in %s sec",
+                  sum(len(messages) for _, messages in entries), len(entries),
+                  time.time() - now)
+
+  def _QueueMessages(self, manager, client_id, messages):
+    """Queues the messages from a client on the queue manager."""
+    for session_id, msgs in utils.GroupBy(
+        messages, operator.attrgetter("session_id")).iteritems():
+
+      # Remove and handle messages to WellKnownFlows
+      unprocessed_msgs = self.HandleWellKnownFlows(msgs)
+
+      if not unprocessed_msgs:
+        continue
+
+      for msg in unprocessed_msgs:
+        manager.QueueResponse(session_id, msg)
+
+      for msg in unprocessed_msgs:
+        # Messages for well known flows should notify even though they don't
+        # have a status.
+        if msg.request_id == 0:
+          manager.QueueNotification(
+              session_id=msg.session_id, priority=msg.priority)
+          # Those messages are all the same, one notification is enough.
+          break
+        elif msg.type == rdf_flows.GrrMessage.Type.STATUS:
+          # If we receive a status message from the client it means the client
+          # has finished processing this request. We therefore can de-queue it
+          # from the client queue. msg.task_id will raise if the task id is
+          # not set (message originated at the client, there was no request on
+          # the server) so we have to use .Get() instead.
+          if msg.HasTaskID():
+            manager.DeQueueClientRequest(client_id, msg.task_id)
+
+          manager.QueueNotification(
+              session_id=msg.session_id,
+              priority=msg.priority,
+              last_status=msg.request_id)
+
+          stat = rdf_flows.GrrStatus(msg.payload)
+          if stat.status == rdf_flows.GrrStatus.ReturnedStatus.CLIENT_KILLED:
+            # A client crashed while performing an action, fire an event.
+            events.Events.PublishEvent(
+                "ClientCrash", rdf_flows.GrrMessage(msg), token=self.token)
 
   def HandleWellKnownFlows(self, messages):
     """Hands off messages to well known flows."""
@@ -440,10 +752,23 @@ class FrontendInit(registry.InitHook):
     # misconfiguration.
     stats.STATS.RegisterCounterMetric(
         "frontend_inactive_request_count", fields=[("source", str)])
+    # Client requests rejected because the frontend was overloaded.
+    stats.STATS.RegisterCounterMetric(
+        "frontend_rejected_request_count", fields=[("source", str)])
     stats.STATS.RegisterEventMetric(
         "frontend_request_latency", fields=[("source", str)])
 
+    # Polls turned away by admission control, by priority, and the work the
+    # admission decisions are based on.
+    stats.STATS.RegisterCounterMetric(
+        "frontend_admission_rejected_count", fields=[("priority", str)])
+    stats.STATS.RegisterGaugeMetric("frontend_admission_inflight_requests", int)
+    stats.STATS.RegisterGaugeMetric("frontend_admission_inflight_messages", int)
+    stats.STATS.RegisterGaugeMetric("frontend_admission_latency", float)
+
     stats.STATS.RegisterEventMetric("grr_frontendserver_handle_time")
+    stats.STATS.RegisterEventMetric(
+        "frontend_ingestion_batch_size", bins=[1, 2, 5, 10, 20, 50, 100])
     stats.STATS.RegisterCounterMetric("grr_frontendserver_handle_num")
     stats.STATS.RegisterGaugeMetric("grr_frontendserver_client_cache_size", int)
     stats.STATS.RegisterCounterMetric("grr_messages_sent")
@@ -2,8 +2,10 @@
 """Unittest for grr frontend server."""
 
 
+import threading
 
 
+from grr.lib import aff4
 from grr.lib import communicator
 from grr.lib import config_lib
 from grr.lib import data_store
@@ -12,6 +14,7 @@ from grr.lib import flow
 from grr.lib import front_end
 from grr.lib import queue_manager
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
@@ -141,6 +144,101 @@ class GRRFEServerTest(test_lib.FlowTestsBaseclass):
       stored_message = rdf_flows.GrrMessage.FromSerializedString(stored_message)
       self.assertRDFValuesEqual(stored_message, message)
 
+  def testReceiveMessagesBatchesConcurrentPolls(self):
+    """Messages from concurrent polls are written in one flush."""
+    self.server.ingestion_batch_window = 0.5
+
+    polls = []
+    for i in range(3):
+      session_id = self.FlowSetup("FlowOrderTest").session_id
+      polls.append([
+          rdf_flows.GrrMessage(
+              request_id=1,
+              response_id=j,
+              session_id=session_id,
+              payload=rdfvalue.RDFInteger(j)) for j in range(1, i + 2)
+      ])
+
+    with test_lib.Instrument(queue_manager.QueueManager, "Flush") as flush:
+      threads = [
+          threading.Thread(
+              target=self.server.ReceiveMessages, args=(self.client_id, msgs))
+          for msgs in polls
+      ]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+
+    self.assertEqual(flush.call_count, 1)
+
+    manager = queue_manager.QueueManager(token=self.token)
+    for messages in polls:
+      for message in messages:
+        stored_message, _ = data_store.DB.Resolve(
+            message.session_id.Add("state/request:00000001"),
+            manager.FLOW_RESPONSE_TEMPLATE % (1, message.response_id),
+            token=self.token)
+
+        stored_message = rdf_flows.GrrMessage.FromSerializedString(
+            stored_message)
+        self.assertRDFValuesEqual(stored_message, message)
+
+  def testReceiveMessagesIsolatesErrorsPerPoll(self):
+    """A poll whose messages fail does not fail the rest of its batch."""
+    self.server.ingestion_batch_window = 0.5
+
+    polls = []
+    for i in range(3):
+      session_id = self.FlowSetup("FlowOrderTest").session_id
+      polls.append([
+          rdf_flows.GrrMessage(
+              request_id=1,
+              response_id=i + 1,
+              session_id=session_id,
+              payload=rdfvalue.RDFInteger(i))
+      ])
+
+    bad_session_id = polls[1][0].session_id
+    handle_well_known_flows = self.server.HandleWellKnownFlows
+
+    def HandleWellKnownFlows(messages):
+      if messages[0].session_id == bad_session_id:
+        raise ValueError("Bad message.")
+      return handle_well_known_flows(messages)
+
+    errors = {}
+
+    def ReceiveMessages(index, messages):
+      try:
+        self.server.ReceiveMessages(self.client_id, messages)
+      except ValueError as e:
+        errors[index] = e
+
+    with utils.Stubber(self.server, "HandleWellKnownFlows",
+                       HandleWellKnownFlows):
+      threads = [
+          threading.Thread(target=ReceiveMessages, args=(i, msgs))
+          for i, msgs in enumerate(polls)
+      ]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+
+    self.assertEqual(errors.keys(), [1])
+
+    manager = queue_manager.QueueManager(token=self.token)
+    for messages in [polls[0], polls[2]]:
+      message = messages[0]
+      stored_message, _ = data_store.DB.Resolve(
+          message.session_id.Add("state/request:00000001"),
+          manager.FLOW_RESPONSE_TEMPLATE % (1, message.response_id),
+          token=self.token)
+
+      self.assertRDFValuesEqual(
+          rdf_flows.GrrMessage.FromSerializedString(stored_message), message)
+
   def testReceiveUnsolicitedClientMessage(self):
     flow_obj = self.FlowSetup("FlowOrderTest")
 
@@ -443,6 +541,14 @@ class GRRFEServerTest(test_lib.FlowTestsBaseclass):
 
   def testHandleClientMessageRetransmission(self):
     """Check that requests get retransmitted but only if there is no status."""
+    self._CheckClientMessageRetransmission()
+
+  def testHandleClientMessageRetransmissionFromTaskLog(self):
+    """Tasks fetched without leases are retransmitted the same way."""
+    self.server.client_queue_mode = "log"
+    self._CheckClientMessageRetransmission()
+
+  def _CheckClientMessageRetransmission(self):
     # Make a new fake client
     client_id = self.SetupClients(1)[0]
 
@@ -505,6 +611,81 @@ class GRRFEServerTest(test_lib.FlowTestsBaseclass):
         [True] * 2 + [False] * (rdf_flows.GrrMessage().task_ttl - 2))
 
 
+class ClientLivenessTrackerTest(test_lib.GRRBaseTest):
+  """Tests the ClientLivenessTracker."""
+
+  def testUpdatesAreWrittenOnFlush(self):
+    client_id, = self.SetupClients(1)
+    tracker = front_end.ClientLivenessTracker(3600, token=self.token)
+    tracker.flusher_thread.Stop()
+
+    now = rdfvalue.RDFDatetime.Now()
+    tracker.Update(client_id, "1.2.3.4", clock=now - 20, ping=now)
+    self.assertEqual(tracker.GetClock(client_id), now - 20)
+
+    client = aff4.FACTORY.Open(client_id, ignore_cache=True, token=self.token)
+    self.assertFalse(client.Get(client.Schema.CLIENT_IP))
+    self.assertFalse(client.Get(client.Schema.CLOCK))
+
+    tracker.Flush()
+
+    client = aff4.FACTORY.Open(client_id, ignore_cache=True, token=self.token)
+    self.assertEqual(client.Get(client.Schema.CLIENT_IP), "1.2.3.4")
+    self.assertEqual(client.Get(client.Schema.CLOCK), now - 20)
+    self.assertEqual(client.Get(client.Schema.PING), now)
+
+
+class AdmissionControllerTest(test_lib.GRRBaseTest):
+  """Tests the AdmissionController."""
+
+  def setUp(self):
+    super(AdmissionControllerTest, self).setUp()
+    self.controller = front_end.AdmissionController(
+        max_inflight_messages=10,
+        target_latency=1.0,
+        ping_load_limit=0.5,
+        min_backoff=30,
+        max_backoff=600)
+
+  def testIdleFrontendAlwaysAdmits(self):
+    messages = [rdf_flows.GrrMessage(request_id=1) for _ in range(100)]
+    with self.controller.Admit(messages):
+      self.assertEqual(self.controller.inflight_messages, 100)
+    self.assertEqual(self.controller.inflight_messages, 0)
+
+  def testPingsAreTurnedAwayFirst(self):
+    responses = [rdf_flows.GrrMessage(request_id=1) for _ in range(6)]
+    rejected = stats.STATS.GetMetricValue(
+        "frontend_admission_rejected_count", fields=["ping"])
+
+    with self.controller.Admit(responses):
+      # The load is 0.6: pings are turned away, flow responses are not.
+      with self.assertRaises(front_end.ServerOverloaded) as e:
+        with self.controller.Admit([]):
+          pass
+
+      self.assertGreaterEqual(e.exception.retry_after, 30)
+      self.assertLessEqual(e.exception.retry_after, 600)
+      self.assertEqual(
+          stats.STATS.GetMetricValue(
+              "frontend_admission_rejected_count", fields=["ping"]),
+          rejected + 1)
+
+      with self.controller.Admit(responses[:3]):
+        self.assertEqual(self.controller.inflight_requests, 2)
+
+      with self.assertRaises(front_end.ServerOverloaded):
+        with self.controller.Admit(responses):
+          pass
+
+  def testSlowDataStoreTurnsPollsAway(self):
+    self.controller.latency = 2.0
+    with self.controller.Admit([]):
+      with self.assertRaises(front_end.ServerOverloaded):
+        with self.controller.Admit([rdf_flows.GrrMessage(request_id=1)]):
+          pass
+
+
 def main(args):
   test_lib.main(args)
 
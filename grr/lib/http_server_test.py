@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""Tests for the event loop based frontend http server."""
+
+
+import httplib
+import threading
+import time
+
+
+from grr.lib import config_lib
+from grr.lib import flags
+from grr.lib import front_end
+from grr.lib import test_lib
+from grr.lib import threadpool
+from grr.lib import utils
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.tools import http_server
+
+
+class FakeFrontend(object):
+  """A frontend that records the message bundles it is handed."""
+
+  def __init__(self):
+    self.bundles = []
+    self.admission_controller = front_end.AdmissionController(
+        max_inflight_messages=100,
+        target_latency=1,
+        ping_load_limit=1,
+        min_backoff=10,
+        max_backoff=10)
+
+  def HandleMessageBundles(self, request_comms, response_comms):
+    _ = response_comms
+    self.bundles.append(request_comms)
+    return "C.1000000000000000", 0
+
+
+class AsyncGRRHTTPServerTest(test_lib.GRRBaseTest):
+  """Tests the AsyncGRRHTTPServer."""
+
+  def setUp(self):
+    super(AsyncGRRHTTPServerTest, self).setUp()
+    self.frontend = FakeFrontend()
+    self.server = http_server.AsyncGRRHTTPServer(
+        ("127.0.0.1", 0), frontend=self.frontend)
+    self.port = self.server.socket.getsockname()[1]
+
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.start()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server_thread.join()
+    super(AsyncGRRHTTPServerTest, self).tearDown()
+
+  def _Connect(self):
+    return httplib.HTTPConnection("127.0.0.1", self.port, timeout=10)
+
+  def _Request(self, connection, method, path, body=None):
+    connection.request(method, path, body=body)
+    response = connection.getresponse()
+    response.data = response.read()
+    return response
+
+  def _AssertClosedByServer(self, connection):
+    connection.sock.settimeout(10)
+    self.assertEqual(connection.sock.recv(1), "")
+
+  def testConnectionsAreKeptAlive(self):
+    connection = self._Connect()
+    for _ in range(3):
+      response = self._Request(connection, "GET", "/server.pem")
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response.getheader("Connection"), "keep-alive")
+
+    self.assertEqual(self.server.connections, 1)
+
+  def testServerPem(self):
+    response = self._Request(self._Connect(), "GET", "/server.pem")
+    self.assertEqual(response.status, 200)
+    self.assertEqual(response.data,
+                     config_lib.CONFIG["Frontend.certificate"].AsPEM())
+
+  def testControlPost(self):
+    request_comms = rdf_flows.ClientCommunication(api_version=3)
+    response = self._Request(self._Connect(), "POST", "/control?api=3",
+                             request_comms.SerializeToString())
+
+    self.assertEqual(response.status, 200)
+    response_comms = rdf_flows.ClientCommunication.FromSerializedString(
+        response.data)
+    self.assertEqual(response_comms.api_version, 3)
+    self.assertEqual(len(self.frontend.bundles), 1)
+
+  def testUnknownPathIsNotFound(self):
+    connection = self._Connect()
+    response = self._Request(connection, "GET", "/unknown")
+    self.assertEqual(response.status, 404)
+
+    # The connection is still usable.
+    response = self._Request(connection, "GET", "/server.pem")
+    self.assertEqual(response.status, 200)
+
+  def testStaticFileErrorsAreAnswered(self):
+
+    def Broken(_):
+      raise RuntimeError("Broken.")
+
+    connection = self._Connect()
+    with utils.Stubber(http_server, "ReadStaticFile", Broken):
+      response = self._Request(connection, "GET", "/static/file")
+    self.assertEqual(response.status, 500)
+
+    # The channel is not left busy.
+    response = self._Request(connection, "GET", "/server.pem")
+    self.assertEqual(response.status, 200)
+
+  def testOverloadIsRejectedWithRetryAfter(self):
+
+    def Full(*_, **__):
+      raise threadpool.Full()
+
+    request_comms = rdf_flows.ClientCommunication(api_version=3)
+    connection = self._Connect()
+    with utils.Stubber(self.server.executor, "AddTask", Full):
+      response = self._Request(connection, "POST", "/control?api=3",
+                               request_comms.SerializeToString())
+
+    self.assertEqual(response.status, 503)
+    self.assertEqual(response.getheader("Retry-After"), "10")
+    self.assertEqual(response.getheader("Connection"), "close")
+    self.assertFalse(self.frontend.bundles)
+
+  def testIdleConnectionsAreClosed(self):
+    connection = self._Connect()
+    self._Request(connection, "GET", "/server.pem")
+
+    self.server.trigger.Call(self.server._CloseIdleConnections,
+                             time.time() + self.server.keepalive_timeout + 1)
+    self._AssertClosedByServer(connection)
+
+  def testShutdownClosesConnections(self):
+    connection = self._Connect()
+    self._Request(connection, "GET", "/server.pem")
+
+    self.server.shutdown()
+    self.server_thread.join(10)
+    self.assertFalse(self.server_thread.is_alive())
+    self._AssertClosedByServer(connection)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""A bus that wakes up workers when notifications are queued for them.
+
+The queue manager publishes the queues it wrote notifications to, and idle
+workers wait on the bus instead of sleeping for a fixed polling interval.
+Waiting always times out eventually, so workers still poll the data store for
+notifications written by processes the bus does not reach.
+"""
+
+import threading
+import time
+
+from grr.lib import config_lib
+from grr.lib import registry
+
+
+class NotificationBus(object):
+  """Base class for notification bus implementations."""
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  def Publish(self, queues):
+    """Signals that new notifications were written to queues.
+
+    Args:
+      queues: A list of queue urns.
+    """
+    raise NotImplementedError()
+
+  def Wait(self, queues, timeout):
+    """Waits until notifications are published to one of the queues.
+
+    Args:
+      queues: A list of queue urns to wait for.
+      timeout: The maximum number of seconds to wait.
+
+    Returns:
+      True if notifications were published, False if the wait timed out.
+    """
+    raise NotImplementedError()
+
+
+class PollingNotificationBus(NotificationBus):
+  """A bus that never wakes anyone up: workers just poll."""
+
+  def Publish(self, queues):
+    pass
+
+  def Wait(self, queues, timeout):
+    time.sleep(timeout)
+    return False
+
+
+class LocalNotificationBus(NotificationBus):
+  """A bus that wakes up workers running in the same process."""
+
+  def __init__(self):
+    self.cv = threading.Condition()
+    # Queues that were published to since the last wait for them.
+    self.pending = set()
+
+  def Publish(self, queues):
+    with self.cv:
+      self.pending.update(str(queue) for queue in queues)
+      self.cv.notify_all()
+
+  def Wait(self, queues, timeout):
+    queue_names = set(str(queue) for queue in queues)
+    deadline = time.time() + timeout
+    with self.cv:
+      while not self.pending & queue_names:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        self.cv.wait(remaining)
+
+      self.pending -= queue_names
+      return True
+
+
+NOTIFICATION_BUS = None
+
+
+class NotificationBusInit(registry.InitHook):
+  """Initializes the notification bus."""
+
+  def Run(self):
+    global NOTIFICATION_BUS  # pylint: disable=global-statement
+
+    bus_name = config_lib.CONFIG["Worker.notification_bus"]
+    try:
+      cls = NotificationBus.GetPlugin(bus_name)
+    except KeyError:
+      raise RuntimeError("No notification bus %s found." % bus_name)
+
+    NOTIFICATION_BUS = cls()
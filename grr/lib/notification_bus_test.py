@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Tests for grr.lib.notification_bus."""
+
+import threading
+
+from grr.lib import flags
+from grr.lib import notification_bus
+from grr.lib import queue_manager
+from grr.lib import queues
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.lib import utils
+
+
+class LocalNotificationBusTest(test_lib.GRRBaseTest):
+  """Tests for the in-process notification bus."""
+
+  def setUp(self):
+    super(LocalNotificationBusTest, self).setUp()
+    self.bus = notification_bus.LocalNotificationBus()
+
+  def testWaitTimesOutWithoutNotifications(self):
+    self.assertFalse(self.bus.Wait([queues.FLOWS], 0.01))
+
+  def testPublishedNotificationsAreNotLost(self):
+    self.bus.Publish([queues.FLOWS])
+
+    self.assertTrue(self.bus.Wait([queues.HUNTS, queues.FLOWS], 0.01))
+    # The notification was consumed by the first wait.
+    self.assertFalse(self.bus.Wait([queues.FLOWS], 0.01))
+
+  def testOtherQueuesDoNotWakeUp(self):
+    self.bus.Publish([queues.HUNTS])
+
+    self.assertFalse(self.bus.Wait([queues.FLOWS], 0.01))
+    self.assertTrue(self.bus.Wait([queues.HUNTS], 0.01))
+
+  def testWaitIsWokenUpByPublish(self):
+    results = []
+    waiting = threading.Thread(
+        target=lambda: results.append(self.bus.Wait([queues.FLOWS], 60)))
+    waiting.start()
+
+    self.bus.Publish([queues.FLOWS])
+    waiting.join(10)
+
+    self.assertFalse(waiting.isAlive())
+    self.assertEqual(results, [True])
+
+  def testQueueManagerPublishesOnFlush(self):
+    with utils.Stubber(notification_bus, "NOTIFICATION_BUS", self.bus):
+      with queue_manager.QueueManager(token=self.token) as manager:
+        manager.QueueNotification(session_id=rdfvalue.SessionID(
+            base="aff4:/flows", queue=queues.FLOWS, flow_name="42"))
+
+        # Nothing is published before the notification is written.
+        self.assertFalse(self.bus.Wait([queues.FLOWS], 0.01))
+
+      self.assertTrue(self.bus.Wait([queues.FLOWS], 0.01))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -13,6 +13,7 @@ import logging
 
 from grr.lib import config_lib
 from grr.lib import data_store
+from grr.lib import notification_bus
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
@@ -49,6 +50,9 @@ class QueueManager(object):
   5) Tasks can be re-leased by calling QueueManager.Schedule(task)
   repeatedly. Each call will extend the lease by the specified amount.
 
+  Client queues can also be read with QueueManager.FetchClientTasks(queue),
+  which hands tasks out without a transaction (see there).
+
   Important QueueManager's feature is the ability to freeze the timestamp used
   for time-limiting Resolve and Delete queries to the datastore. "with"
   statement should be used to freeze the timestamp, like:
@@ -82,13 +86,29 @@ class QueueManager(object):
   NOTIFY_PREDICATE_PREFIX = "notify:"
   NOTIFY_PREDICATE_TEMPLATE = NOTIFY_PREDICATE_PREFIX + "%s"
 
+  # Every FetchClientTasks call that hands out tasks appends a version of this
+  # attribute to the queue, listing the ids of the tasks it handed out.
+  TASK_DELIVERY_PREDICATE = "delivery:tasks"
+
   STUCK_PRIORITY = "Flow stuck"
 
   request_limit = 1000000
   response_limit = 1000000
 
+  # The maximum number of notifications read from a single shard at once.
+  notification_limit = 10000
+
   notification_shard_counters = {}
 
+  # Notification shards that were found empty recently. Keys are shard urns,
+  # values are pairs (number of consecutive empty fetches, time before which
+  # the shard is not polled again).
+  empty_notification_shards = {}
+
+  # The initial delay before an empty shard is polled again. The delay doubles
+  # with every further empty fetch, up to Worker.notification_shard_max_backoff.
+  EMPTY_SHARD_MIN_BACKOFF = 0.25
+
   def __init__(self, store=None, token=None):
     self.token = token
     if store is None:
@@ -270,10 +290,10 @@ class QueueManager(object):
               token=self.token,
               timestamp=timestamp))
       for response_urn, request in sorted(response_subjects.items()):
-        responses = []
-        for _, serialized, _ in response_data.get(response_urn, []):
-          responses.append(
-              rdf_flows.GrrMessage.FromSerializedString(serialized))
+        responses = rdf_flows.GrrMessage.ParseMany([
+            serialized
+            for _, serialized, _ in response_data.get(response_urn, [])
+        ])
 
         yield (request, sorted(responses, key=lambda msg: msg.response_id))
 
@@ -328,9 +348,8 @@ class QueueManager(object):
 
     for urn, request_data in sorted(requests.items()):
       request = rdf_flows.RequestState.FromSerializedString(request_data)
-      responses = []
-      for _, serialized, _ in response_data.get(urn, []):
-        responses.append(rdf_flows.GrrMessage.FromSerializedString(serialized))
+      responses = rdf_flows.GrrMessage.ParseMany(
+          [serialized for _, serialized, _ in response_data.get(urn, [])])
 
       yield (request, sorted(responses, key=lambda msg: msg.response_id))
 
@@ -411,12 +430,16 @@ class QueueManager(object):
               mutation_pool=mutation_pool)
 
     if self.notifications:
+      notified_queues = set()
       for notification, timestamp in self.notifications.itervalues():
+        notified_queues.add(notification.session_id.Queue())
         self.NotifyQueue(
             notification, timestamp=timestamp, mutation_pool=mutation_pool)
 
       mutation_pool.Flush()
 
+      self._PublishNotifications(notified_queues)
+
     self.to_write = {}
     self.to_delete = {}
     self.client_messages_to_delete = {}
@@ -526,9 +549,10 @@ class QueueManager(object):
     for queue, queued_tasks in utils.GroupBy(tasks,
                                              lambda x: x.queue).iteritems():
       if queue:
-        to_schedule = dict([(self._TaskIdToColumn(task.task_id),
-                             [task.SerializeToString()])
-                            for task in queued_tasks])
+        serialized_tasks = rdf_flows.GrrMessage.SerializeMany(queued_tasks)
+        to_schedule = dict([(self._TaskIdToColumn(task.task_id), [serialized])
+                            for task, serialized in zip(queued_tasks,
+                                                        serialized_tasks)])
 
         if mutation_pool:
           mutation_pool.MultiSet(queue, to_schedule, timestamp=timestamp)
@@ -569,6 +593,96 @@ class QueueManager(object):
     return self._SortByPriority(
         self._GetUnsortedNotifications(queue_shard).values(), queue)
 
+  def GetNotificationsByPriorityForQueues(self, queues):
+    """Retrieves notifications for several queues in a single data store call.
+
+    All the notification shards of all the queues are read with one
+    MultiResolvePrefix. Shards that were found empty recently are skipped
+    until their backoff expires, so the cost of polling scales with the
+    number of busy shards.
+
+    The data store applies the limit to all the shards together, so a very
+    busy shard could use it up. At most notification_limit notifications are
+    kept per shard and shards that were cut off by the limit are read again.
+
+    Args:
+      queues: A list of queue urns, usually the worker queues.
+    Returns:
+      A dict keyed by queue, values are dicts of notifications keyed by
+      priority.
+    """
+    shard_to_queue = {}
+    now = time.time()
+    for queue in queues:
+      for queue_shard in self.GetAllNotificationShards(queue):
+        _, not_before = self.empty_notification_shards.get(
+            str(queue_shard), (0, 0))
+        if not_before <= now:
+          shard_to_queue[str(queue_shard)] = queue
+
+    notifications_by_queue = dict((queue, {}) for queue in queues)
+    found_shards = set()
+    end_time = self.frozen_timestamp or rdfvalue.RDFDatetime.Now()
+    pending_shards = sorted(shard_to_queue)
+    while pending_shards:
+      limit = self.notification_limit * len(pending_shards)
+      total_values = 0
+      for queue_shard, values in self.data_store.MultiResolvePrefix(
+          pending_shards,
+          self.NOTIFY_PREDICATE_PREFIX,
+          timestamp=(0, end_time),
+          token=self.token,
+          limit=limit):
+        queue_shard = utils.SmartStr(queue_shard)
+        total_values += len(values)
+        if values:
+          found_shards.add(queue_shard)
+        self._ParseNotifications(
+            rdfvalue.RDFURN(queue_shard),
+            values[:self.notification_limit],
+            notifications_by_queue[shard_to_queue[queue_shard]])
+
+      # If the limit was not reached, the shards we did not get anything for
+      # are empty. Otherwise they might just have been cut off.
+      if total_values < limit:
+        break
+
+      pending_shards = [
+          queue_shard for queue_shard in pending_shards
+          if queue_shard not in found_shards
+      ]
+
+    self._UpdateEmptyShards(set(shard_to_queue) - found_shards, found_shards)
+
+    return dict((queue, self._SortByPriority(notifications.values(), queue))
+                for queue, notifications in notifications_by_queue.iteritems())
+
+  @classmethod
+  def ResetNotificationShardsBackoff(cls, queues):
+    """Makes sure all shards of queues are polled on the next fetch."""
+    queue_names = [str(queue) for queue in queues]
+    for queue_shard in cls.empty_notification_shards.keys():
+      for queue_name in queue_names:
+        if (queue_shard == queue_name or
+            queue_shard.startswith(queue_name + "/")):
+          cls.empty_notification_shards.pop(queue_shard, None)
+          break
+
+  def _UpdateEmptyShards(self, empty_shards, found_shards):
+    """Backs off polling the shards that had no notifications."""
+    max_backoff = config_lib.CONFIG["Worker.notification_shard_max_backoff"]
+    for queue_shard in found_shards:
+      self.empty_notification_shards.pop(queue_shard, None)
+
+    if not max_backoff:
+      return
+
+    now = time.time()
+    for queue_shard in empty_shards:
+      count, _ = self.empty_notification_shards.get(queue_shard, (0, 0))
+      backoff = min(max_backoff, self.EMPTY_SHARD_MIN_BACKOFF * 2**count)
+      self.empty_notification_shards[queue_shard] = (count + 1, now + backoff)
+
   def GetNotificationsByPriorityForAllShards(self, queue):
     """Same as GetNotificationsByPriority but for all shards.
 
@@ -630,12 +744,30 @@ class QueueManager(object):
     if notifications_by_session_id is None:
       notifications_by_session_id = {}
     end_time = self.frozen_timestamp or rdfvalue.RDFDatetime.Now()
-    for predicate, serialized_notification, ts in self.data_store.ResolvePrefix(
+    values = self.data_store.ResolvePrefix(
         queue_shard,
         self.NOTIFY_PREDICATE_PREFIX,
         timestamp=(0, end_time),
         token=self.token,
-        limit=10000):
+        limit=self.notification_limit)
+
+    return self._ParseNotifications(queue_shard, values,
+                                    notifications_by_session_id)
+
+  def _ParseNotifications(self, queue_shard, values,
+                          notifications_by_session_id):
+    """Parses notifications read from queue_shard.
+
+    Args:
+      queue_shard: urn of queue shard
+      values: A list of (predicate, serialized notification, timestamp) read
+        from the queue shard.
+      notifications_by_session_id: store notifications in this dict.
+
+    Returns:
+      dict of notifications. keys are session ids.
+    """
+    for predicate, serialized_notification, ts in values:
 
       # Parse the notification.
       try:
@@ -696,7 +828,8 @@ class QueueManager(object):
       timestamp: An optional timestamp for this notification.
       sync: If True, sync to the data_store immediately.
       mutation_pool: An optional MutationPool object to schedule Notifications
-                     on. If not given, self.data_store is used directly.
+                     on. If not given, self.data_store is used directly and
+                     the workers are woken up through the notification bus.
 
     Raises:
       RuntimeError: An invalid session_id was passed.
@@ -751,6 +884,12 @@ class QueueManager(object):
           sync=sync,
           replace=False,
           token=self.token)
+      self._PublishNotifications([queue])
+
+  def _PublishNotifications(self, queues):
+    """Wakes up the workers waiting for notifications on queues."""
+    if notification_bus.NOTIFICATION_BUS is not None:
+      notification_bus.NOTIFICATION_BUS.Publish(queues)
 
   def DeleteNotification(self, session_id, start=None, end=None):
     self.DeleteNotifications([session_id], start=start, end=end)
@@ -808,16 +947,16 @@ class QueueManager(object):
     else:
       prefix = utils.SmartStr(task_id)
 
-    all_tasks = []
-
-    for _, serialized, ts in self.data_store.ResolvePrefix(
+    records = self.data_store.ResolvePrefix(
         queue,
         prefix,
         timestamp=self.data_store.ALL_TIMESTAMPS,
-        token=self.token):
-      task = rdf_flows.GrrMessage.FromSerializedString(serialized)
+        token=self.token)
+
+    all_tasks = rdf_flows.GrrMessage.ParseMany(
+        [serialized for _, serialized, _ in records])
+    for task, (_, _, ts) in zip(all_tasks, records):
       task.eta = ts
-      all_tasks.append(task)
 
     # Sort the tasks in order of priority.
     all_tasks.sort(key=lambda task: task.priority, reverse=True)
@@ -901,6 +1040,121 @@ class QueueManager(object):
                    ttl_exceeded_count, transaction.subject)
     return tasks
 
+  def FetchClientTasks(self, queue, lease_seconds=10, limit=1):
+    """Returns a list of Tasks without leasing them in a transaction.
+
+    This is an alternative to QueryAndOwn for client queues. Handed out tasks
+    are not rewritten. Instead, every call that hands out tasks appends one
+    delivery record listing their ids to the queue. A task is handed out again
+    once its last delivery is lease_seconds old, and dropped once it was
+    handed out as often as its ttl allows.
+
+    Concurrent calls for the same queue do not wait for each other. They both
+    append their records and then read them back; tasks listed in both
+    records are left to the call that wrote the earlier one.
+
+    Args:
+      queue: The queue to query from.
+      lease_seconds: Handed out tasks are not handed out again for this long.
+      limit: Number of values to fetch.
+    Returns:
+        A list of GrrMessage() objects. Their task_ttl is decremented once for
+        every time they were handed out, as QueryAndOwn does.
+    """
+    now = rdfvalue.RDFDatetime.Now().AsMicroSecondsFromEpoch()
+    lease = long(lease_seconds * 1e6)
+
+    tasks = {}
+    live_task_ids = set()
+    records = []
+    for predicate, value, timestamp in self.data_store.ResolvePrefix(
+        queue, [self.TASK_PREDICATE_PREFIX, self.TASK_DELIVERY_PREDICATE],
+        timestamp=self.data_store.ALL_TIMESTAMPS,
+        token=self.token):
+      if predicate == self.TASK_DELIVERY_PREDICATE:
+        records.append((timestamp, value))
+        continue
+
+      task = rdf_flows.GrrMessage.FromSerializedString(value)
+      live_task_ids.add(task.task_id)
+      # Only hand out tasks with timestamps in the past.
+      if timestamp <= now:
+        task.eta = timestamp
+        tasks[task.task_id] = task
+
+    mutation_pool = self.data_store.GetMutationPool(token=self.token)
+
+    # Maps task ids to the times the task was handed out.
+    deliveries = {}
+    for timestamp, value in records:
+      task_ids = self._DecodeTaskDelivery(value)
+      if live_task_ids.isdisjoint(task_ids):
+        # All the tasks of this record are gone, it is not needed anymore.
+        mutation_pool.DeleteAttributes(
+            queue, [self.TASK_DELIVERY_PREDICATE], start=timestamp,
+            end=timestamp)
+        continue
+
+      for task_id in task_ids:
+        deliveries.setdefault(task_id, []).append(timestamp)
+
+    result = []
+    ttl_exceeded_count = 0
+    for task_id, task in sorted(tasks.iteritems()):
+      delivered = deliveries.get(task_id, [])
+      if delivered and max(delivered) > now - lease:
+        continue
+
+      task.task_ttl -= len(delivered) + 1
+      if task.task_ttl <= 0:
+        # Remove the task if ttl is exhausted.
+        self.Delete(queue, [task_id], mutation_pool=mutation_pool)
+        ttl_exceeded_count += 1
+        stats.STATS.IncrementCounter("grr_task_ttl_expired_count")
+        continue
+
+      if delivered:
+        stats.STATS.IncrementCounter("grr_task_retransmission_count")
+
+      result.append(task)
+      if len(result) >= limit:
+        break
+
+    record = ",".join(str(task.task_id) for task in result)
+    if result:
+      mutation_pool.Set(
+          queue,
+          self.TASK_DELIVERY_PREDICATE,
+          record,
+          timestamp=now,
+          replace=False)
+    mutation_pool.Flush()
+
+    if ttl_exceeded_count:
+      logging.info("TTL exceeded for %d messages on queue %s",
+                   ttl_exceeded_count, queue)
+
+    if not result:
+      return result
+
+    # Tasks in records written since we read the queue were handed out by a
+    # concurrent call. The earlier record wins.
+    raced_task_ids = set()
+    for _, value, timestamp in self.data_store.ResolvePrefix(
+        queue,
+        self.TASK_DELIVERY_PREDICATE,
+        timestamp=self.data_store.ALL_TIMESTAMPS,
+        token=self.token):
+      if now - lease < timestamp and (timestamp, utils.SmartStr(value)) < (
+          now, record):
+        raced_task_ids.update(self._DecodeTaskDelivery(value))
+
+    return [task for task in result if task.task_id not in raced_task_ids]
+
+  def _DecodeTaskDelivery(self, value):
+    """Returns the task ids listed in a delivery record."""
+    return set(long(task_id) for task_id in utils.SmartStr(value).split(","))
+
 
 class WellKnownQueueManager(QueueManager):
   """A flow manager for well known flows."""
@@ -2,6 +2,7 @@
 """Tests the queue manager."""
 
 
+import threading
 import time
 
 
@@ -13,6 +14,7 @@ from grr.lib import queues
 from grr.lib import rdfvalue
 from grr.lib import stats
 from grr.lib import test_lib
+from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
 
 # pylint: mode=test
@@ -398,6 +400,80 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
     # But the id should not change
     self.assertEqual(tasks[0].task_id, original_id)
 
+  def testFetchClientTasks(self):
+    """Tasks are handed out without being rewritten."""
+    test_queue = rdfvalue.RDFURN("fooFetch")
+    task = rdf_flows.GrrMessage(
+        queue=test_queue,
+        task_ttl=5,
+        session_id="aff4:/Test",
+        generate_task_id=True)
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.Schedule([task])
+    _, scheduled_ts = data_store.DB.Resolve(
+        test_queue, manager._TaskIdToColumn(task.task_id), token=self.token)
+
+    tasks = manager.FetchClientTasks(test_queue, lease_seconds=100, limit=100)
+    self.assertEqual(len(tasks), 1)
+    self.assertEqual(tasks[0].task_ttl, 4)
+    self.assertEqual(tasks[0].session_id, "aff4:/Test")
+
+    # The task itself is untouched.
+    value, ts = data_store.DB.Resolve(
+        test_queue, manager._TaskIdToColumn(task.task_id), token=self.token)
+    self.assertEqual(ts, scheduled_ts)
+    self.assertEqual(rdf_flows.GrrMessage.FromSerializedString(value).task_ttl,
+                     5)
+
+    # It is not handed out again until the delivery expires.
+    self._current_mock_time += 10
+    tasks = manager.FetchClientTasks(test_queue, lease_seconds=100, limit=100)
+    self.assertEqual(len(tasks), 0)
+
+    for ttl in range(3, 0, -1):
+      self._current_mock_time += 110
+      tasks = manager.FetchClientTasks(test_queue, lease_seconds=100)
+      self.assertEqual(len(tasks), 1)
+      self.assertEqual(tasks[0].task_ttl, ttl)
+
+    # The task is now gone.
+    self._current_mock_time += 110
+    tasks = manager.FetchClientTasks(test_queue, lease_seconds=100)
+    self.assertEqual(len(tasks), 0)
+    self.assertEqual(manager.Query(test_queue), [])
+
+    # And the delivery records are dropped with it.
+    manager.FetchClientTasks(test_queue, lease_seconds=100)
+    self.assertEqual(
+        data_store.DB.ResolvePrefix(
+            test_queue,
+            manager.TASK_DELIVERY_PREDICATE,
+            timestamp=data_store.DB.ALL_TIMESTAMPS,
+            token=self.token), [])
+
+  def testFetchClientTasksPriority(self):
+    test_queue = rdfvalue.RDFURN("fooFetchPriority")
+
+    tasks = []
+    for i in range(10):
+      tasks.append(
+          rdf_flows.GrrMessage(
+              session_id="Test%d" % i,
+              priority=i % 3,
+              queue=test_queue,
+              generate_task_id=True))
+
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.Schedule(tasks)
+
+    for priority, count in [(2, 3), (1, 3), (0, 4)]:
+      tasks = manager.FetchClientTasks(test_queue, lease_seconds=100, limit=3)
+      if count > 3:
+        tasks += manager.FetchClientTasks(
+            test_queue, lease_seconds=100, limit=100)
+
+      self.assertEqual([task.priority for task in tasks], [priority] * count)
+
   def testPriorityScheduling(self):
     test_queue = rdfvalue.RDFURN("fooReschedule")
 
@@ -594,6 +670,127 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
     notifications = manager.GetNotificationsForAllShards(queues.HUNTS)
     self.assertEqual(len(notifications), 2)
 
+  def testGetNotificationsByPriorityForQueues(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    for flow_name in ["42", "43"]:
+      manager.QueueNotification(session_id=rdfvalue.SessionID(
+          base="aff4:/hunts", queue=queues.HUNTS, flow_name=flow_name))
+      manager.Flush()
+    manager.QueueNotification(session_id=rdfvalue.SessionID(
+        base="aff4:/flows", queue=queues.FLOWS, flow_name="44"))
+    manager.Flush()
+
+    with test_lib.Instrument(data_store.DB, "MultiResolvePrefix") as resolve:
+      notifications_by_queue = manager.GetNotificationsByPriorityForQueues(
+          [queues.HUNTS, queues.FLOWS])
+
+    self.assertEqual(resolve.call_count, 1)
+    hunt_notifications = sum(notifications_by_queue[queues.HUNTS].values(), [])
+    flow_notifications = sum(notifications_by_queue[queues.FLOWS].values(), [])
+    self.assertEqual(
+        sorted(n.session_id.FlowName() for n in hunt_notifications),
+        ["42", "43"])
+    self.assertEqual([n.session_id.FlowName() for n in flow_notifications],
+                     ["44"])
+
+  def _WriteNotifications(self, queue_shard, flow_names):
+    manager = queue_manager.QueueManager(token=self.token)
+    values = {}
+    for flow_name in flow_names:
+      session_id = rdfvalue.SessionID(
+          base="aff4:/hunts", queue=queues.HUNTS, flow_name=flow_name)
+      values[manager.NOTIFY_PREDICATE_TEMPLATE % session_id] = [
+          rdf_flows.GrrNotification(
+              session_id=session_id, first_queued=1).SerializeToString()
+      ]
+    data_store.DB.MultiSet(queue_shard, values, token=self.token)
+
+  def testNotificationLimitIsAppliedPerShard(self):
+    self._WriteNotifications(queues.HUNTS,
+                             ["busy%d" % i for i in range(10001)])
+    self._WriteNotifications(queues.HUNTS.Add("1"), ["42"])
+    self._WriteNotifications(queues.FLOWS, ["43"])
+
+    with utils.Stubber(queue_manager.QueueManager, "empty_notification_shards",
+                       {}):
+      with test_lib.ConfigOverrider({
+          "Worker.notification_shard_max_backoff": 10
+      }):
+        manager = queue_manager.QueueManager(token=self.token)
+        notifications_by_queue = manager.GetNotificationsByPriorityForQueues(
+            [queues.HUNTS, queues.FLOWS])
+
+        hunt_notifications = sum(
+            notifications_by_queue[queues.HUNTS].values(), [])
+        flow_notifications = sum(
+            notifications_by_queue[queues.FLOWS].values(), [])
+        hunt_names = set(n.session_id.FlowName() for n in hunt_notifications)
+        self.assertIn("42", hunt_names)
+        self.assertEqual(len(hunt_names), manager.notification_limit + 1)
+        self.assertEqual([n.session_id.FlowName() for n in flow_notifications],
+                         ["43"])
+
+        # Only the shards which really are empty are backed off.
+        self.assertEqual(
+            sorted(manager.empty_notification_shards),
+            [str(queues.FLOWS.Add("1"))])
+
+  def testShardsCutOffByTheLimitAreReadAgain(self):
+    self._WriteNotifications(queues.HUNTS, ["busy%d" % i for i in range(20)])
+    self._WriteNotifications(queues.HUNTS.Add("1"), ["42"])
+
+    with utils.MultiStubber(
+        (queue_manager.QueueManager, "empty_notification_shards", {}),
+        (queue_manager.QueueManager, "notification_limit", 5)):
+      with test_lib.ConfigOverrider({
+          "Worker.notification_shard_max_backoff": 10
+      }):
+        manager = queue_manager.QueueManager(token=self.token)
+        with test_lib.Instrument(data_store.DB,
+                                 "MultiResolvePrefix") as resolve:
+          notifications = manager.GetNotificationsByPriorityForQueues(
+              [queues.HUNTS])[queues.HUNTS]
+
+        hunt_names = set(
+            n.session_id.FlowName() for n in sum(notifications.values(), []))
+        self.assertIn("42", hunt_names)
+        self.assertEqual(len(hunt_names), 6)
+        self.assertLessEqual(resolve.call_count, 2)
+        self.assertFalse(manager.empty_notification_shards)
+
+  def testEmptyNotificationShardsAreBackedOff(self):
+    session_id = rdfvalue.SessionID(
+        base="aff4:/hunts", queue=queues.HUNTS, flow_name="42")
+
+    with utils.Stubber(queue_manager.QueueManager, "empty_notification_shards",
+                       {}):
+      with test_lib.ConfigOverrider({
+          "Worker.notification_shard_max_backoff": 10
+      }):
+        with test_lib.FakeTime(1000):
+          manager = queue_manager.QueueManager(token=self.token)
+          notifications = manager.GetNotificationsByPriorityForQueues(
+              [queues.HUNTS])
+          self.assertFalse(notifications[queues.HUNTS])
+
+          manager.QueueNotification(session_id=session_id)
+          manager.Flush()
+
+          # All shards were empty, so they are not polled again right away.
+          with test_lib.Instrument(data_store.DB,
+                                   "MultiResolvePrefix") as resolve:
+            notifications = manager.GetNotificationsByPriorityForQueues(
+                [queues.HUNTS])
+          self.assertEqual(resolve.call_count, 0)
+          self.assertFalse(notifications[queues.HUNTS])
+
+        with test_lib.FakeTime(1001):
+          notifications = manager.GetNotificationsByPriorityForQueues(
+              [queues.HUNTS])
+          self.assertEqual(
+              sum(notifications[queues.HUNTS].values(), [])[0].session_id,
+              session_id)
+
   def testNotificationRequeueing(self):
     with test_lib.ConfigOverrider({"Worker.queue_shards": 1}):
       session_id = rdfvalue.SessionID(
@@ -641,6 +838,61 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
           self.assertEqual(len(notifications), 0)
 
 
+class ClientQueueBenchmark(test_lib.AverageMicroBenchmarks):
+  """Compares QueryAndOwn and FetchClientTasks under concurrent pollers."""
+
+  NUM_TASKS = 500
+  NUM_POLLERS = 10
+  TASKS_PER_POLL = 10
+
+  def _Drain(self, fetch):
+    """Drains a queue with concurrent pollers.
+
+    Args:
+      fetch: QueryAndOwn or FetchClientTasks of a queue manager.
+
+    Returns:
+      A tuple (seconds taken, polls made, polls that got no tasks, tasks handed
+      out more than once).
+    """
+    test_queue = rdfvalue.RDFURN("fooClientQueueBenchmark")
+    data_store.DB.DeleteSubject(test_queue, token=self.token)
+    queue_manager.QueueManager(token=self.token).Schedule([
+        rdf_flows.GrrMessage(
+            queue=test_queue, session_id="aff4:/Test", generate_task_id=True)
+        for _ in range(self.NUM_TASKS)
+    ])
+
+    handed_out = []
+    # The number of tasks each poll got.
+    polls = []
+
+    def Poll():
+      while len(set(handed_out)) < self.NUM_TASKS:
+        tasks = fetch(test_queue, lease_seconds=1000, limit=self.TASKS_PER_POLL)
+        polls.append(len(tasks))
+        handed_out.extend(task.task_id for task in tasks)
+
+    threads = [threading.Thread(target=Poll) for _ in range(self.NUM_POLLERS)]
+    start = time.time()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    return (time.time() - start, len(polls), polls.count(0),
+            len(handed_out) - len(set(handed_out)))
+
+  def testConcurrentPollers(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    for fetch in [manager.QueryAndOwn, manager.FetchClientTasks]:
+      time_taken, polls, empty_polls, duplicates = self._Drain(fetch)
+      self.AddResult("%s (empty polls)" % fetch.__name__, time_taken, polls,
+                     empty_polls)
+      self.AddResult("%s (duplicates)" % fetch.__name__, time_taken, polls,
+                     duplicates)
+
+
 def main(argv):
   test_lib.main(argv)
 
@@ -160,6 +160,27 @@ class RDFValue(object):
       res.age = age
     return res
 
+  @classmethod
+  def ParseMany(cls, values, age=None):
+    """Parses a list of serialized values into instances of this class.
+
+    This is the bulk version of FromSerializedString(). Derived classes can
+    override it to share the work between all the values.
+
+    Args:
+      values: An iterable of serialized values.
+      age: If set, the age of all the parsed values.
+
+    Returns:
+      A list of instances of this class.
+    """
+    return [cls.FromSerializedString(value, age=age) for value in values]
+
+  @classmethod
+  def SerializeMany(cls, values):
+    """Serializes a list of values, the inverse of ParseMany()."""
+    return [value.SerializeToString() for value in values]
+
   def SerializeToDataStore(self):
     """Serialize to a datastore compatible form."""
     return self.SerializeToString()
@@ -881,6 +902,12 @@ class RDFURN(RDFValue):
 
   _string_urn = ""
 
+  # Normalized paths by the string they were parsed from. The same URNs (client
+  # roots, queues, hunts) are parsed over and over again, so this saves
+  # normalizing them each time and makes the URNs share their path strings.
+  _normalized_paths = {}
+  max_normalized_paths = 10000
+
   def __init__(self, initializer=None, age=None):
     """Constructor.
 
@@ -909,11 +936,25 @@ class RDFURN(RDFValue):
     Args:
       initializer: url string
     """
+    cacheable = initializer.__class__ is str or initializer.__class__ is unicode
+    if cacheable:
+      path = RDFURN._normalized_paths.get(initializer)
+      if path is not None:
+        self._string_urn = path
+        return
+
     # Strip off the aff4: prefix if necessary.
     if initializer.startswith("aff4:/"):
-      initializer = initializer[5:]
+      path = utils.NormalizePath(initializer[5:])
+    else:
+      path = utils.NormalizePath(initializer)
 
-    self._string_urn = utils.NormalizePath(initializer)
+    if cacheable:
+      if len(RDFURN._normalized_paths) >= self.max_normalized_paths:
+        RDFURN._normalized_paths.clear()
+      RDFURN._normalized_paths[initializer] = path
+
+    self._string_urn = path
 
   def SerializeToString(self):
     return str(self)
@@ -954,8 +995,29 @@ class RDFURN(RDFValue):
     if not isinstance(path, basestring):
       raise ValueError("Only strings should be added to a URN.")
 
-    result = self.Copy(age)
-    result.Update(path=utils.JoinPath(self._string_urn, path))
+    if self.__class__ is not RDFURN:
+      result = self.Copy(age)
+      result.Update(path=utils.JoinPath(self._string_urn, path))
+
+      return result
+
+    # Our path is already normalized so there is no need to go through the
+    # constructor, Update() and JoinPath() for plain RDFURNs.
+    if age is None:
+      age = int(time.time() * MICROSECONDS)
+
+    # Both halves are normalized, so joining them is plain concatenation.
+    stem = self._string_urn
+    if stem == "/":
+      stem = ""
+    suffix = utils.NormalizePath(path)
+    if suffix == "/":
+      suffix = ""
+
+    result = RDFURN.__new__(RDFURN)
+    result._string_urn = stem + suffix or "/"
+    result._age = age
+    result.dirty = True
 
     return result
 
@@ -218,6 +218,25 @@ class RDFURNTest(test_base.RDFValueTestCase):
     for path in ["aff4:/test/?#asd", "aff4:/test/#asd", "aff4:/test/?#"]:
       self.assertEqual(path, str(rdfvalue.RDFURN(path)))
 
+  def testAddNormalizesPath(self):
+    url = rdfvalue.RDFURN("aff4:/hunts/W:AAAAAAAA")
+    self.assertEqual(url.Add("/a//b/").Path(), "/hunts/W:AAAAAAAA/a/b")
+    self.assertEqual(url.Add("../../x/./y").Path(), "/hunts/W:AAAAAAAA/x/y")
+    self.assertEqual(url.Add("").Path(), "/hunts/W:AAAAAAAA")
+    self.assertEqual(rdfvalue.RDFURN("aff4:/").Add("a").Path(), "/a")
+    self.assertEqual(rdfvalue.RDFURN("aff4:/").Add("/").Path(), "/")
+
+  def testParsedPathsAreCached(self):
+    with utils.Stubber(rdfvalue.RDFURN, "max_normalized_paths", 2):
+      for _ in range(3):
+        for path in ["a/../b", "aff4:/c/", u"/d//e"]:
+          rdfvalue.RDFURN(path)
+          self.assertLessEqual(len(rdfvalue.RDFURN._normalized_paths), 2)
+
+      self.assertEqual(rdfvalue.RDFURN("a/../b").Path(), "/b")
+      self.assertEqual(rdfvalue.RDFURN("aff4:/c/").Path(), "/c")
+      self.assertEqual(rdfvalue.RDFURN(u"/d//e").Path(), "/d/e")
+
   def testComparison(self):
     urn = rdfvalue.RDFURN("aff4:/abc/def")
     self.assertEqual(urn, str(urn))
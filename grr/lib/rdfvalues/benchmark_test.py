@@ -2,10 +2,15 @@
 """This module tests the RDFValue implementation for performance."""
 
 
+import gc
+import sys
 
+from grr.lib import rdfvalue
 from grr.lib import test_lib
 from grr.lib import type_info
+from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import structs as rdf_structs
 from grr.proto import jobs_pb2
 from grr.proto import knowledge_base_pb2
@@ -53,6 +58,25 @@ class FastGrrMessageList(rdf_structs.RDFProtoStruct):
               name="job", field_number=1, nested=StructGrrMessage)))
 
 
+class PlainGrrMessage(rdf_structs.RDFProtoStruct):
+  """A GrrMessage without the compiled layout."""
+  protobuf = jobs_pb2.GrrMessage
+
+
+def StructSize(struct):
+  """Approximate memory held by a struct, not counting the field values."""
+  raw_data = struct.GetRawData()
+  size = sys.getsizeof(struct) + sys.getsizeof(raw_data)
+  size += sum(sys.getsizeof(entry) for entry in raw_data.itervalues())
+
+  # Add the instance dict if the struct has one.
+  for referent in gc.get_referents(struct):
+    if isinstance(referent, dict) and referent is not raw_data:
+      size += sys.getsizeof(referent)
+
+  return size
+
+
 class RDFValueBenchmark(test_lib.AverageMicroBenchmarks):
   """Microbenchmark tests for RDFProtos."""
 
@@ -337,3 +361,148 @@ class RDFValueBenchmark(test_lib.AverageMicroBenchmarks):
 
     self.TimeIt(RDFStructDecodeEncode)
     self.TimeIt(ProtoDecodeEncode)
+
+  def testAcceleratedDecodeEncode(self):
+    """Compare the C extension to the pure Python parser and serializer."""
+    repeats = self.REPEATS / 50
+
+    message_list = FastGrrMessageList()
+    for i in range(self.REPEATS):
+      message_list.job.Append(
+          session_id="test", name="foobar", request_id=i, args="x" * 100)
+
+    data = message_list.SerializeToString()
+
+    def DecodeEncode():
+      s = FastGrrMessageList.FromSerializedString(data)
+      self.assertEqual(s.job[100].request_id, 100)
+      s.SerializeToString()
+
+    self.TimeIt(
+        DecodeEncode, "Accelerated MessageList Decode/Encode",
+        repetitions=repeats)
+
+    with utils.MultiStubber(
+        (rdf_structs, "ReadIntoObject", rdf_structs.PythonReadIntoObject),
+        (rdf_structs, "SerializeEntries", rdf_structs.PythonSerializeEntries),
+        (rdf_structs, "SplitBuffer", rdf_structs.PythonSplitBuffer)):
+      self.TimeIt(
+          DecodeEncode, "Python MessageList Decode/Encode",
+          repetitions=repeats)
+
+  def testRepeatedFieldPassthrough(self):
+    """Re-serialize a large MessageList after routing on a few fields."""
+    repeats = self.REPEATS / 50
+
+    message_list = FastGrrMessageList()
+    for i in range(self.REPEATS):
+      message_list.job.Append(
+          session_id="test", name="foobar", request_id=i, args="x" * 10000)
+
+    data = message_list.SerializeToString()
+
+    def ProtoPassthrough():
+      s = jobs_pb2.MessageList()
+      s.ParseFromString(data)
+      self.assertEqual(s.job[100].request_id, 100)
+      s.SerializeToString()
+
+    def RDFStructPassthrough():
+      s = FastGrrMessageList.FromSerializedString(data)
+      self.assertEqual(s.job[100].request_id, 100)
+      s.SerializeToString()
+
+    self.TimeIt(
+        RDFStructPassthrough, "RDFStruct Repeated Passthrough",
+        repetitions=repeats)
+    self.TimeIt(
+        ProtoPassthrough, "Protobuf Repeated Passthrough", repetitions=repeats)
+
+  def testURNCreation(self):
+    """Parse URNs and derive child URNs from them."""
+    client_id = rdf_client.ClientURN("C.0000000000000001")
+    hunt_urn = rdfvalue.RDFURN("aff4:/hunts/H:123456")
+
+    def ParseURN():
+      return rdfvalue.RDFURN("aff4:/C.0000000000000001/flows")
+
+    def ParseUnnormalizedURN():
+      return rdfvalue.RDFURN("aff4:/C.0000000000000001/fs/os/../os/./c/")
+
+    def AddToClientURN():
+      return client_id.Add("flows/W:ABCDEF")
+
+    def AddChain():
+      return hunt_urn.Add("Results").Add("C.0000000000000001").Add("W:ABCDEF")
+
+    self.TimeIt(ParseURN, "RDFURN from string")
+    self.TimeIt(ParseUnnormalizedURN, "RDFURN from unnormalized string")
+    self.TimeIt(AddToClientURN, "ClientURN Add")
+    self.TimeIt(AddChain, "RDFURN chained Add")
+
+  def testCompiledStructs(self):
+    """Compare compiled and plain structs. Value is the size in bytes."""
+    data = PlainGrrMessage(
+        session_id="aff4:/flows/W:ABCDEF",
+        request_id=1,
+        response_id=2,
+        name="ListDirectory",
+        task_id=1234,
+        args="x" * 100).SerializeToString()
+
+    def ParseAndRead(cls):
+      s = cls.FromSerializedString(data)
+      # Fields are decoded on first access and cached after that.
+      for _ in range(2):
+        fields = (s.session_id, s.request_id, s.response_id, s.name)
+        self.assertEqual(fields[1], 1)
+
+      return StructSize(s)
+
+    def CreateAndSerialize(cls):
+      s = cls(session_id="aff4:/flows/W:ABCDEF",
+              request_id=1,
+              response_id=2,
+              name="ListDirectory")
+      s.SerializeToString()
+
+      return StructSize(s)
+
+    for cls in [PlainGrrMessage, rdf_flows.GrrMessage]:
+      prefix = "Compiled" if cls.compiled else "Plain"
+      self.TimeIt(ParseAndRead, "%s struct parse and read" % prefix, cls=cls)
+      self.TimeIt(
+          CreateAndSerialize, "%s struct create and serialize" % prefix,
+          cls=cls)
+
+  def testParseSerializeMany(self):
+    """Compare bulk and one at a time parsing of a list of messages."""
+    messages = [
+        rdf_flows.GrrMessage(
+            session_id="aff4:/flows/W:ABCDEF",
+            request_id=1,
+            response_id=i,
+            name="ListDirectory",
+            args="x" * 100) for i in range(100)
+    ]
+    serialized = [message.SerializeToString() for message in messages]
+
+    def ParseOneByOne():
+      return len([
+          rdf_flows.GrrMessage.FromSerializedString(data)
+          for data in serialized
+      ])
+
+    def ParseMany():
+      return len(rdf_flows.GrrMessage.ParseMany(serialized))
+
+    def SerializeOneByOne():
+      return len([message.SerializeToString() for message in messages])
+
+    def SerializeMany():
+      return len(rdf_flows.GrrMessage.SerializeMany(messages))
+
+    self.TimeIt(ParseOneByOne, "Parse 100 messages one by one")
+    self.TimeIt(ParseMany, "ParseMany 100 messages")
+    self.TimeIt(SerializeOneByOne, "Serialize 100 messages one by one")
+    self.TimeIt(SerializeMany, "SerializeMany 100 messages")
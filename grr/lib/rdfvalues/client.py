@@ -116,10 +116,7 @@ class ClientURN(rdfvalue.RDFURN):
     if not isinstance(path, basestring):
       raise ValueError("Only strings should be added to a URN.")
 
-    result = rdfvalue.RDFURN(self.Copy(age))
-    result.Update(path=utils.JoinPath(self._string_urn, path))
-
-    return result
+    return rdfvalue.RDFURN(self).Add(path, age=age)
 
   def Queue(self):
     """Returns the queue name of this clients task queue."""
@@ -645,6 +642,7 @@ class Iterator(structs.RDFProtoStruct):
 class StatEntry(structs.RDFProtoStruct):
   """Represent an extended stat response."""
   protobuf = jobs_pb2.StatEntry
+  compiled = True
 
 
 class FindSpec(structs.RDFProtoStruct):
@@ -20,6 +20,7 @@ from grr.proto import output_plugin_pb2
 class GrrMessage(rdf_structs.RDFProtoStruct):
   """An RDFValue class to manage GRR messages."""
   protobuf = jobs_pb2.GrrMessage
+  compiled = True
 
   lock = threading.Lock()
   next_id_base = 0
@@ -139,10 +140,12 @@ class GrrStatus(rdf_structs.RDFProtoStruct):
 class GrrNotification(rdf_structs.RDFProtoStruct):
   """A flow notification."""
   protobuf = jobs_pb2.GrrNotification
+  compiled = True
 
 
 class RequestState(rdf_structs.RDFProtoStruct):
   protobuf = jobs_pb2.RequestState
+  compiled = True
 
 
 class UnknownObject(object):
@@ -42,6 +42,7 @@ class PathSpec(rdf_structs.RDFProtoStruct):
   helpers.
   """
   protobuf = jobs_pb2.PathSpec
+  compiled = True
 
   def CopyConstructor(self, other):
     # pylint: disable=protected-access
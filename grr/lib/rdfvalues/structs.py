@@ -4,6 +4,7 @@
 
 import base64
 import copy
+import itertools
 import struct
 
 
@@ -11,7 +12,11 @@ import struct
 try:
   from grr.accelerated import _semantic
 except ImportError:
-  _semantic = None
+  try:
+    # This is where setup.py installs the extension.
+    from grr import _semantic
+  except ImportError:
+    _semantic = None
 
 from google.protobuf import any_pb2
 from google.protobuf import wrappers_pb2
@@ -193,6 +198,22 @@ def SplitBuffer(buff, index=0, length=None):
       raise rdfvalue.DecodeError("Unexpected Tag.")
 
 
+class WireFormatSlice(tuple):
+  """Where the wire format of a field lies in a serialized buffer.
+
+  This is a (buffer, start, tag_end, data_start, end) tuple. Elements of
+  repeated fields are kept like this instead of being copied out of the buffer
+  when it is parsed. Elements which are never accessed or modified are written
+  back by copying their bytes straight from the original buffer.
+  """
+  __slots__ = ()
+
+  def WireFormat(self):
+    """Returns the (encoded_tag, encoded_length, wire_format) tuple."""
+    buff, start, tag_end, data_start, end = self
+    return (buff[start:tag_end], buff[tag_end:data_start], buff[data_start:end])
+
+
 def SerializeEntries(entries):
   """Serializes given triplets of python and wire values and a descriptor."""
   output = []
@@ -211,11 +232,14 @@ def ReadIntoObject(buff, index, value_obj, length=0):
   """Reads all tags until the next end group and store in the value_obj."""
   raw_data = value_obj.GetRawData()
   count = 0
+  end = index
 
   # Split the buffer into tags and wire_format representations, then collect
   # these into the raw data cache.
   for (encoded_tag, encoded_length, encoded_field) in SplitBuffer(
       buff, index=index, length=length):
+    start = end
+    end += len(encoded_tag) + len(encoded_length) + len(encoded_field)
 
     type_info_obj = value_obj.type_infos_by_encoded_tag.get(encoded_tag)
 
@@ -243,17 +267,86 @@ def ReadIntoObject(buff, index, value_obj, length=0):
 
     # Repeated fields are handled especially.
     elif type_info_obj.__class__ is ProtoList:
-      value_obj.Get(type_info_obj.name).wrapped_list.append((None, wire_format))
+      value_obj.Get(type_info_obj.name).wrapped_list.append(
+          (None, WireFormatSlice((buff, start, start + len(encoded_tag),
+                                  end - len(encoded_field), end))))
 
     else:
       # Set the python_format as None so it gets converted lazily on access.
       raw_data[type_info_obj.name] = (None, wire_format, type_info_obj)
 
+
+def AcceleratedReadIntoObject(buff, index, value_obj, length=0):
+  """Like ReadIntoObject() but parses the buffer in the C extension."""
+  repeated_fields = _semantic.read_into_object(
+      buff, index, length, value_obj.type_infos_by_encoded_tag,
+      value_obj.GetRawData(), ProtoList, WireFormatSlice)
+
+  for name, elements in repeated_fields.iteritems():
+    value_obj.Get(name).wrapped_list.extend(elements)
+
+
+def ReadIntoObjects(buffers, value_objs):
+  """Reads each buffer into the value_obj at the same position."""
+  for buff, value_obj in itertools.izip(buffers, value_objs):
+    ReadIntoObject(buff, 0, value_obj)
+
+
+def AcceleratedReadIntoObjects(buffers, value_objs):
+  """Like ReadIntoObjects() but parses all buffers in one extension call.
+
+  Args:
+    buffers: A list of serialized structs.
+    value_objs: A list of structs of the same class to parse the buffers into.
+  """
+  if not value_objs:
+    return
+
+  repeated_fields = _semantic.read_into_objects(
+      buffers, value_objs[0].type_infos_by_encoded_tag,
+      [value_obj.GetRawData() for value_obj in value_objs], ProtoList,
+      WireFormatSlice)
+
+  for value_obj, repeated in itertools.izip(value_objs, repeated_fields):
+    for name, elements in repeated.iteritems():
+      value_obj.Get(name).wrapped_list.extend(elements)
+
+
+def SerializeObjects(value_objs):
+  """Serializes the raw data of each struct in value_objs."""
+  return [SerializeEntries(value_obj.GetRawData().itervalues())
+          for value_obj in value_objs]
+
+
+def AcceleratedSerializeObjects(value_objs):
+  """Like SerializeObjects() but serializes all structs in one C call."""
+  return _semantic.serialize_many(
+      [value_obj.GetRawData() for value_obj in value_objs])
+
+
+# Keep the pure Python implementations around to compare against.
+PythonVarintEncode = VarintEncode
+PythonVarintReader = VarintReader
+PythonSplitBuffer = SplitBuffer
+PythonSerializeEntries = SerializeEntries
+PythonReadIntoObject = ReadIntoObject
+PythonReadIntoObjects = ReadIntoObjects
+PythonSerializeObjects = SerializeObjects
+
 # pylint: disable=invalid-name
 if _semantic:
   VarintEncode = _semantic.varint_encode
   VarintReader = _semantic.varint_decode
   SplitBuffer = _semantic.split_buffer
+
+  # Older builds of the extension do not have these.
+  if _semantic.get_version() >= u"20161017":
+    ReadIntoObject = AcceleratedReadIntoObject
+    SerializeEntries = _semantic.serialize_entries
+
+  if _semantic.get_version() >= u"20161018":
+    ReadIntoObjects = AcceleratedReadIntoObjects
+    SerializeObjects = AcceleratedSerializeObjects
 # pylint: enable=invalid-name
 
 
@@ -1102,9 +1195,11 @@ class RepeatedFieldHelper(object):
     if self.dirty:
       return True
 
-    # If any of the items is dirty we are also dirty.
-    for item in self.wrapped_list:
-      if self.type_descriptor.IsDirty(item[0]):
+    # If any of the items is dirty we are also dirty. Items which were never
+    # decoded can not have been modified.
+    for python_format, _ in self.wrapped_list:
+      if (python_format is not None and
+          self.type_descriptor.IsDirty(python_format)):
         self.dirty = True
         return True
 
@@ -1160,8 +1255,14 @@ class RepeatedFieldHelper(object):
 
     python_format, wire_format = self.wrapped_list[item]
     if python_format is None:
-      python_format = self.type_descriptor.ConvertFromWireFormat(
-          wire_format, container=self.container)
+      if wire_format.__class__ is WireFormatSlice:
+        # Keep the slice so the element can still be written back by copying
+        # its original bytes as long as it is not modified.
+        python_format = self.type_descriptor.ConvertFromWireFormat(
+            wire_format.WireFormat(), container=self.container)
+      else:
+        python_format = self.type_descriptor.ConvertFromWireFormat(
+            wire_format, container=self.container)
 
       self.wrapped_list[item] = (python_format, wire_format)
 
@@ -1270,10 +1371,46 @@ class ProtoList(ProtoType):
     Returns:
       A wire format representation of the value.
     """
-    output = SerializeEntries(
-        (python_format, wire_format, value.type_descriptor)
-        for python_format, wire_format in value.wrapped_list)
-    return ("", "", output)
+    output = []
+    entries = []
+
+    # Consecutive elements which are still where they were parsed from are
+    # copied from the original buffer in one go.
+    run_buffer, run_start, run_end = None, 0, 0
+
+    for python_format, wire_format in value.wrapped_list:
+      if wire_format.__class__ is WireFormatSlice:
+        if (python_format is None or
+            not value.type_descriptor.IsDirty(python_format)):
+          buff, start, _, _, end = wire_format
+          if buff is run_buffer and start == run_end:
+            run_end = end
+            continue
+
+          if entries:
+            output.append(SerializeEntries(entries))
+            entries = []
+          if run_buffer is not None:
+            output.append(run_buffer[run_start:run_end])
+
+          run_buffer, run_start, run_end = buff, start, end
+          continue
+
+        # The element was modified so it needs to be serialized again.
+        wire_format = None
+
+      if run_buffer is not None:
+        output.append(run_buffer[run_start:run_end])
+        run_buffer = None
+
+      entries.append((python_format, wire_format, value.type_descriptor))
+
+    if entries:
+      output.append(SerializeEntries(entries))
+    if run_buffer is not None:
+      output.append(run_buffer[run_start:run_end])
+
+    return ("", "", "".join(output))
 
   def Format(self, value):
     yield "["
@@ -1483,9 +1620,53 @@ class AbstractSerlializer(object):
     """Parse the string and set attributes in the value_obj."""
 
 
+# The instance state of compiled structs (see RDFStruct.compiled).
+COMPILED_STRUCT_SLOTS = ("_age", "_data", "dirty")
+
+
+def CompiledFieldProperty(field_desc):
+  """Returns a property which accesses the raw data of a compiled struct."""
+  # pylint: disable=protected-access
+  name = field_desc.name
+
+  def Getter(self):
+    entry = self._data.get(name)
+    # Defaults are handled by Get().
+    if entry is None:
+      return self.Get(name)
+
+    python_format, wire_format, type_descriptor = entry
+    if python_format is None:
+      python_format = type_descriptor.ConvertFromWireFormat(
+          wire_format, container=self)
+      self._data[name] = (python_format, wire_format, type_descriptor)
+
+    return python_format
+
+  def Setter(self, value):
+    if value is None:
+      self._data.pop(name, None)
+      return
+
+    self._data[name] = (field_desc.Validate(value, container=self), None,
+                        field_desc)
+    self.dirty = True
+
+  return property(Getter, Setter, None, field_desc.description)
+
+
 class RDFStructMetaclass(rdfvalue.RDFValueMetaclass):
   """A metaclass which registers new RDFProtoStruct instances."""
 
+  def __new__(mcs, name, bases, env_dict):
+    # Compiled structs keep their state in slots instead of an instance dict.
+    # Derived classes inherit the slots, so only add them once.
+    if env_dict.get("compiled") and not any(
+        getattr(base, "compiled", False) for base in bases):
+      env_dict.setdefault("__slots__", COMPILED_STRUCT_SLOTS)
+
+    return super(RDFStructMetaclass, mcs).__new__(mcs, name, bases, env_dict)
+
   def __init__(cls, name, bases, env_dict):  # pylint: disable=no-self-argument
     super(RDFStructMetaclass, cls).__init__(name, bases, env_dict)
 
@@ -1567,11 +1748,18 @@ class RDFStruct(rdfvalue.RDFValue):
   # set.
   suppressions = []
 
+  # Hot message types can set this to use a more compact and faster layout. The
+  # instance state lives in __slots__ instead of a per instance __dict__ and the
+  # field accessors read decoded values straight from the raw data. The wire
+  # format is unchanged.
+  compiled = False
+
   def __init__(self, initializer=None, age=None, **kwargs):
     # Maintain the order so that parsing and serializing a proto does not change
     # the serialized form.
     self._data = {}
     self._age = age
+    self.dirty = False
 
     for arg, value in kwargs.iteritems():
       if not hasattr(self.__class__, arg):
@@ -1698,6 +1886,36 @@ class RDFStruct(rdfvalue.RDFValue):
     ReadIntoObject(string, 0, self)
     self.dirty = True
 
+  @classmethod
+  def ParseMany(cls, values, age=None):
+    """Parses a list of serialized structs of this class in one pass."""
+    # Only structs which use the standard wire format can be parsed in bulk.
+    if (cls.ParseFromString.im_func is not RDFStruct.ParseFromString.im_func or
+        cls.FromSerializedString.im_func is not
+        rdfvalue.RDFValue.FromSerializedString.im_func):
+      return super(RDFStruct, cls).ParseMany(values, age=age)
+
+    values = list(values)
+    results = [cls() for _ in values]
+    ReadIntoObjects(values, results)
+
+    for result in results:
+      result.dirty = True
+      if age:
+        result.age = age
+
+    return results
+
+  @classmethod
+  def SerializeMany(cls, values):
+    """Serializes a list of structs of this class in one pass."""
+    values = list(values)
+    if (cls.SerializeToString.im_func is not RDFStruct.SerializeToString.im_func
+        or any(value.__class__ is not cls for value in values)):
+      return super(RDFStruct, cls).SerializeMany(values)
+
+    return SerializeObjects(values)
+
   def __eq__(self, other):
     if not isinstance(other, self.__class__):
       return False
@@ -1871,6 +2089,7 @@ class RDFStruct(rdfvalue.RDFValue):
   def __setstate__(self, data):
     """Support the pickle protocol."""
     self._data = {}
+    self._age = None
     self.ParseFromString(data["data"])
 
 
@@ -2190,6 +2409,10 @@ class RDFProtoStruct(RDFStruct):
 
     # Add direct accessors only if the class does not already have them.
     if not hasattr(cls, field_desc.name):
+      if cls.compiled:
+        setattr(cls, field_desc.name, CompiledFieldProperty(field_desc))
+        return
+
       # This lambda is a class method so pylint: disable=protected-access
       # This is much faster than __setattr__/__getattr__
       setattr(cls, field_desc.name,
@@ -3,6 +3,9 @@
 """Test RDFStruct implementations."""
 
 
+import gc
+import pickle
+import unittest
 
 from google.protobuf import descriptor_pool
 from google.protobuf import message_factory
@@ -11,6 +14,7 @@ from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import test_lib
 from grr.lib import type_info
+from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import paths as rdf_paths
@@ -165,6 +169,20 @@ class UnionTest(structs.RDFProtoStruct):
           description="An integer value"),)
 
 
+class CompiledTestStruct(structs.RDFProtoStruct):
+  """A compiled struct which is wire compatible with TestStruct."""
+  compiled = True
+
+  type_description = type_info.TypeDescriptorSet(
+      type_info.ProtoString(
+          name="foobar", field_number=1, default="string"),
+      type_info.ProtoUnsignedInteger(
+          name="int", field_number=2, default=5),
+      type_info.ProtoList(
+          type_info.ProtoString(
+              name="repeated", field_number=3)),)
+
+
 class RDFStructsTest(test_base.RDFValueTestCase):
   """Test the RDFStruct implementation."""
 
@@ -337,6 +355,32 @@ class RDFStructsTest(test_base.RDFValueTestCase):
     self.assertEqual(len(sliced), 2)
     self.assertEqual(sliced[0].foobar, "Nest3")
 
+  def testRepeatedMemberIsDecodedLazily(self):
+    tested = TestStruct()
+    for i in range(10):
+      tested.repeat_nested.Append(foobar="Nest%s" % i)
+
+    data = tested.SerializeToString()
+
+    new_tested = TestStruct.FromSerializedString(data)
+    self.assertEqual(len(new_tested.repeat_nested), 10)
+
+    wrapped_list = new_tested.repeat_nested.wrapped_list
+    self.assertEqual([x for x, _ in wrapped_list if x is not None], [])
+
+    self.assertEqual(new_tested.repeat_nested[3].foobar, "Nest3")
+    self.assertEqual(len([x for x, _ in wrapped_list if x is not None]), 1)
+
+    # Unmodified elements are written back as they were read.
+    self.assertEqual(new_tested.SerializeToString(), data)
+
+    new_tested.repeat_nested[3].foobar = "Changed"
+    new_tested.repeat_nested.Append(foobar="New")
+    decoded = TestStruct.FromSerializedString(new_tested.SerializeToString())
+    self.assertEqual([x.foobar for x in decoded.repeat_nested],
+                     ["Nest0", "Nest1", "Nest2", "Changed", "Nest4", "Nest5",
+                      "Nest6", "Nest7", "Nest8", "Nest9", "New"])
+
   def testUnknownFields(self):
     """Test that unknown fields are preserved across decode/encode cycle."""
     tested = TestStruct(foobar="hello", int=5)
@@ -634,6 +678,185 @@ class RDFStructsTest(test_base.RDFValueTestCase):
     # Raises if there is a flavored field set that doesn't match struct_flavor.
     self.assertRaises(ValueError, tested_union.UnionCast)
 
+  def testParseMany(self):
+    values = []
+    for i in range(5):
+      tested = TestStruct(foobar="Value%s" % i, int=i)
+      tested.repeat_nested.Append(foobar="Nest%s" % i)
+      values.append(tested)
+
+    serialized = [value.SerializeToString() for value in values]
+    parsed = TestStruct.ParseMany(serialized, age=1000)
+
+    self.assertEqual(parsed, values)
+    for i, value in enumerate(parsed):
+      self.assertEqual(value.age, 1000)
+      self.assertEqual(value.repeat_nested[0].foobar, "Nest%s" % i)
+
+    self.assertEqual(TestStruct.ParseMany([]), [])
+
+  def testSerializeMany(self):
+    values = [TestStruct(foobar="Value%s" % i, int=i) for i in range(5)]
+    self.assertEqual(
+        TestStruct.SerializeMany(values),
+        [value.SerializeToString() for value in values])
+
+    # Values of other classes are serialized by their own class.
+    mixed = [TestStruct(foobar="hello"), PartialTest1(int=5)]
+    self.assertEqual(
+        TestStruct.SerializeMany(mixed),
+        [value.SerializeToString() for value in mixed])
+
+
+@unittest.skipUnless(
+    structs.SerializeEntries is not structs.PythonSerializeEntries,
+    "The semantic protobuf accelerator is not available.")
+class AcceleratedStructsTest(test_lib.GRRBaseTest):
+  """Checks the C extension against the pure Python implementation."""
+
+  def testParsingMatchesPython(self):
+    tested = TestStruct(foobar="hello", int=5)
+    tested.repeated.Append("Good")
+    tested.repeated.Append("Bye")
+    tested.nested.foobar = "goodbye"
+    for i in range(3):
+      tested.repeat_nested.Append(foobar="Nest%s" % i)
+
+    data = tested.SerializeToString()
+
+    with utils.MultiStubber(
+        (structs, "ReadIntoObject", structs.PythonReadIntoObject),
+        (structs, "SerializeEntries", structs.PythonSerializeEntries)):
+      python_tested = TestStruct.FromSerializedString(data)
+      python_partial = PartialTest1.FromSerializedString(data)
+      python_data = python_partial.SerializeToString()
+
+    accelerated_tested = TestStruct.FromSerializedString(data)
+    self.assertEqual(accelerated_tested, python_tested)
+    self.assertEqual(list(accelerated_tested.repeated), ["Good", "Bye"])
+    self.assertEqual(accelerated_tested.repeat_nested[2].foobar, "Nest2")
+    self.assertEqual(accelerated_tested.nested.foobar, "goodbye")
+
+    # Unknown fields are kept and written back the same way.
+    accelerated_partial = PartialTest1.FromSerializedString(data)
+    self.assertEqual(
+        sorted(accelerated_partial.GetRawData().items()),
+        sorted(python_partial.GetRawData().items()))
+    self.assertEqual(
+        TestStruct.FromSerializedString(
+            accelerated_partial.SerializeToString()),
+        TestStruct.FromSerializedString(python_data))
+
+  def testVarintsMatchPython(self):
+    for value in [0, 1, 127, 128, 2**63, 2**64 - 1, 2**64, 2**64 + 1]:
+      encoded = structs.VarintEncode(value)
+      self.assertEqual(encoded, structs.PythonVarintEncode(value))
+      self.assertEqual(structs.VarintReader(encoded),
+                       structs.PythonVarintReader(encoded))
+
+    # Both encoders handle values of any size.
+    self.assertEqual(
+        structs.VarintEncode(2**200), structs.PythonVarintEncode(2**200))
+
+  def testModifiedFieldsAreSerialized(self):
+    tested = TestStruct.FromSerializedString(
+        TestStruct(foobar="hello", int=5).SerializeToString())
+    tested.int = 6
+    tested.repeated.Append("New")
+
+    decoded = TestStruct.FromSerializedString(tested.SerializeToString())
+    self.assertEqual(decoded.foobar, "hello")
+    self.assertEqual(decoded.int, 6)
+    self.assertEqual(list(decoded.repeated), ["New"])
+
+  def testBulkParsingMatchesPython(self):
+    values = []
+    for i in range(10):
+      tested = TestStruct(foobar="Value%s" % i, int=i)
+      tested.repeated.Append("Good")
+      tested.repeat_nested.Append(foobar="Nest%s" % i)
+      values.append(tested)
+
+    with utils.MultiStubber(
+        (structs, "ReadIntoObjects", structs.PythonReadIntoObjects),
+        (structs, "SerializeObjects", structs.PythonSerializeObjects)):
+      python_data = TestStruct.SerializeMany(values)
+      python_parsed = TestStruct.ParseMany(python_data)
+      python_partial = PartialTest1.ParseMany(python_data)
+
+    accelerated_data = TestStruct.SerializeMany(values)
+    self.assertEqual(accelerated_data, python_data)
+    self.assertEqual(TestStruct.ParseMany(accelerated_data), python_parsed)
+
+    # Unknown fields are kept by both implementations.
+    accelerated_partial = PartialTest1.ParseMany(accelerated_data)
+    self.assertEqual(
+        TestStruct.ParseMany(PartialTest1.SerializeMany(accelerated_partial)),
+        TestStruct.ParseMany(PartialTest1.SerializeMany(python_partial)))
+
+
+class CompiledStructsTest(test_lib.GRRBaseTest):
+  """Test structs with a compiled layout."""
+
+  def testStateIsKeptInSlots(self):
+    tested = CompiledTestStruct()
+    self.assertFalse(tested.dirty)
+    tested.foobar = "hello"
+    self.assertTrue(tested.dirty)
+
+    # The raw data is the only dict the struct holds on to.
+    dicts = [x for x in gc.get_referents(tested) if isinstance(x, dict)]
+    self.assertEqual(dicts, [tested.GetRawData()])
+
+  def testAccessors(self):
+    tested = CompiledTestStruct()
+    self.assertEqual(tested.foobar, "string")
+    self.assertEqual(tested.int, 5)
+    self.assertFalse(tested.HasField("int"))
+
+    tested.int = 6
+    self.assertEqual(tested.int, 6)
+    self.assertTrue(tested.dirty)
+    self.assertRaises(type_info.TypeValueError, setattr, tested, "int", "foo")
+
+    tested.int = None
+    self.assertFalse(tested.HasField("int"))
+
+    tested = CompiledTestStruct.FromSerializedString(
+        CompiledTestStruct(foobar="hello").SerializeToString())
+    self.assertIsNone(tested.GetRawData()["foobar"][0])
+    self.assertEqual(tested.foobar, u"hello")
+    self.assertEqual(tested.GetRawData()["foobar"][0], u"hello")
+
+  def testWireCompatibility(self):
+    tested = CompiledTestStruct(foobar="hello", int=6)
+    tested.repeated.Append("Good")
+    data = tested.SerializeToString()
+
+    plain = TestStruct.FromSerializedString(data)
+    self.assertEqual(plain.foobar, "hello")
+    self.assertEqual(plain.int, 6)
+    self.assertEqual(list(plain.repeated), ["Good"])
+
+    self.assertEqual(
+        CompiledTestStruct.FromSerializedString(
+            plain.SerializeToString()).SerializeToString(), data)
+
+  def testCopies(self):
+    message = rdf_flows.GrrMessage(
+        session_id="aff4:/flows/W:1234",
+        request_id=1,
+        payload=rdf_paths.PathSpec(
+            path="/etc/passwd", pathtype=rdf_paths.PathSpec.PathType.OS))
+    self.assertTrue(rdf_flows.GrrMessage.compiled)
+
+    for copied in [message.Copy(), rdf_flows.GrrMessage(message),
+                   pickle.loads(pickle.dumps(message, 2)),
+                   pickle.loads(pickle.dumps(message))]:
+      self.assertEqual(copied, message)
+      self.assertEqual(copied.payload.path, "/etc/passwd")
+      self.assertEqual(copied.SerializeToString(), message.SerializeToString())
+
 
 def main(argv):
   test_lib.GrrTestProgram(argv=argv)
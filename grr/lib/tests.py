@@ -18,6 +18,7 @@ except ImportError:
 from grr.lib import build_test
 from grr.lib import client_index_test
 from grr.lib import communicator_test
+from grr.lib import compression_test
 from grr.lib import config_lib_test
 from grr.lib import config_validation_test
 from grr.lib import console_utils_test
@@ -30,9 +31,11 @@ from grr.lib import flow_test
 from grr.lib import flow_utils_test
 from grr.lib import front_end_test
 from grr.lib import fuse_mount_test
+from grr.lib import http_server_test
 from grr.lib import hunt_test
 from grr.lib import ipv6_utils_test
 from grr.lib import lexer_test
+from grr.lib import notification_bus_test
 from grr.lib import objectfilter_test
 from grr.lib import output_plugin_test
 from grr.lib import parsers_test
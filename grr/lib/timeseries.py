@@ -2,16 +2,35 @@
 """Operations on a series of points, indexed by time.
 """
 
-import copy
+import array
+import bisect
+import itertools
+
+# pylint: disable=g-import-not-at-top
+try:
+  import numpy
+except ImportError:
+  # Without numpy the series operations fall back to plain python loops over
+  # the same arrays.
+  numpy = None
+# pylint: enable=g-import-not-at-top
 
 from grr.lib import rdfvalue
 
 NORMALIZE_MODE_GAUGE = 1
 NORMALIZE_MODE_COUNTER = 2
 
+# Missing values (None) are stored as NaN in the values array.
+_MISSING = float("nan")
+
 
 class Timeseries(object):
-  """Timeseries contains a sequence of points, each with a timestamp."""
+  """Timeseries contains a sequence of points, each with a timestamp.
+
+  Values and timestamps are kept in two parallel arrays of doubles, which
+  represent microsecond timestamps exactly and let numpy operate on the whole
+  series at once when it is available.
+  """
 
   def __init__(self, initializer=None):
     """Create a timeseries with an optional initializer.
@@ -22,14 +41,43 @@ class Timeseries(object):
     Raises:
       RuntimeError: If initializer is not understood.
     """
+    self._values = array.array("d")
+    self._timestamps = array.array("d")
+    # As long as only integers were added, values are reported as integers,
+    # just as they would be if they were kept in python lists.
+    self._int_values = True
+
     if initializer is None:
-      self.data = []
       return
     if isinstance(initializer, Timeseries):
-      self.data = copy.deepcopy(initializer.data)
+      # pylint: disable=protected-access
+      self._values = array.array("d", initializer._values)
+      self._timestamps = array.array("d", initializer._timestamps)
+      self._int_values = initializer._int_values
+      # pylint: enable=protected-access
       return
     raise RuntimeError("Unrecognized initializer.")
 
+  @property
+  def data(self):
+    """The points of the series as a list of [value, timestamp] pairs."""
+    if self._int_values:
+      convert = int
+    else:
+      convert = float
+
+    # NaN is the only value which is not equal to itself.
+    return [[convert(value) if value == value else None, int(timestamp)]
+            for value, timestamp in itertools.izip(self._values,
+                                                   self._timestamps)]
+
+  @data.setter
+  def data(self, points):
+    self._values = array.array("d")
+    self._timestamps = array.array("d")
+    self._int_values = True
+    self.MultiAppend(points)
+
   def _NormalizeTime(self, time):
     """Normalize a time to be an int measured in microseconds."""
     if isinstance(time, rdfvalue.RDFDatetime):
@@ -38,6 +86,21 @@ class Timeseries(object):
       return time.microseconds
     return int(time)
 
+  def _NumpyArrays(self):
+    """Returns numpy views of the values and timestamps arrays."""
+    if not self._values:
+      return numpy.zeros(0), numpy.zeros(0)
+
+    return (numpy.frombuffer(self._values, dtype=numpy.float64),
+            numpy.frombuffer(self._timestamps, dtype=numpy.float64))
+
+  def _SetNumpyArrays(self, values, timestamps):
+    """Replaces the series with the given numpy arrays."""
+    self._values = array.array(
+        "d", numpy.asarray(values, dtype=numpy.float64).tostring())
+    self._timestamps = array.array(
+        "d", numpy.asarray(timestamps, dtype=numpy.float64).tostring())
+
   def Append(self, value, timestamp):
     """Adds value at timestamp.
 
@@ -52,9 +115,16 @@ class Timeseries(object):
     """
 
     timestamp = self._NormalizeTime(timestamp)
-    if self.data and timestamp < self.data[-1][1]:
+    if self._timestamps and timestamp < self._timestamps[-1]:
       raise RuntimeError("Next timestamp must be larger.")
-    self.data.append([value, timestamp])
+
+    if value is None:
+      value = _MISSING
+    elif not isinstance(value, (int, long)):
+      self._int_values = False
+
+    self._values.append(value)
+    self._timestamps.append(timestamp)
 
   def MultiAppend(self, value_timestamp_pairs):
     """Adds multiple value<->timestamp pairs.
@@ -74,14 +144,19 @@ class Timeseries(object):
       start_time: If set, timestamps before start_time will be dropped.
       stop_time: If set, timestamps at or past stop_time will be dropped.
     """
+    # Timestamps are sorted, so the range is a single slice of the arrays.
+    start = 0
+    if start_time is not None:
+      start = bisect.bisect_left(self._timestamps,
+                                 self._NormalizeTime(start_time))
 
-    start_time = self._NormalizeTime(start_time)
-    stop_time = self._NormalizeTime(stop_time)
-    self.data = [
-        p for p in self.data
-        if (start_time is None or p[1] >= start_time
-           ) and (stop_time is None or p[1] < stop_time)
-    ]
+    stop = len(self._timestamps)
+    if stop_time is not None:
+      stop = bisect.bisect_left(self._timestamps,
+                                self._NormalizeTime(stop_time))
+
+    self._values = self._values[start:stop]
+    self._timestamps = self._timestamps[start:stop]
 
   def Normalize(self, period, start_time, stop_time, mode=NORMALIZE_MODE_GAUGE):
     """Normalize the series to have a fixed period over a fixed time range.
@@ -119,33 +194,84 @@ class Timeseries(object):
     period = self._NormalizeTime(period)
     start_time = self._NormalizeTime(start_time)
     stop_time = self._NormalizeTime(stop_time)
-    if not self.data:
+    if not self._values:
       return
 
     self.FilterRange(start_time, stop_time)
 
-    grouped = {}
-    for value, timestamp in self.data:
-      offset = timestamp - start_time
-      shifted_offset = offset - (offset % period)
-      grouped.setdefault(shifted_offset, []).append(value)
-
-    self.data = []
-    last_value = None
-    for offset in range(0, stop_time - start_time, period):
-      g = grouped.get(offset)
-      if mode == NORMALIZE_MODE_GAUGE:
-        v = None
-        if g:
-          v = float(sum(g)) / float(len(g))
-        self.data.append([v, offset + start_time])
-      else:
-        if g:
-          for v in g:
-            if v < last_value:
-              raise RuntimeError("Next value must not be smaller.")
-            last_value = v
-        self.data.append([last_value, offset + start_time])
+    num_periods = max(0, (stop_time - start_time + period - 1) // period)
+    if mode == NORMALIZE_MODE_GAUGE:
+      values = self._NormalizeGauge(period, start_time, num_periods)
+      self._int_values = False
+    else:
+      values = self._NormalizeCounter(period, start_time, num_periods)
+
+    stop = start_time + num_periods * period
+    if numpy is not None:
+      self._SetNumpyArrays(values,
+                           numpy.arange(
+                               start_time, stop, period, dtype=numpy.float64))
+    else:
+      self._values = array.array("d", values)
+      self._timestamps = array.array("d", xrange(start_time, stop, period))
+
+  def _NormalizeGauge(self, period, start_time, num_periods):
+    """Averages the values within each period."""
+    if numpy is not None:
+      values, timestamps = self._NumpyArrays()
+      present = ~numpy.isnan(values)
+      periods = ((timestamps[present] - start_time) // period).astype(
+          numpy.int64)
+      sums = numpy.bincount(
+          periods, weights=values[present], minlength=num_periods)
+      counts = numpy.bincount(periods, minlength=num_periods)
+      return numpy.where(counts, sums / numpy.maximum(counts, 1), _MISSING)
+
+    sums = [0.0] * num_periods
+    counts = [0] * num_periods
+    for value, timestamp in itertools.izip(self._values, self._timestamps):
+      if value != value:
+        continue
+      i = int(timestamp - start_time) // period
+      sums[i] += value
+      counts[i] += 1
+
+    return [
+        total / count if count else _MISSING
+        for total, count in itertools.izip(sums, counts)
+    ]
+
+  def _NormalizeCounter(self, period, start_time, num_periods):
+    """Takes the last value seen during or before each period."""
+    if numpy is not None:
+      values, timestamps = self._NumpyArrays()
+      present = ~numpy.isnan(values)
+      values = values[present]
+      timestamps = timestamps[present]
+      if (numpy.diff(values) < 0).any():
+        raise RuntimeError("Next value must not be smaller.")
+
+      period_ends = start_time + period * numpy.arange(
+          1, num_periods + 1, dtype=numpy.float64)
+      # Index 0 stands for periods before the first value of the series.
+      filled = numpy.concatenate(([_MISSING], values))
+      return filled[numpy.searchsorted(timestamps, period_ends)]
+
+    result = []
+    last_value = _MISSING
+    i = 0
+    for period_end in xrange(start_time + period,
+                             start_time + (num_periods + 1) * period, period):
+      while i < len(self._timestamps) and self._timestamps[i] < period_end:
+        value = self._values[i]
+        if value == value:
+          if value < last_value:
+            raise RuntimeError("Next value must not be smaller.")
+          last_value = value
+        i += 1
+      result.append(last_value)
+
+    return result
 
   def MakeIncreasing(self):
     """Makes the time series increasing.
@@ -159,15 +285,27 @@ class Timeseries(object):
     larger than the previous level.
 
     """
+    if numpy is not None:
+      values, timestamps = self._NumpyArrays()
+      if not values.size:
+        return
+      previous = values[:-1]
+      # Assume that it was only reset once.
+      resets = (previous != 0) & (previous > values[1:])
+      offsets = numpy.cumsum(numpy.where(resets, previous, 0))
+      self._SetNumpyArrays(values + numpy.concatenate(([0], offsets)),
+                           timestamps)
+      return
+
     offset = 0
-    last_value = None
-    for p in self.data:
-      if last_value and last_value > p[0]:
+    last_value = 0
+    for i, value in enumerate(self._values):
+      if last_value and last_value > value:
         # Assume that it was only reset once.
         offset += last_value
-      last_value = p[0]
+      last_value = value
       if offset:
-        p[0] += offset
+        self._values[i] += offset
 
   def ToDeltas(self):
     """Convert the sequence to the sequence of differences between points.
@@ -175,15 +313,21 @@ class Timeseries(object):
     The value of each point v[i] is replaced by v[i+1] - v[i], except for the
     last point which is dropped.
     """
-    if len(self.data) < 2:
-      self.data = []
+    if len(self._values) < 2:
+      self._values = array.array("d")
+      self._timestamps = array.array("d")
+      return
+
+    if numpy is not None:
+      values, timestamps = self._NumpyArrays()
+      # NaN propagates, so a missing point makes both adjacent deltas missing.
+      self._SetNumpyArrays(numpy.diff(values), timestamps[:-1])
       return
-    for i in range(0, len(self.data) - 1):
-      if self.data[i][0] is None or self.data[i + 1][0] is None:
-        self.data[i][0] = None
-      else:
-        self.data[i][0] = self.data[i + 1][0] - self.data[i][0]
-    del self.data[-1]
+
+    values = self._values
+    self._values = array.array(
+        "d", [values[i + 1] - values[i] for i in xrange(len(values) - 1)])
+    del self._timestamps[-1]
 
   def Add(self, other):
     """Add other to self pointwise.
@@ -198,24 +342,63 @@ class Timeseries(object):
     Raises:
       RuntimeError: other does not contain the same timestamps as self.
     """
-    if len(self.data) != len(other.data):
+    # pylint: disable=protected-access
+    if len(self._values) != len(other._values):
       raise RuntimeError("Can only add series of identical lengths.")
-    for i in range(len(self.data)):
-      if self.data[i][1] != other.data[i][1]:
-        raise RuntimeError("Timestamp mismatch.")
-      if self.data[i][0] is None and other.data[i][0] is None:
+    if self._timestamps != other._timestamps:
+      raise RuntimeError("Timestamp mismatch.")
+
+    self._int_values = self._int_values and other._int_values
+
+    if numpy is not None:
+      values, timestamps = self._NumpyArrays()
+      other_values, _ = other._NumpyArrays()
+      missing = numpy.isnan(values)
+      other_missing = numpy.isnan(other_values)
+      # A point is only missing from the sum if it is missing from both.
+      result = (numpy.where(missing, 0, values) +
+                numpy.where(other_missing, 0, other_values))
+      result[missing & other_missing] = _MISSING
+      self._SetNumpyArrays(result, timestamps)
+      return
+
+    for i, other_value in enumerate(other._values):
+      if other_value != other_value:
         continue
-      self.data[i][0] = (self.data[i][0] or 0) + (other.data[i][0] or 0)
+      value = self._values[i]
+      if value != value:
+        self._values[i] = other_value
+      else:
+        self._values[i] = value + other_value
+    # pylint: enable=protected-access
 
   def Rescale(self, multiplier):
     """Multiply pointwise by multiplier."""
-    for p in self.data:
-      if p[0] is not None:
-        p[0] *= multiplier
+    if not isinstance(multiplier, (int, long)):
+      self._int_values = False
+
+    if numpy is not None:
+      values, timestamps = self._NumpyArrays()
+      self._SetNumpyArrays(values * multiplier, timestamps)
+      return
+
+    # NaN stays NaN, so missing values remain missing.
+    self._values = array.array("d", [v * multiplier for v in self._values])
 
   def Mean(self):
     """Return the arithmatic mean of all values."""
-    values = [v for v, _ in self.data if v is not None]
-    if not values:
+    if numpy is not None:
+      values, _ = self._NumpyArrays()
+      values = values[~numpy.isnan(values)]
+      count = values.size
+      total = values.sum()
+    else:
+      values = [v for v in self._values if v == v]
+      count = len(values)
+      total = sum(values)
+
+    if not count:
       return None
-    return sum(values) / len(values)
+    if self._int_values:
+      return int(total) // count
+    return float(total) / count
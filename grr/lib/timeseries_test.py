@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 """Tests for grr.lib.timeseries."""
 
+import copy
+
 from grr.lib import flags
 from grr.lib import test_lib
 from grr.lib import timeseries
+from grr.lib import utils
 
 
 class TimeseriesTest(test_lib.GRRBaseTest):
@@ -118,6 +121,164 @@ class TimeseriesTest(test_lib.GRRBaseTest):
     self.assertEqual(50, s.Mean())
 
 
+class PurePythonTimeseriesTest(TimeseriesTest):
+  """Runs the timeseries tests without numpy."""
+
+  def setUp(self):
+    super(PurePythonTimeseriesTest, self).setUp()
+    self.numpy_stubber = utils.Stubber(timeseries, "numpy", None)
+    self.numpy_stubber.Start()
+
+  def tearDown(self):
+    self.numpy_stubber.Stop()
+    super(PurePythonTimeseriesTest, self).tearDown()
+
+
+class ListTimeseries(object):
+  """The former Timeseries, which kept a list of [value, timestamp] lists.
+
+  Only the operations used by the benchmark are kept, with their original
+  implementation, so the packed arrays can be compared against them.
+  """
+
+  def __init__(self, initializer=None):
+    self.data = copy.deepcopy(initializer.data) if initializer else []
+
+  def MultiAppend(self, value_timestamp_pairs):
+    for value, timestamp in value_timestamp_pairs:
+      if self.data and timestamp < self.data[-1][1]:
+        raise RuntimeError("Next timestamp must be larger.")
+      self.data.append([value, timestamp])
+
+  def FilterRange(self, start_time=None, stop_time=None):
+    self.data = [
+        p for p in self.data
+        if (start_time is None or p[1] >= start_time
+           ) and (stop_time is None or p[1] < stop_time)
+    ]
+
+  def Normalize(self,
+                period,
+                start_time,
+                stop_time,
+                mode=timeseries.NORMALIZE_MODE_GAUGE):
+    if not self.data:
+      return
+
+    self.FilterRange(start_time, stop_time)
+
+    grouped = {}
+    for value, timestamp in self.data:
+      offset = timestamp - start_time
+      shifted_offset = offset - (offset % period)
+      grouped.setdefault(shifted_offset, []).append(value)
+
+    self.data = []
+    last_value = None
+    for offset in range(0, stop_time - start_time, period):
+      g = grouped.get(offset)
+      if mode == timeseries.NORMALIZE_MODE_GAUGE:
+        v = None
+        if g:
+          v = float(sum(g)) / float(len(g))
+        self.data.append([v, offset + start_time])
+      else:
+        if g:
+          for v in g:
+            if v < last_value:
+              raise RuntimeError("Next value must not be smaller.")
+            last_value = v
+        self.data.append([last_value, offset + start_time])
+
+  def MakeIncreasing(self):
+    offset = 0
+    last_value = None
+    for p in self.data:
+      if last_value and last_value > p[0]:
+        offset += last_value
+      last_value = p[0]
+      if offset:
+        p[0] += offset
+
+  def ToDeltas(self):
+    if len(self.data) < 2:
+      self.data = []
+      return
+    for i in range(0, len(self.data) - 1):
+      if self.data[i][0] is None or self.data[i + 1][0] is None:
+        self.data[i][0] = None
+      else:
+        self.data[i][0] = self.data[i + 1][0] - self.data[i][0]
+    del self.data[-1]
+
+  def Rescale(self, multiplier):
+    for p in self.data:
+      if p[0] is not None:
+        p[0] *= multiplier
+
+  def Mean(self):
+    values = [v for v, _ in self.data if v is not None]
+    if not values:
+      return None
+    return sum(values) / len(values)
+
+
+class TimeseriesBenchmark(test_lib.AverageMicroBenchmarks):
+  """Compares timeseries operations against the former list based series.
+
+  The packed array series is timed both with numpy and with its pure Python
+  fallback.
+  """
+
+  REPEATS = 5
+  POINTS = 1000000
+
+  def setUp(self):
+    super(TimeseriesBenchmark, self).setUp()
+    self.series = timeseries.Timeseries()
+    self.series.MultiAppend((i, i * 1000) for i in xrange(self.POINTS))
+    self.list_series = ListTimeseries()
+    self.list_series.MultiAppend((i, i * 1000) for i in xrange(self.POINTS))
+
+  def _RunOperations(self, series_cls=timeseries.Timeseries, series=None):
+    s = series_cls(series or self.series)
+    s.MakeIncreasing()
+    s.Normalize(
+        60 * 1000000,
+        0,
+        self.POINTS * 1000,
+        mode=timeseries.NORMALIZE_MODE_COUNTER)
+    s.ToDeltas()
+    s.Rescale(1 / 60.0)
+    return s.Mean()
+
+  def _RunGaugeOperations(self, series_cls=timeseries.Timeseries, series=None):
+    s = series_cls(series or self.series)
+    s.Normalize(1000000, 0, self.POINTS * 1000)
+    return s.Mean()
+
+  def testTimeseriesOperations(self):
+    """Normalizes and aggregates a series of a million points."""
+    self.TimeIt(
+        self._RunOperations,
+        name="Counter with lists",
+        series_cls=ListTimeseries,
+        series=self.list_series)
+    self.TimeIt(
+        self._RunGaugeOperations,
+        name="Gauge with lists",
+        series_cls=ListTimeseries,
+        series=self.list_series)
+
+    if timeseries.numpy is not None:
+      self.TimeIt(self._RunOperations, name="Counter with numpy")
+      self.TimeIt(self._RunGaugeOperations, name="Gauge with numpy")
+
+    with utils.Stubber(timeseries, "numpy", None):
+      self.TimeIt(self._RunOperations, name="Counter with arrays")
+      self.TimeIt(self._RunGaugeOperations, name="Gauge with arrays")
+
+
 def main(argv):
   test_lib.main(argv)
 
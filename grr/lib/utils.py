@@ -554,6 +554,155 @@ class AgeBasedCache(TimeBasedCache):
     return stored[1]
 
 
+class SizeLimitedAgeBasedCache(FastStore):
+  """An age based LRU cache limited by the total size of its objects.
+
+  The size of each object is computed by size_fn when it is stored. Least
+  recently used objects are expired once the total size exceeds max_bytes.
+  Just like the AgeBasedCache, accessing an object does not keep it alive.
+  """
+
+  def __init__(self, max_bytes=10 * 1024 * 1024, max_age=600, size_fn=len):
+    super(SizeLimitedAgeBasedCache, self).__init__(max_size=max_bytes)
+    self.max_age = max_age
+    self.size_fn = size_fn
+    self.total_bytes = 0
+    self.evictions = 0
+
+  def KillObject(self, obj):
+    self.total_bytes -= obj[2]
+
+  @Synchronized
+  def Expire(self):
+    """Expires the least recently used objects until we are within budget."""
+    while self.total_bytes > self._limit and self._age:
+      node = self._age.PopLeft()
+      self._hash.pop(node.key, None)
+      self.KillObject(node.data)
+      self.evictions += 1
+
+  @Synchronized
+  def Put(self, key, obj):
+    size = self.size_fn(obj)
+    # The entry is about to be replaced so its size must not be counted twice.
+    self.ExpireObject(key)
+    self.total_bytes += size
+    return super(SizeLimitedAgeBasedCache, self).Put(
+        key, [time.time(), obj, size])
+
+  @Synchronized
+  def Pop(self, key):
+    stored = super(SizeLimitedAgeBasedCache, self).Pop(key)
+    if stored:
+      self.KillObject(stored)
+      return stored[1]
+
+  @Synchronized
+  def Get(self, key):
+    stored = super(SizeLimitedAgeBasedCache, self).Get(key)
+    if stored[0] + self.max_age < time.time():
+      self.ExpireObject(key)
+      raise KeyError("Expired")
+
+    return stored[1]
+
+  @Synchronized
+  def __getstate__(self):
+    """When pickled the cache is flushed."""
+    self.Flush()
+    return dict(max_bytes=self._limit, max_age=self.max_age)
+
+  def __setstate__(self, state):
+    self.__init__(max_bytes=state["max_bytes"], max_age=state["max_age"])
+
+
+class ShardedAgeBasedCache(object):
+  """An age based cache split into independently locked shards.
+
+  Keys are assigned to shards by hashing shard_fn(key) so threads working on
+  different objects rarely wait for the same lock. Each shard is a
+  SizeLimitedAgeBasedCache holding an equal part of the max_bytes budget.
+
+  If a shard_fn is given, it must map a prefix passed to ExpirePrefix() to the
+  same value as all the keys starting with it, so only one shard needs to be
+  searched. Without a shard_fn, keys are hashed as they are.
+
+  This exposes the same interface as the AgeBasedCache so they can be used
+  interchangeably.
+  """
+
+  def __init__(self,
+               max_bytes=10 * 1024 * 1024,
+               max_age=600,
+               shards=16,
+               size_fn=len,
+               shard_fn=None):
+    self.max_age = max_age
+    self.shard_fn = shard_fn
+    self.shards = [
+        SizeLimitedAgeBasedCache(
+            max_bytes=max(1, max_bytes // shards),
+            max_age=max_age,
+            size_fn=size_fn) for _ in xrange(shards)
+    ]
+
+  def _GetShard(self, key):
+    if self.shard_fn is not None:
+      key = self.shard_fn(key)
+    return self.shards[hash(key) % len(self.shards)]
+
+  def Get(self, key):
+    """Fetch the object from cache, raises KeyError if it is not present."""
+    return self._GetShard(key).Get(key)
+
+  def Put(self, key, obj):
+    return self._GetShard(key).Put(key, obj)
+
+  def ExpireObject(self, key):
+    return self._GetShard(key).ExpireObject(key)
+
+  def Pop(self, key):
+    return self._GetShard(key).Pop(key)
+
+  def ExpirePrefix(self, prefix):
+    """Expire all the objects with the key having a given prefix."""
+    if self.shard_fn is not None:
+      self._GetShard(prefix).ExpirePrefix(prefix)
+    else:
+      for shard in self.shards:
+        shard.ExpirePrefix(prefix)
+
+  def ExpireRegEx(self, regex):
+    for shard in self.shards:
+      shard.ExpireRegEx(regex)
+
+  def Flush(self):
+    for shard in self.shards:
+      shard.Flush()
+
+  def __contains__(self, key):
+    return key in self._GetShard(key)
+
+  def __getitem__(self, key):
+    return self.Get(key)
+
+  def __iter__(self):
+    for shard in self.shards:
+      for key, data in shard:
+        yield key, data[1]
+
+  def __len__(self):
+    return sum(len(shard) for shard in self.shards)
+
+  @property
+  def total_bytes(self):
+    return sum(shard.total_bytes for shard in self.shards)
+
+  @property
+  def evictions(self):
+    return sum(shard.evictions for shard in self.shards)
+
+
 class Struct(object):
   """A baseclass for parsing binary Structs."""
 
@@ -706,6 +855,13 @@ def NormalizePath(path, sep="/"):
     return sep
   path = SmartUnicode(path)
 
+  # Most paths have no empty, . or .. components, so there is nothing to do but
+  # anchor them at the top level.
+  if (sep + sep not in path and sep + "." not in path and
+      not path.startswith(".")):
+    path = path.strip(sep)
+    return sep + path if path else sep
+
   path_list = path.split(sep)
 
   # This is a relative path and the first element is . or ..
@@ -119,6 +119,79 @@ class StoreTests(test_lib.GRRBaseTest):
     # Make sure it's actually gone.
     self.assertLess(len(utils.TimeBasedCache.active_caches), l)
 
+  def testSizeLimitedAgeBasedCacheExpiresBySize(self):
+    cache = utils.SizeLimitedAgeBasedCache(max_bytes=10)
+    cache.Put("a", "12345")
+    cache.Put("b", "1234")
+    self.assertEqual(cache.total_bytes, 9)
+
+    # Touching "a" makes "b" the least recently used entry.
+    cache.Get("a")
+    cache.Put("c", "12")
+    self.assertRaises(KeyError, cache.Get, "b")
+    self.assertEqual(cache.Get("a"), "12345")
+    self.assertEqual(cache.Get("c"), "12")
+    self.assertEqual(cache.total_bytes, 7)
+    self.assertEqual(cache.evictions, 1)
+
+    # Replacing an entry does not count its size twice.
+    cache.Put("c", "123")
+    self.assertEqual(cache.total_bytes, 8)
+
+    cache.ExpireObject("a")
+    self.assertEqual(cache.total_bytes, 3)
+    cache.Flush()
+    self.assertEqual(cache.total_bytes, 0)
+
+  def testSizeLimitedAgeBasedCacheExpiresByAge(self):
+    cache = utils.SizeLimitedAgeBasedCache(max_age=50)
+    with test_lib.FakeTime(100):
+      cache.Put("key", "hello")
+
+    with test_lib.FakeTime(140):
+      # Accessing the object does not keep it alive.
+      self.assertEqual(cache.Get("key"), "hello")
+
+    with test_lib.FakeTime(160):
+      self.assertRaises(KeyError, cache.Get, "key")
+      self.assertEqual(cache.total_bytes, 0)
+
+  def testShardedAgeBasedCache(self):
+    cache = utils.ShardedAgeBasedCache(max_bytes=1000, shards=4)
+    for i in range(20):
+      cache.Put("key%d" % i, "value%d" % i)
+
+    self.assertEqual(len(cache), 20)
+    for i in range(20):
+      self.assertEqual(cache.Get("key%d" % i), "value%d" % i)
+
+    cache.ExpirePrefix("key1")
+    self.assertEqual(len(cache), 9)
+    self.assertRaises(KeyError, cache.Get, "key1")
+    self.assertRaises(KeyError, cache.Get, "key15")
+    self.assertEqual(cache.Get("key2"), "value2")
+
+    cache.Flush()
+    self.assertEqual(len(cache), 0)
+    self.assertEqual(cache.total_bytes, 0)
+
+  def testShardedAgeBasedCacheWithShardFunction(self):
+    cache = utils.ShardedAgeBasedCache(
+        shards=8, shard_fn=lambda key: key.split(":")[0])
+    for i in range(10):
+      cache.Put("subject%d:a" % i, "x")
+      cache.Put("subject%d:b" % i, "x")
+
+    # All the keys of a subject live in the same shard.
+    shard = cache._GetShard("subject3:")
+    self.assertIn("subject3:a", shard)
+    self.assertIn("subject3:b", shard)
+
+    cache.ExpirePrefix("subject3:")
+    self.assertEqual(len(cache), 18)
+    self.assertRaises(KeyError, cache.Get, "subject3:a")
+    self.assertEqual(cache.Get("subject4:a"), "x")
+
 
 class UtilsTest(test_lib.GRRBaseTest):
   """Utilities tests."""
@@ -132,6 +205,11 @@ class UtilsTest(test_lib.GRRBaseTest):
         ("../foo/bar", "/foo/bar"),
         ("./foo/bar", "/foo/bar"),
         ("/", "/"),
+        ("foo", "/foo"),
+        ("/foo/bar/", "/foo/bar"),
+        ("//foo//bar//", "/foo/bar"),
+        ("/.hidden/a..b", "/.hidden/a..b"),
+        ("", "/"),
     ]
 
     for test, expected in data:
@@ -200,7 +200,10 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
       return ""
     method, perm = cmdinfo
     if perm in permissions:
-      response = method(request)
+      if op == rdf_data_server.DataStoreCommand.Command.APPLY_MUTATIONS:
+        response = method(request, cmd.mutations)
+      else:
+        response = method(request)
     else:
       status_desc = ("Operation not allowed: required %s but only have "
                      "%s permissions" % (perm, permissions))
@@ -801,7 +804,8 @@ def Start(db,
       cmd.LOCK_SUBJECT: (reqhandler_cls.SERVICE.LockSubject, "w"),
       cmd.EXTEND_SUBJECT: (reqhandler_cls.SERVICE.ExtendSubject, "w"),
       cmd.UNLOCK_SUBJECT: (reqhandler_cls.SERVICE.UnlockSubject, "w"),
-      cmd.SCAN_ATTRIBUTES: (reqhandler_cls.SERVICE.ScanAttributes, "r")
+      cmd.SCAN_ATTRIBUTES: (reqhandler_cls.SERVICE.ScanAttributes, "r"),
+      cmd.APPLY_MUTATIONS: (reqhandler_cls.SERVICE.ApplyMutations, "w")
   }
 
   # Initialize nonce store for authentication.
@@ -41,14 +41,14 @@ def RPCWrapper(f):
   """
 
   @functools.wraps(f)
-  def Wrapper(self, request):
+  def Wrapper(self, request, *args):
     """Wrap the function can catch exceptions, converting them to status."""
     failed = True
     response = rdf_data_store.DataStoreResponse()
     response.status = rdf_data_store.DataStoreResponse.Status.OK
 
     try:
-      f(self, request, response)
+      f(self, request, response, *args)
       failed = False
     except access_control.UnauthorizedAccess as e:
       # Attach a copy of the request to the response so the caller can tell why
@@ -109,7 +109,17 @@ class DataStoreService(object):
   @RPCWrapper
   def MultiSet(self, request, unused_response):
     """Set multiple attributes for a given subject at once."""
+    subject, values, to_delete = self._MultiSetArgs(request)
+    self.db.MultiSet(
+        subject,
+        values,
+        to_delete=to_delete,
+        sync=request.sync,
+        replace=False,
+        token=request.token)
 
+  def _MultiSetArgs(self, request):
+    """Returns subject, values and attributes to delete of a MULTI_SET."""
     values = {}
     to_delete = set()
 
@@ -125,13 +135,7 @@ class DataStoreService(object):
         values.setdefault(value.attribute, []).append(
             (value.value.GetValue(), timestamp))
 
-    self.db.MultiSet(
-        request.subject[0],
-        values,
-        to_delete=to_delete,
-        sync=request.sync,
-        replace=False,
-        token=request.token)
+    return request.subject[0], values, to_delete
 
   @RPCWrapper
   def ResolveMulti(self, request, response):
@@ -198,14 +202,21 @@ class DataStoreService(object):
   @RPCWrapper
   def DeleteAttributes(self, request, unused_response):
     """Delete attributes from a given subject."""
+    subject, attributes, start, end = self._DeleteAttributesArgs(request)
+    self.db.DeleteAttributes(
+        subject,
+        attributes,
+        start=start,
+        end=end,
+        token=request.token,
+        sync=request.sync)
+
+  def _DeleteAttributesArgs(self, request):
+    """Returns subject, attributes, start and end of a DELETE_ATTRIBUTES."""
     timestamp = self.FromTimestampSpec(request.timestamp)
-    subject = request.subject[0]
-    sync = request.sync
-    token = request.token
     attributes = [v.attribute for v in request.values]
     start, end = timestamp  # pylint: disable=unpacking-non-sequence
-    self.db.DeleteAttributes(
-        subject, attributes, start=start, end=end, token=token, sync=sync)
+    return request.subject[0], attributes, start, end
 
   @RPCWrapper
   def DeleteSubject(self, request, unused_response):
@@ -213,6 +224,29 @@ class DataStoreService(object):
     token = request.token
     self.db.DeleteSubject(subject, token=token)
 
+  @RPCWrapper
+  def ApplyMutations(self, request, unused_response, mutations):
+    """Applies a batch of mutations in one data store operation."""
+    command = rdf_data_server.DataStoreCommand.Command
+    pool = self.db.GetMutationPool(token=request.token)
+
+    for mutation in mutations:
+      if mutation.command == command.MULTI_SET:
+        subject, values, to_delete = self._MultiSetArgs(mutation.request)
+        pool.MultiSet(subject, values, replace=False, to_delete=to_delete)
+      elif mutation.command == command.DELETE_ATTRIBUTES:
+        subject, attributes, start, end = self._DeleteAttributesArgs(
+            mutation.request)
+        pool.DeleteAttributes(subject, attributes, start=start, end=end)
+      elif mutation.command == command.DELETE_SUBJECT:
+        pool.DeleteSubject(mutation.request.subject[0])
+      else:
+        raise data_store.Error("Command %s can't be batched." %
+                               mutation.command)
+
+    if pool.Size():
+      self.db.ApplyMutations(pool)
+
   def _NewTransaction(self, subject, duration, response):
     transid = utils.SmartStr(uuid.uuid4())
     now = time.time()
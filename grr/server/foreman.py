@@ -34,6 +34,17 @@ class ForemanClientRuleSet(rdf_structs.RDFProtoStruct):
     Returns:
       A bool value of the evaluation.
 
+    Raises:
+      ValueError: The match mode is of unknown value.
+    """
+    return self.Compile()(objects, client_id)
+
+  def Compile(self):
+    """Compiles the rule set into a function evaluating it.
+
+    Returns:
+      A function taking the same arguments as Evaluate and returning a bool.
+
     Raises:
       ValueError: The match mode is of unknown value.
     """
@@ -44,7 +55,12 @@ class ForemanClientRuleSet(rdf_structs.RDFProtoStruct):
     else:
       raise ValueError("Unexpected match mode value: %s" % self.match_mode)
 
-    return quantifier(rule.Evaluate(objects, client_id) for rule in self.rules)
+    matchers = [rule.Compile() for rule in self.rules]
+
+    def Matcher(objects, client_id):
+      return quantifier(matcher(objects, client_id) for matcher in matchers)
+
+    return Matcher
 
   def Validate(self):
     for rule in self.rules:
@@ -77,6 +93,18 @@ class ForemanClientRuleBase(rdf_structs.RDFProtoStruct):
     Returns:
       A bool value of the evaluation.
     """
+    return self.Compile()(objects, client_id)
+
+  def Compile(self):
+    """Compiles the rule into a function evaluating it.
+
+    Everything that does not depend on the client (attribute lookups, regexes,
+    label sets) is resolved here, so the returned function can be applied to
+    many clients cheaply.
+
+    Returns:
+      A function taking the same arguments as Evaluate and returning a bool.
+    """
     raise NotImplementedError
 
   def Validate(self):
@@ -93,6 +121,9 @@ class ForemanClientRule(ForemanClientRuleBase):
   def Evaluate(self, objects, client_id):
     return self.UnionCast().Evaluate(objects, client_id)
 
+  def Compile(self):
+    return self.UnionCast().Compile()
+
   def Validate(self):
     self.UnionCast().Validate()
 
@@ -101,18 +132,29 @@ class ForemanOsClientRule(ForemanClientRuleBase):
   """This rule will fire if the client OS is marked as true in the proto."""
   protobuf = jobs_pb2.ForemanOsClientRule
 
-  def Evaluate(self, objects, client_id):
-    try:
-      fd = objects[client_id]
-      attribute = aff4.Attribute.NAMES["System"]
-    except KeyError:
-      return False
+  def Compile(self):
+    prefixes = []
+    if self.os_windows:
+      prefixes.append("Windows")
+    if self.os_linux:
+      prefixes.append("Linux")
+    if self.os_darwin:
+      prefixes.append("Darwin")
+    prefixes = tuple(prefixes)
+    attribute = aff4.Attribute.NAMES.get("System")
+
+    def Matcher(objects, client_id):
+      if not prefixes or attribute is None:
+        return False
 
-    value = utils.SmartStr(fd.Get(attribute))
+      try:
+        fd = objects[client_id]
+      except KeyError:
+        return False
 
-    return ((self.os_windows and value.startswith("Windows")) or
-            (self.os_linux and value.startswith("Linux")) or
-            (self.os_darwin and value.startswith("Darwin")))
+      return utils.SmartStr(fd.Get(attribute)).startswith(prefixes)
+
+    return Matcher
 
   def Validate(self):
     pass
@@ -122,26 +164,29 @@ class ForemanLabelClientRule(ForemanClientRuleBase):
   """This rule will fire if the client has the selected label."""
   protobuf = jobs_pb2.ForemanLabelClientRule
 
-  def Evaluate(self, objects, client_id):
-    try:
-      fd = objects[client_id]
-    except KeyError:
-      return False
+  def Compile(self):
+    label_names = frozenset(self.label_names)
 
     if self.match_mode == ForemanLabelClientRule.MatchMode.MATCH_ALL:
-      quantifier = all
+      predicate = label_names.issubset
     elif self.match_mode == ForemanLabelClientRule.MatchMode.MATCH_ANY:
-      quantifier = any
+      predicate = lambda names: not label_names.isdisjoint(names)
     elif self.match_mode == ForemanLabelClientRule.MatchMode.DOES_NOT_MATCH_ALL:
-      quantifier = lambda iterable: not all(iterable)
+      predicate = lambda names: not label_names.issubset(names)
     elif self.match_mode == ForemanLabelClientRule.MatchMode.DOES_NOT_MATCH_ANY:
-      quantifier = lambda iterable: not any(iterable)
+      predicate = label_names.isdisjoint
     else:
       raise ValueError("Unexpected match mode value: %s" % self.match_mode)
 
-    client_label_names = set(fd.GetLabelsNames())
+    def Matcher(objects, client_id):
+      try:
+        fd = objects[client_id]
+      except KeyError:
+        return False
+
+      return predicate(set(fd.GetLabelsNames()))
 
-    return quantifier((name in client_label_names) for name in self.label_names)
+    return Matcher
 
   def Validate(self):
     pass
@@ -154,17 +199,23 @@ class ForemanRegexClientRule(ForemanClientRuleBase):
   def GetPathsToCheck(self):
     return [self.path]
 
-  def Evaluate(self, objects, client_id):
-    path = client_id.Add(self.path)
-    try:
-      fd = objects[path]
-      attribute = aff4.Attribute.NAMES[self.attribute_name]
-    except KeyError:
-      return False
+  def Compile(self):
+    path = self.path
+    attribute = aff4.Attribute.NAMES.get(self.attribute_name)
+    regex = self.attribute_regex
+
+    def Matcher(objects, client_id):
+      if attribute is None or regex is None:
+        return False
+
+      try:
+        fd = objects[client_id.Add(path)]
+      except KeyError:
+        return False
 
-    value = utils.SmartStr(fd.Get(attribute))
+      return bool(regex.Search(utils.SmartStr(fd.Get(attribute))))
 
-    return self.attribute_regex.Search(value)
+    return Matcher
 
   def Validate(self):
     if not self.attribute_name:
@@ -182,30 +233,44 @@ class ForemanIntegerClientRule(ForemanClientRuleBase):
   def GetPathsToCheck(self):
     return [self.path]
 
-  def Evaluate(self, objects, client_id):
-    path = client_id.Add(self.path)
-    try:
-      fd = objects[path]
-      attribute = aff4.Attribute.NAMES[self.attribute_name]
-    except KeyError:
-      return False
-
-    try:
-      value = int(fd.Get(attribute))
-    except (ValueError, TypeError):
-      # Not an integer attribute.
-      return False
+  def Compile(self):
+    path = self.path
+    attribute = aff4.Attribute.NAMES.get(self.attribute_name)
 
+    # The operator is turned into an inclusive range of matching values, None
+    # meaning that the range is unbounded.
     op = self.operator
+    value = int(self.value)
     if op == ForemanIntegerClientRule.Operator.LESS_THAN:
-      return value < self.value
+      low, high = None, value - 1
     elif op == ForemanIntegerClientRule.Operator.GREATER_THAN:
-      return value > self.value
+      low, high = value + 1, None
     elif op == ForemanIntegerClientRule.Operator.EQUAL:
-      return value == self.value
+      low, high = value, value
     else:
       # Unknown operator.
-      return False
+      attribute = None
+      low = high = None
+
+    def Matcher(objects, client_id):
+      if attribute is None:
+        return False
+
+      try:
+        fd = objects[client_id.Add(path)]
+      except KeyError:
+        return False
+
+      try:
+        client_value = int(fd.Get(attribute))
+      except (ValueError, TypeError):
+        # Not an integer attribute.
+        return False
+
+      return ((low is None or client_value >= low) and
+              (high is None or client_value <= high))
+
+    return Matcher
 
   def Validate(self):
     if not self.attribute_name:
@@ -237,3 +302,42 @@ class ForemanRule(rdf_structs.RDFProtoStruct):
 class ForemanRules(rdf_protodict.RDFValueArray):
   """A list of rules that the foreman will apply."""
   rdf_type = ForemanRule
+
+
+class ForemanRuleIndex(object):
+  """Foreman rules compiled for evaluation against many clients.
+
+  The index is built once for a given ForemanRules value and then reused for
+  every client the foreman checks until the rules change.
+  """
+
+  def __init__(self, rules):
+    self.rules = rules
+    # Tuples of (created, expires, rule, matcher, paths) in rule order.
+    self.entries = []
+    for rule in rules:
+      rule_set = rule.client_rule_set
+      self.entries.append((int(rule.created), int(rule.expires), rule,
+                           rule_set.Compile(),
+                           sorted(rule_set.GetPathsToCheck())))
+
+    self.latest_created = max([entry[0] for entry in self.entries] or [0])
+    self.earliest_expiry = min([entry[1] for entry in self.entries] or [0])
+
+  def GetRelevantRules(self, last_foreman_run, now):
+    """Returns the rules a client has not been checked against yet.
+
+    Args:
+      last_foreman_run: The time the client was last checked by the foreman.
+      now: The current time, rules expired before this are ignored.
+
+    Returns:
+      A list of (rule, matcher, paths) tuples, where matcher is the compiled
+      client rule set of rule and paths are the aff4 paths it needs opened.
+    """
+    if self.latest_created <= last_foreman_run:
+      return []
+
+    return [(rule, matcher, paths)
+            for created, expires, rule, matcher, paths in self.entries
+            if expires >= now and created > last_foreman_run]
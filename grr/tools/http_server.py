@@ -3,9 +3,14 @@
 
 
 
+import asynchat
+import asyncore
 import BaseHTTPServer
 import cgi
+import contextlib
 import cStringIO
+import email.utils
+import mimetools
 import pdb
 import socket
 import SocketServer
@@ -31,6 +36,7 @@ from grr.lib import master
 from grr.lib import rdfvalue
 from grr.lib import startup
 from grr.lib import stats
+from grr.lib import threadpool
 from grr.lib import type_info
 from grr.lib import utils
 from grr.lib.flows.general import file_finder
@@ -38,34 +44,176 @@ from grr.lib.rdfvalues import flows as rdf_flows
 
 # pylint: disable=g-bad-name
 
+STATUS_TEXT = {
+    200: "200 OK",
+    404: "404 Not Found",
+    406: "406 Not Acceptable",
+    500: "500 Internal Server Error",
+    503: "503 Service Unavailable"
+}
+
+_active_counter_lock = threading.Lock()
+_active_counter = 0
+
+
+@contextlib.contextmanager
+def _ActiveRequest():
+  """Counts the requests currently being processed."""
+  global _active_counter  # pylint: disable=global-statement
+
+  with _active_counter_lock:
+    _active_counter += 1
+    stats.STATS.SetGaugeValue(
+        "frontend_active_count", _active_counter, fields=["http"])
+  try:
+    yield
+  finally:
+    with _active_counter_lock:
+      _active_counter -= 1
+      stats.STATS.SetGaugeValue(
+          "frontend_active_count", _active_counter, fields=["http"])
+
+
+def ProcessControlRequest(frontend, path, headers, post_data, client_ip):
+  """Processes encrypted message bundles POSTed by a client.
+
+  Args:
+    frontend: The FrontEndServer handling the messages.
+    path: The request path, including the query string.
+    headers: The request headers.
+    post_data: The body of the request.
+    client_ip: The ip address the request came from, as a string.
+
+  Returns:
+    A tuple of the http status, the data to respond with and a dict of extra
+    headers.
+  """
+  if not master.MASTER_WATCHER.IsMaster():
+    # We shouldn't be getting requests from the client unless we
+    # are the active instance.
+    stats.STATS.IncrementCounter(
+        "frontend_inactive_request_count", fields=["http"])
+    logging.info("Request sent to inactive frontend from %s", client_ip)
+
+  # Get the api version
+  try:
+    api_version = int(cgi.parse_qs(path.split("?")[1])["api"][0])
+  except (ValueError, KeyError, IndexError):
+    # The oldest api version we support if not specified.
+    api_version = 3
+
+  try:
+    request_comms = rdf_flows.ClientCommunication.FromSerializedString(
+        post_data)
+
+    # If the client did not supply the version in the protobuf we use the get
+    # parameter.
+    if not request_comms.api_version:
+      request_comms.api_version = api_version
+
+    # Reply using the same version we were requested with.
+    responses_comms = rdf_flows.ClientCommunication(
+        api_version=request_comms.api_version)
+
+    source_ip = ipaddr.IPAddress(client_ip)
+
+    if source_ip.version == 6:
+      source_ip = source_ip.ipv4_mapped or source_ip
+
+    request_comms.orig_request = rdf_flows.HttpRequest(
+        raw_headers=utils.SmartStr(headers),
+        source_ip=utils.SmartStr(source_ip))
+
+    request_start_time = time.ctime()
+    source, nr_messages = frontend.HandleMessageBundles(request_comms,
+                                                        responses_comms)
+
+    logging.info("HTTP request from %s (%s) @ %s, %d bytes - %d messages "
+                 "received, %d messages sent.", source,
+                 utils.SmartStr(source_ip), request_start_time, len(post_data),
+                 nr_messages, responses_comms.num_messages)
+
+    return 200, responses_comms.SerializeToString(), {}
+
+  except communicator.UnknownClientCert:
+    # "406 Not Acceptable: The server can only generate a response that is not
+    # accepted by the client". This is because we can not encrypt for the
+    # client appropriately.
+    return 406, "Enrollment required", {}
+
+  except front_end.ServerOverloaded as e:
+    return OverloadedResponse(e.retry_after)
+
+  except Exception as e:  # pylint: disable=broad-except
+    if flags.FLAGS.debug:
+      pdb.post_mortem()
+
+    logging.error("Had to respond with status 500: %s.", e)
+    return 500, "Error", {}
+
+
+def OverloadedResponse(retry_after):
+  """Returns the (status, data, headers) turning away an overloaded request."""
+  # The client keeps its messages and polls again after Retry-After seconds.
+  return 503, "Server overloaded", {"Retry-After": str(retry_after)}
+
+
+def _FormatHeaders(headers):
+  """Formats a dict of extra response headers."""
+  return "".join("%s: %s\r\n" % item
+                 for item in sorted((headers or {}).items()))
+
+
+AFF4_READ_BLOCK_SIZE = 10 * 1024 * 1024
+
+
+def ReadStaticFile(path):
+  """Yields the content of a static file in blocks.
+
+  Args:
+    path: The path of the file below Frontend.static_aff4_prefix.
+
+  Yields:
+    Blocks of data.
+
+  Raises:
+    IOError: The file can not be read.
+    AttributeError: The object is not a stream.
+  """
+  static_aff4_prefix = config_lib.CONFIG["Frontend.static_aff4_prefix"]
+  aff4_path = rdfvalue.RDFURN(static_aff4_prefix).Add(path)
+  logging.info("Serving %s", aff4_path)
+  fd = aff4.FACTORY.Open(aff4_path, token=aff4.FACTORY.root_token)
+  while True:
+    data = fd.Read(AFF4_READ_BLOCK_SIZE)
+    if not data:
+      break
+
+    yield data
+
 
 class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   """GRR HTTP handler for receiving client posts."""
 
-  statustext = {
-      200: "200 OK",
-      404: "404 Not Found",
-      406: "406 Not Acceptable",
-      500: "500 Internal Server Error"
-  }
-
-  active_counter_lock = threading.Lock()
-  active_counter = 0
+  statustext = STATUS_TEXT
 
   def Send(self,
            data,
            status=200,
            ctype="application/octet-stream",
-           last_modified=0):
+           last_modified=0,
+           headers=None):
 
     self.wfile.write(("HTTP/1.0 %s\r\n"
                       "Server: GRR Server\r\n"
                       "Content-type: %s\r\n"
                       "Content-Length: %d\r\n"
                       "Last-Modified: %s\r\n"
+                      "%s"
                       "\r\n"
                       "%s") % (self.statustext[status], ctype, len(data),
-                               self.date_time_string(last_modified), data))
+                               self.date_time_string(last_modified),
+                               _FormatHeaders(headers), data))
 
   def do_GET(self):
     """Serve the server pem with GET requests."""
@@ -76,19 +224,9 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       path = self.path[len(url_prefix):]
       self.ServeStatic(path)
 
-  AFF4_READ_BLOCK_SIZE = 10 * 1024 * 1024
-
   def ServeStatic(self, path):
-    static_aff4_prefix = config_lib.CONFIG["Frontend.static_aff4_prefix"]
-    aff4_path = rdfvalue.RDFURN(static_aff4_prefix).Add(path)
     try:
-      logging.info("Serving %s", aff4_path)
-      fd = aff4.FACTORY.Open(aff4_path, token=aff4.FACTORY.root_token)
-      while True:
-        data = fd.Read(self.AFF4_READ_BLOCK_SIZE)
-        if not data:
-          break
-
+      for data in ReadStaticFile(path):
         self.Send(data)
     except (IOError, AttributeError):
       self.Send("", status=404)
@@ -121,116 +259,362 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   @stats.Timed("frontend_request_latency", fields=["http"])
   def Control(self):
     """Handle POSTS."""
-    if not master.MASTER_WATCHER.IsMaster():
-      # We shouldn't be getting requests from the client unless we
-      # are the active instance.
-      stats.STATS.IncrementCounter(
-          "frontend_inactive_request_count", fields=["http"])
-      logging.info("Request sent to inactive frontend from %s",
-                   self.client_address[0])
+    with _ActiveRequest():
+      try:
+        length = int(self.headers.getheader("content-length"))
+      except (TypeError, ValueError):
+        length = 0
 
-    # Get the api version
-    try:
-      api_version = int(cgi.parse_qs(self.path.split("?")[1])["api"][0])
-    except (ValueError, KeyError, IndexError):
-      # The oldest api version we support if not specified.
-      api_version = 3
+      status, data, headers = ProcessControlRequest(
+          self.server.frontend, self.path, self.headers,
+          self._GetPOSTData(length), self.client_address[0])
+      self.Send(data, status=status, headers=headers)
 
-    with GRRHTTPServerHandler.active_counter_lock:
-      GRRHTTPServerHandler.active_counter += 1
-      stats.STATS.SetGaugeValue(
-          "frontend_active_count", self.active_counter, fields=["http"])
 
-    try:
-      length = int(self.headers.getheader("content-length"))
+def CreateFrontEnd():
+  """Creates the FrontEndServer the http servers hand client messages to."""
+  return front_end.FrontEndServer(
+      certificate=config_lib.CONFIG["Frontend.certificate"],
+      private_key=config_lib.CONFIG["PrivateKeys.server_key"],
+      max_queue_size=config_lib.CONFIG["Frontend.max_queue_size"],
+      message_expiry_time=config_lib.CONFIG["Frontend.message_expiry_time"],
+      max_retransmission_time=config_lib.CONFIG[
+          "Frontend.max_retransmission_time"])
 
-      request_comms = rdf_flows.ClientCommunication.FromSerializedString(
-          self._GetPOSTData(length))
 
-      # If the client did not supply the version in the protobuf we use the get
-      # parameter.
-      if not request_comms.api_version:
-        request_comms.api_version = api_version
+def _AddressFamily(server_address):
+  (address, _) = server_address
+  version = ipaddr.IPAddress(address).version
+  if version == 4:
+    return socket.AF_INET
+  return socket.AF_INET6
 
-      # Reply using the same version we were requested with.
-      responses_comms = rdf_flows.ClientCommunication(
-          api_version=request_comms.api_version)
 
-      source_ip = ipaddr.IPAddress(self.client_address[0])
+class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """The GRR HTTP frontend server."""
 
-      if source_ip.version == 6:
-        source_ip = source_ip.ipv4_mapped or source_ip
+  allow_reuse_address = True
+  request_queue_size = 500
 
-      request_comms.orig_request = rdf_flows.HttpRequest(
-          raw_headers=utils.SmartStr(self.headers),
-          source_ip=utils.SmartStr(source_ip))
+  address_family = socket.AF_INET6
 
-      request_start_time = time.ctime()
-      source, nr_messages = self.server.frontend.HandleMessageBundles(
-          request_comms, responses_comms)
+  def __init__(self, server_address, handler, frontend=None, *args, **kwargs):
+    stats.STATS.SetGaugeValue("frontend_max_active_count",
+                              self.request_queue_size)
 
-      logging.info(
-          "HTTP request from %s (%s) @ %s, %d bytes - %d messages received,"
-          " %d messages sent.", source,
-          utils.SmartStr(source_ip), request_start_time, length, nr_messages,
-          responses_comms.num_messages)
+    self.frontend = frontend or CreateFrontEnd()
+    self.server_cert = config_lib.CONFIG["Frontend.certificate"]
+    self.address_family = _AddressFamily(server_address)
 
-      self.Send(responses_comms.SerializeToString())
+    logging.info("Will attempt to listen on %s", server_address)
+    BaseHTTPServer.HTTPServer.__init__(self, server_address, handler, *args,
+                                       **kwargs)
 
-    except communicator.UnknownClientCert:
-      # "406 Not Acceptable: The server can only generate a response that is not
-      # accepted by the client". This is because we can not encrypt for the
-      # client appropriately.
-      self.Send("Enrollment required", status=406)
 
-    except Exception as e:  # pylint: disable=broad-except
-      if flags.FLAGS.debug:
-        pdb.post_mortem()
+class _LoopTrigger(asyncore.dispatcher):
+  """Runs callbacks queued by other threads on the event loop.
 
-      logging.error("Had to respond with status 500: %s.", e)
-      self.Send("Error", status=500)
+  asyncore channels are not thread safe, so threads processing requests hand
+  their responses back to the loop through this trigger.
+  """
 
-    finally:
-      with GRRHTTPServerHandler.active_counter_lock:
-        GRRHTTPServerHandler.active_counter -= 1
-        stats.STATS.SetGaugeValue(
-            "frontend_active_count", self.active_counter, fields=["http"])
+  def __init__(self, socket_map):
+    self.lock = threading.Lock()
+    self.callbacks = []
+    reader, self.writer = socket.socketpair()
+    self.writer.setblocking(0)
+    asyncore.dispatcher.__init__(self, sock=reader, map=socket_map)
 
+  def writable(self):
+    return False
 
-class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
-  """The GRR HTTP frontend server."""
+  def Call(self, callback, *args, **kwargs):
+    """Queues callback(*args, **kwargs) to be run on the event loop."""
+    with self.lock:
+      self.callbacks.append((callback, args, kwargs))
 
-  allow_reuse_address = True
-  request_queue_size = 500
+    try:
+      self.writer.send("x")
+    except socket.error:
+      # The socket buffer is full so the loop is going to wake up anyways.
+      pass
 
-  address_family = socket.AF_INET6
+  def handle_read(self):
+    try:
+      self.recv(8192)
+    except socket.error:
+      pass
+
+    with self.lock:
+      callbacks, self.callbacks = self.callbacks, []
+
+    for callback, args, kwargs in callbacks:
+      try:
+        callback(*args, **kwargs)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Error in frontend event loop callback: %s", e)
+
+  def close(self):
+    asyncore.dispatcher.close(self)
+    self.writer.close()
+
+
+class AsyncGRRHTTPChannel(asynchat.async_chat):
+  """A client connection served by the AsyncGRRHTTPServer event loop.
+
+  Connections are kept alive between requests. While the executor processes a
+  request nothing more is read from the connection.
+  """
+
+  MAX_HEADER_SIZE = 64 * 1024
+
+  def __init__(self, sock, client_address, server):
+    asynchat.async_chat.__init__(self, sock=sock, map=server.socket_map)
+    self.server = server
+    self.client_address = client_address
+    self.busy = False
+    self.last_activity = time.time()
+    self._ResetRequest()
+
+  def _ResetRequest(self):
+    self.command = None
+    self.path = None
+    self.headers = None
+    self.keep_alive = False
+    self.in_buffer = []
+    self.in_buffer_size = 0
+    self.set_terminator("\r\n\r\n")
+
+  def readable(self):
+    return not self.busy and asynchat.async_chat.readable(self)
+
+  def collect_incoming_data(self, data):
+    self.last_activity = time.time()
+    self.in_buffer.append(data)
+    self.in_buffer_size += len(data)
+    if self.headers is None and self.in_buffer_size > self.MAX_HEADER_SIZE:
+      logging.info("Headers too long from %s", self.client_address[0])
+      self.close()
+
+  def found_terminator(self):
+    data = "".join(self.in_buffer)
+    self.in_buffer = []
+    self.in_buffer_size = 0
+
+    if self.headers is not None:
+      # The body of a POST was read.
+      self._HandleRequest(data)
+      return
+
+    request_line, _, header_lines = data.partition("\r\n")
+    try:
+      self.command, self.path, version = request_line.split()
+    except ValueError:
+      logging.info("Bad request line from %s: %r", self.client_address[0],
+                   request_line[:100])
+      self.close()
+      return
+
+    self.headers = mimetools.Message(cStringIO.StringIO(header_lines))
+    connection = (self.headers.getheader("connection") or "").lower()
+    if version == "HTTP/1.1":
+      self.keep_alive = connection != "close"
+    else:
+      self.keep_alive = connection == "keep-alive"
 
-  def __init__(self, server_address, handler, frontend=None, *args, **kwargs):
-    stats.STATS.SetGaugeValue("frontend_max_active_count",
-                              self.request_queue_size)
+    length = 0
+    if self.command == "POST":
+      try:
+        length = int(self.headers.getheader("content-length"))
+      except (TypeError, ValueError):
+        pass
 
-    if frontend:
-      self.frontend = frontend
+    if length > 0:
+      self.set_terminator(length)
     else:
-      self.frontend = front_end.FrontEndServer(
-          certificate=config_lib.CONFIG["Frontend.certificate"],
-          private_key=config_lib.CONFIG["PrivateKeys.server_key"],
-          max_queue_size=config_lib.CONFIG["Frontend.max_queue_size"],
-          message_expiry_time=config_lib.CONFIG["Frontend.message_expiry_time"],
-          max_retransmission_time=config_lib.CONFIG[
-              "Frontend.max_retransmission_time"])
-    self.server_cert = config_lib.CONFIG["Frontend.certificate"]
+      self._HandleRequest("")
+
+  def _HandleRequest(self, post_data):
+    """Dispatches a fully read request."""
+    self.busy = True
+    url_prefix = config_lib.CONFIG["Frontend.static_url_path_prefix"]
+
+    if self.command == "POST":
+      self._Submit(self._Control, post_data)
+    elif self.command == "GET" and self.path.startswith("/server.pem"):
+      self.SendResponse(self.server.server_cert.AsPEM())
+    elif self.command == "GET" and self.path.startswith(url_prefix):
+      self._Submit(self._ServeStatic, self.path[len(url_prefix):])
+    else:
+      self.SendResponse("", status=404)
+
+  def _Submit(self, target, *args):
+    """Hands target(*args) to the executor, rejecting it if that is full."""
+    try:
+      self.server.executor.AddTask(
+          target=target,
+          args=args,
+          name="FrontendRequest",
+          blocking=False,
+          inline=False)
+    except threadpool.Full:
+      stats.STATS.IncrementCounter(
+          "frontend_rejected_request_count", fields=["http"])
+      status, data, headers = OverloadedResponse(
+          self.server.frontend.admission_controller.RetryAfter(1))
+      self.SendResponse(data, status=status, close=True, headers=headers)
+
+  @stats.Counted("frontend_request_count", fields=["http"])
+  @stats.Timed("frontend_request_latency", fields=["http"])
+  def _Control(self, post_data):
+    """Processes a client POST. Runs on the executor."""
+    with _ActiveRequest():
+      status, data, headers = ProcessControlRequest(
+          self.server.frontend, self.path, self.headers, post_data,
+          self.client_address[0])
+
+    self.server.trigger.Call(self.SendResponse, data, status, headers=headers)
+
+  def _ServeStatic(self, path):
+    """Reads a static file. Runs on the executor."""
+    try:
+      data, status = "".join(ReadStaticFile(path)), 200
+    except (IOError, AttributeError):
+      data, status = "", 404
+    except Exception as e:  # pylint: disable=broad-except
+      # The channel waits for a response, so we always have to send one.
+      logging.exception("Error serving static file %s: %s", path, e)
+      data, status = "Error", 500
+
+    self.server.trigger.Call(self.SendResponse, data, status)
+
+  def SendResponse(self,
+                   data,
+                   status=200,
+                   ctype="application/octet-stream",
+                   last_modified=0,
+                   close=False,
+                   headers=None):
+    """Sends a response and gets ready for the next request."""
+    if not self.connected:
+      # The client went away while we were processing its request.
+      return
+
+    keep_alive = self.keep_alive and not close
+    self.push(("HTTP/1.1 %s\r\n"
+               "Server: GRR Server\r\n"
+               "Content-type: %s\r\n"
+               "Content-Length: %d\r\n"
+               "Last-Modified: %s\r\n"
+               "Connection: %s\r\n"
+               "%s"
+               "\r\n"
+               "%s") % (STATUS_TEXT[status], ctype, len(data),
+                        email.utils.formatdate(last_modified, usegmt=True),
+                        "keep-alive" if keep_alive else "close",
+                        _FormatHeaders(headers), data))
+
+    if keep_alive:
+      self.busy = False
+      self.last_activity = time.time()
+      self._ResetRequest()
+    else:
+      self.close_when_done()
+
+  def handle_error(self):
+    logging.exception("Error on frontend connection from %s",
+                      self.client_address[0])
+    self.close()
 
-    (address, _) = server_address
-    version = ipaddr.IPAddress(address).version
-    if version == 4:
-      self.address_family = socket.AF_INET
-    elif version == 6:
-      self.address_family = socket.AF_INET6
+  def close(self):
+    if self.connected:
+      self.server.connections -= 1
+    asynchat.async_chat.close(self)
+
+
+class AsyncGRRHTTPServer(asyncore.dispatcher):
+  """The GRR HTTP frontend server based on an event loop.
+
+  A single thread handles all the client connections, only the processing of
+  requests, which involves blocking data store access, is handed off to a
+  bounded thread pool. When the pool is busy, new requests are turned away
+  instead of queueing up without bound.
+  """
+
+  request_queue_size = 500
+
+  def __init__(self, server_address, frontend=None):
+    self.socket_map = {}
+    asyncore.dispatcher.__init__(self, map=self.socket_map)
+
+    self.frontend = frontend or CreateFrontEnd()
+    self.server_cert = config_lib.CONFIG["Frontend.certificate"]
+    self.max_connections = config_lib.CONFIG["Frontend.max_connections"]
+    self.keepalive_timeout = config_lib.CONFIG["Frontend.keepalive_timeout"]
+    self.connections = 0
+    self.running = False
 
     logging.info("Will attempt to listen on %s", server_address)
-    BaseHTTPServer.HTTPServer.__init__(self, server_address, handler, *args,
-                                       **kwargs)
+    self.create_socket(_AddressFamily(server_address), socket.SOCK_STREAM)
+    try:
+      self.set_reuse_addr()
+      self.bind(server_address)
+      self.listen(self.request_queue_size)
+    except socket.error:
+      self.close()
+      raise
+
+    max_threads = config_lib.CONFIG["Frontend.executor_max_threads"]
+    stats.STATS.SetGaugeValue("frontend_max_active_count", max_threads)
+    self.executor = threadpool.ThreadPool.Factory(
+        "grr_frontend_executor",
+        min_threads=config_lib.CONFIG["Frontend.executor_min_threads"],
+        max_threads=max_threads)
+    self.executor.Start()
+
+    self.trigger = _LoopTrigger(self.socket_map)
+
+  def readable(self):
+    # Stop accepting connections while we have too many.
+    return self.connections < self.max_connections
+
+  def writable(self):
+    return False
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is None:
+      return
+
+    sock, client_address = pair
+    self.connections += 1
+    AsyncGRRHTTPChannel(sock, client_address, self)
+
+  def _CloseIdleConnections(self, now):
+    for channel in self.socket_map.values():
+      if (isinstance(channel, AsyncGRRHTTPChannel) and not channel.busy and
+          now - channel.last_activity > self.keepalive_timeout):
+        channel.close()
+
+  def serve_forever(self):
+    self.running = True
+    last_check = time.time()
+    while self.running:
+      asyncore.loop(timeout=1, use_poll=True, map=self.socket_map, count=1)
+
+      now = time.time()
+      if now - last_check >= 1:
+        self._CloseIdleConnections(now)
+        last_check = now
+
+  def _Stop(self):
+    self.running = False
+    for channel in self.socket_map.values():
+      channel.close()
+
+  def shutdown(self):
+    """Stops serve_forever, may be called from any thread."""
+    self.trigger.Call(self._Stop)
 
 
 def CreateServer(frontend=None):
@@ -242,8 +626,11 @@ def CreateServer(frontend=None):
 
     server_address = (config_lib.CONFIG["Frontend.bind_address"], port)
     try:
-      httpd = GRRHTTPServer(
-          server_address, GRRHTTPServerHandler, frontend=frontend)
+      if config_lib.CONFIG["Frontend.server_type"] == "async":
+        httpd = AsyncGRRHTTPServer(server_address, frontend=frontend)
+      else:
+        httpd = GRRHTTPServer(
+            server_address, GRRHTTPServerHandler, frontend=frontend)
       break
     except socket.error as e:
       if e.errno == socket.errno.EADDRINUSE and port < max_port: